@@ -0,0 +1,73 @@
+import json
+import os
+import sqlite3
+
+index_name = 'instances_all.sqlite3'
+
+
+def build_index(ann_file, index_file):
+	''' Builds the sqlite index of the images and annotations of ann_file, reading it record by record.
+		Every record is stored as it is, next to the columns used for the lookups '''
+	from maskrcnn_modanet.arrange_annotations import parse_top_level
+
+	if os.path.isfile(index_file + '.tmp'):
+		os.remove(index_file + '.tmp')
+	db = sqlite3.connect(index_file + '.tmp')
+	db.execute('CREATE TABLE images (id INTEGER PRIMARY KEY, file_name TEXT NOT NULL, width INTEGER, height INTEGER, data TEXT NOT NULL)')
+	db.execute('CREATE TABLE annotations (id INTEGER PRIMARY KEY, image_id INTEGER NOT NULL, category_id INTEGER NOT NULL, data TEXT NOT NULL)')
+	db.execute('CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL, data TEXT NOT NULL)')
+
+	with open(ann_file, 'rb') as f:
+		for in_array, key, value in parse_top_level(f):
+			if not in_array:
+				continue
+			if key == 'images':
+				db.execute('INSERT INTO images (id, file_name, width, height, data) VALUES (?, ?, ?, ?, ?)',
+					(value['id'], value['file_name'], value.get('width'), value.get('height'), json.dumps(value)))
+			elif key == 'annotations':
+				db.execute('INSERT INTO annotations (id, image_id, category_id, data) VALUES (?, ?, ?, ?)',
+					(value['id'], value['image_id'], value['category_id'], json.dumps(value)))
+			elif key == 'categories':
+				db.execute('INSERT INTO categories (id, name, data) VALUES (?, ?, ?)', (value['id'], value['name'], json.dumps(value)))
+
+	# indexes are faster to build once the tables are full
+	db.execute('CREATE UNIQUE INDEX images_file_name ON images (file_name)')
+	db.execute('CREATE INDEX annotations_image_id ON annotations (image_id)')
+	db.execute('CREATE INDEX annotations_category_id ON annotations (category_id)')
+	db.commit()
+	db.close()
+	os.replace(index_file + '.tmp', index_file)
+
+
+class AnnotationsIndex(object):
+	''' Read only lookups on the index of instances_all.json '''
+	def __init__(self, index_file):
+		self.db = sqlite3.connect('file:' + index_file + '?mode=ro', uri=True)
+
+	def close(self):
+		self.db.close()
+
+	def image(self, file_name):
+		''' The image with this file name, None if not in the dataset '''
+		row = self.db.execute('SELECT data FROM images WHERE file_name = ?', (file_name,)).fetchone()
+		return json.loads(row[0]) if row else None
+
+	def images(self):
+		return [json.loads(row[0]) for row in self.db.execute('SELECT data FROM images ORDER BY id')]
+
+	def image_annotations(self, image_id):
+		return [json.loads(row[0]) for row in self.db.execute('SELECT data FROM annotations WHERE image_id = ? ORDER BY id', (image_id,))]
+
+	def category_annotations(self, category_id):
+		return [json.loads(row[0]) for row in self.db.execute('SELECT data FROM annotations WHERE category_id = ? ORDER BY id', (category_id,))]
+
+	def categories(self):
+		return [json.loads(row[0]) for row in self.db.execute('SELECT data FROM categories ORDER BY id')]
+
+
+def annotations_index(ann_path):
+	''' Opens the index of ann_path/instances_all.json, building it first if datasets arrange did not '''
+	if not os.path.isfile(ann_path + index_name):
+		print('Indexing the annotations, just for the first time..')
+		build_index(ann_path + 'instances_all.json', ann_path + index_name)
+	return AnnotationsIndex(ann_path + index_name)
@@ -1,153 +1,284 @@
 import json
 import os
 
-with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json') as f:
-	savedvars = json.load(f)
-path = savedvars['datapath']
-
 import copy
+import shutil
 
 import random
 
-
-
-ann_path = path + "datasets/coco/annotations/"
-ann_orig_path = path + 'datasets/modanet/annotations/'
-
-sets_names = ['train', 'val', 'test']
-
-if not os.path.isfile(ann_path + 'instances_all.json'):
-	# copy the modanet instances to the annotations folder
-	with open(ann_orig_path + 'modanet2018_instances_' + sets_names[0] + '.json') as f:
-		instances = json.load(f)
-	with open(ann_path + 'instances_all.json', 'w') as outfile:
-		json.dump(instances, outfile)
-
-print('Now arranging annotations')
-print()
-
-# now asking variables, if not already saved
-if savedvars['percentagetrain'] == None:
-	savedvars['seed'] = input('Random images selection seed (insert a number of your choice): ')
-	savedvars['percentagetrain'] = input('Train Annotations Set Percentage: ')
-	savedvars['percentageval'] = input('Val Annotations Set Percentage: ')
-	savedvars['percentagetest'] = input('Test Annotations Set Percentage: ')
-
-	# now saving them
-	with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json', 'w') as outfile:
-		json.dump(savedvars, outfile)
-
-
-sets_percentages = [int(savedvars['percentagetrain']), int(savedvars['percentageval']), int(savedvars['percentagetest'])]
-random.seed(int(savedvars['seed']))
-
-
-print("Doing " + str([str(p) + '% ' + n for p, n in zip(sets_percentages, sets_names)]))
-print('You can always change them later by typing: maskrcnn-modanet savedvars edit [variable name] [variable value]')
-print('You can check the names of the variables by typing: maskrcnn-modanet savedvars show')
-
-
-with open(ann_path + 'instances_all.json') as f:
-    instances = json.load(f)
-
-print("Annotations:" + str(len(instances['annotations'])))
-print("Images:" + str(len(instances['images'])))
-
-train_ann = {
-	'year': instances['year'],
-	'categories': instances['categories'],
-	'annotations': [],
-	'licenses': instances['licenses'],
-	'type': instances['type'],
-	'info': instances['info'],
-	'images': []
-}
-val_ann = copy.deepcopy(train_ann)
-test_ann = copy.deepcopy(train_ann)
-
-if sum(sets_percentages) != 100:
-	print("Values not valid, doing 80% train, 10 val and 10 test! Please update your sets percentages")
-	sets_percentages = [80, 10, 10]
-
-split_percs = [0]
-for perc in sets_percentages:
-	#make it cumulative
-	last_perc = split_percs.pop()
-	split_percs.extend([last_perc + perc] * 2)
-split_percs.pop()
-# now is [80, 90, 100]
-
-
-#cat_split_percs = [split_percs for i in range(len(instances['categories']) + 1)]
-# has the percentages of cumulative probability for each category (will be modified later)
-
-images_anns = [ [0] * 1115985 for i in range(len(instances['categories']) + 1)] #categories start from one
-# has the images referenced by the annotations for each category, with key the id and value how many annotations has the image of that category
-
-cat_anns = [ [0, 0, 0] for i in range(len(instances['categories']) + 1) ]
-# has [category][set (train{0}, val{1}, test{2})] and as value the number of annotations in that set for that category. to be filled
-
-images_set = [None] * 1115985
-# has as key, image id, as value, (train{0}, val{1}, test{2}). used for faster recovering of this info
-
-for ann in instances['annotations']:
-	images_anns[ann['category_id']][ann['image_id']] += 1
-
-print("Annotations categories for each image recorded")
-
-sum_images_anns = [ sum(images_anns_cat) for images_anns_cat in images_anns ]
-
-
-# now that I know what annotations images contain, apply probability
-for img in instances['images']:
-	img_id = img['id']
-	p = random.random() * 100
-	if p < split_percs[0]:
-		train_ann['images'].append(img)
-		images_set[img_id] = 0
-		for cat_id in range(1, len(instances['categories']) + 1): # for each category
-			cat_anns[cat_id][0] += images_anns[cat_id][img_id] # record how many annotations have been added to a set
-
-	elif split_percs[0] <= p < split_percs[1]:
-		val_ann['images'].append(img)
-		images_set[img_id] = 1
-		for cat_id in range(1, len(instances['categories']) + 1): # for each category
-			cat_anns[cat_id][1] += images_anns[cat_id][img_id] # record how many annotations have been added to a set
-			
-	elif p <= split_percs[2]:
-		test_ann['images'].append(img)
-		images_set[img_id] = 2
-		for cat_id in range(1, len(instances['categories']) + 1): # for each category
-			cat_anns[cat_id][2] += images_anns[cat_id][img_id] # record how many annotations have been added to a set
-			
-
-for cat_id in range(1, len(cat_anns)):
-	print("Category ID: " + str(cat_id) + "\tCat Anns: " + str(sum(cat_anns[cat_id])) + 
-		"\tCat Percs:" + str([i / float(sum(cat_anns[cat_id])) * 100 for i in cat_anns[cat_id]]))
-
-
-
-print()
-print("Adding annotations..")
-for ann in instances['annotations']:
-	# add the annotations to the correct sets
-	img_id = ann['image_id']
-	if images_set[img_id] == 0:
-		train_ann['annotations'].append(ann)
-	elif images_set[img_id] == 1:
-		val_ann['annotations'].append(ann)
-	elif images_set[img_id] == 2:
-		test_ann['annotations'].append(ann)
-print()
-print("Result sum annotations:" + str(sum([len(train_ann['annotations']), len(val_ann['annotations']), len(test_ann['annotations'])])))
-print("Result sum images:" + str(sum([len(train_ann['images']), len(val_ann['images']), len(test_ann['images'])])))
-print()
-print("Now writing files..")
-with open(ann_path + 'instances_train.json', 'w') as outfile:
-	json.dump(train_ann, outfile)
-
-with open(ann_path + 'instances_val.json', 'w') as outfile:
-	json.dump(val_ann, outfile)
-
-with open(ann_path + 'instances_test.json', 'w') as outfile:
-	json.dump(test_ann, outfile)
\ No newline at end of file
+import numpy as np
+
+from maskrcnn_modanet.manifest import Manifest, inputs_hash
+from maskrcnn_modanet.annotations_index import build_index, index_name
+
+
+def split_images(n_images, split_percs):
+	''' Draws the set of each image (train{0}, val{1}, test{2}) with the cumulative percentages split_percs, like [80, 90, 100] '''
+	p = np.array([random.random() * 100 for i in range(n_images)])
+	return np.searchsorted(np.array(split_percs[:-1]), p, side='right')
+
+def annotations_sets(images_ids, images_set, ann_image_ids):
+	''' Returns for each annotation the set of its image, -1 when the image is not among images_ids.
+		Image ids are remapped to their position, so nothing is sized by the largest id '''
+	if len(images_ids) == 0:
+		return np.full(len(ann_image_ids), -1, dtype=np.int64)
+	order = np.argsort(images_ids)
+	sorted_ids = images_ids[order]
+	positions = np.minimum(np.searchsorted(sorted_ids, ann_image_ids), len(sorted_ids) - 1)
+	found = sorted_ids[positions] == ann_image_ids
+	return np.where(found, images_set[order[positions]], -1)
+
+def count_category_annotations(ann_categories, ann_set, n_categories):
+	''' Returns a (n_categories + 1, 3) array with how many annotations of each category are in each set. categories start from one '''
+	assigned = ann_set >= 0
+	counts = np.bincount(ann_categories[assigned] * 3 + ann_set[assigned], minlength=(n_categories + 1) * 3)
+	return counts[:(n_categories + 1) * 3].reshape((n_categories + 1, 3))
+
+def print_category_percentages(cat_anns):
+	for cat_id in range(1, len(cat_anns)):
+		total = cat_anns[cat_id].sum()
+		print("Category ID: " + str(cat_id) + "\tCat Anns: " + str(total) + 
+			"\tCat Percs:" + str([i / float(max(total, 1)) * 100 for i in cat_anns[cat_id].tolist()]))
+
+
+def parse_top_level(f):
+	''' Parses a json object incrementally.
+		Yields (True, key, item) for every item of the arrays at the top level and (False, key, value) for the other top level values.
+		Only one item at a time is kept in memory '''
+	import ijson
+	from ijson.common import ObjectBuilder
+
+	key = None
+	in_array = False
+	builder = None
+	depth = 0
+	for prefix, event, value in ijson.parse(f, use_float=True):
+		if builder is None:
+			if prefix == '':
+				if event == 'map_key':
+					key = value
+				continue
+			if prefix == key and event == 'start_array':
+				in_array = True
+				continue
+			if prefix == key and event == 'end_array':
+				in_array = False
+				continue
+			builder = ObjectBuilder()
+			depth = 0
+		builder.event(event, value)
+		if event in ('start_map', 'start_array'):
+			depth += 1
+		elif event in ('end_map', 'end_array'):
+			depth -= 1
+		if depth == 0:
+			yield in_array, key, builder.value
+			builder = None
+
+def split_streaming(all_file, sets_files, split_percs):
+	''' Same split as the in memory one, but reading all_file and writing the sets files record by record.
+		Images and annotations go to temporary part files, joined at the end with the header values.
+		Memory only depends on the number of images (their set is kept to place the annotations) '''
+	parts = [{part: open(set_file + '.' + part + '.tmp', 'w') for part in ('images', 'annotations')} for set_file in sets_files]
+	counts = [{'images': 0, 'annotations': 0} for set_file in sets_files]
+	def write_item(set_index, part, item):
+		if counts[set_index][part]:
+			parts[set_index][part].write(', ')
+		json.dump(item, parts[set_index][part])
+		counts[set_index][part] += 1
+
+	# first pass: header values and images
+	header = {}
+	images_set = {}
+	with open(all_file, 'rb') as f:
+		for in_array, key, value in parse_top_level(f):
+			if key == 'images':
+				if in_array:
+					set_index = int(split_images(1, split_percs)[0])
+					images_set[value['id']] = set_index
+					write_item(set_index, 'images', value)
+			elif key != 'annotations':
+				if in_array:
+					header.setdefault(key, []).append(value)
+				else:
+					header[key] = value
+	print("Images:" + str(len(images_set)))
+
+	# second pass: annotations, going to the set of their image
+	cat_anns = np.zeros((len(header['categories']) + 1, 3), dtype=np.int64)
+	n_annotations = 0
+	with open(all_file, 'rb') as f:
+		for in_array, key, value in parse_top_level(f):
+			if key == 'annotations' and in_array:
+				n_annotations += 1
+				set_index = images_set.get(value['image_id'])
+				if set_index is not None:
+					cat_anns[value['category_id'], set_index] += 1
+					write_item(set_index, 'annotations', value)
+	print("Annotations:" + str(n_annotations))
+
+	print_category_percentages(cat_anns)
+
+	print()
+	print("Result sum annotations:" + str(sum(c['annotations'] for c in counts)))
+	print("Result sum images:" + str(sum(c['images'] for c in counts)))
+	print()
+	print("Now writing files..")
+	for set_file, set_parts in zip(sets_files, parts):
+		for part in set_parts.values():
+			part.close()
+		# same keys order of the in memory split
+		with open(set_file + '.tmp', 'w') as outfile:
+			outfile.write('{"year": ' + json.dumps(header.get('year')) + ', "categories": ' + json.dumps(header.get('categories', [])) + ', "annotations": [')
+			with open(set_file + '.annotations.tmp') as part:
+				shutil.copyfileobj(part, outfile)
+			outfile.write('], "licenses": ' + json.dumps(header.get('licenses', [])) + ', "type": ' + json.dumps(header.get('type')) + ', "info": ' + json.dumps(header.get('info')) + ', "images": [')
+			with open(set_file + '.images.tmp') as part:
+				shutil.copyfileobj(part, outfile)
+			outfile.write(']}')
+		os.replace(set_file + '.tmp', set_file)
+		os.remove(set_file + '.images.tmp')
+		os.remove(set_file + '.annotations.tmp')
+
+
+def write_json(obj, path):
+	''' Writes to a temporary file first, so an interrupted run never leaves a truncated file behind '''
+	with open(path + '.tmp', 'w') as outfile:
+		json.dump(obj, outfile)
+	os.replace(path + '.tmp', path)
+
+
+def main(streaming=False):
+	with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json') as f:
+		savedvars = json.load(f)
+	path = savedvars['datapath']
+
+	ann_path = path + "datasets/coco/annotations/"
+	ann_orig_path = path + 'datasets/modanet/annotations/'
+
+	sets_names = ['train', 'val', 'test']
+
+	manifest = Manifest(path + 'datasets/coco/manifest.sqlite3')
+
+	orig_file = ann_orig_path + 'modanet2018_instances_' + sets_names[0] + '.json'
+	all_hash = inputs_hash(manifest.file_checksum(orig_file))
+	if not manifest.output_is_current('instances_all.json', ann_path + 'instances_all.json', all_hash):
+		# copy the modanet instances to the annotations folder
+		if streaming:
+			shutil.copyfile(orig_file, ann_path + 'instances_all.json.tmp')
+			os.replace(ann_path + 'instances_all.json.tmp', ann_path + 'instances_all.json')
+		else:
+			with open(orig_file) as f:
+				instances = json.load(f)
+			write_json(instances, ann_path + 'instances_all.json')
+		manifest.set_output('instances_all.json', ann_path + 'instances_all.json', all_hash)
+
+	# index used by viewannotation and viewimage for their single image lookups
+	index_hash = inputs_hash(manifest.output_checksum('instances_all.json'))
+	if not manifest.output_is_current(index_name, ann_path + index_name, index_hash):
+		print('Indexing the annotations..')
+		build_index(ann_path + 'instances_all.json', ann_path + index_name)
+		manifest.set_output(index_name, ann_path + index_name, index_hash)
+
+	print('Now arranging annotations')
+	print()
+
+	# now asking variables, if not already saved
+	if savedvars['percentagetrain'] == None:
+		savedvars['seed'] = input('Random images selection seed (insert a number of your choice): ')
+		savedvars['percentagetrain'] = input('Train Annotations Set Percentage: ')
+		savedvars['percentageval'] = input('Val Annotations Set Percentage: ')
+		savedvars['percentagetest'] = input('Test Annotations Set Percentage: ')
+
+		# now saving them
+		with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json', 'w') as outfile:
+			json.dump(savedvars, outfile)
+
+
+	sets_percentages = [int(savedvars['percentagetrain']), int(savedvars['percentageval']), int(savedvars['percentagetest'])]
+	random.seed(int(savedvars['seed']))
+
+	# the splits only depend on the annotations, the seed and the percentages
+	split_hash = inputs_hash(manifest.output_checksum('instances_all.json'), int(savedvars['seed']), sets_percentages)
+	if all(manifest.output_is_current('instances_' + n + '.json', ann_path + 'instances_' + n + '.json', split_hash) for n in sets_names):
+		print('Annotations sets are up to date, nothing to do')
+		manifest.close()
+		return
+
+
+	print("Doing " + str([str(p) + '% ' + n for p, n in zip(sets_percentages, sets_names)]))
+	print('You can always change them later by typing: maskrcnn-modanet savedvars edit [variable name] [variable value]')
+	print('You can check the names of the variables by typing: maskrcnn-modanet savedvars show')
+
+	if sum(sets_percentages) != 100:
+		print("Values not valid, doing 80% train, 10 val and 10 test! Please update your sets percentages")
+		sets_percentages = [80, 10, 10]
+
+	split_percs = [0]
+	for perc in sets_percentages:
+		#make it cumulative
+		last_perc = split_percs.pop()
+		split_percs.extend([last_perc + perc] * 2)
+	split_percs.pop()
+	# now is [80, 90, 100]
+
+	if streaming:
+		split_streaming(ann_path + 'instances_all.json', [ann_path + 'instances_' + n + '.json' for n in sets_names], split_percs)
+		for set_name in sets_names:
+			manifest.set_output('instances_' + set_name + '.json', ann_path + 'instances_' + set_name + '.json', split_hash)
+		manifest.close()
+		return
+
+	with open(ann_path + 'instances_all.json') as f:
+	    instances = json.load(f)
+
+	print("Annotations:" + str(len(instances['annotations'])))
+	print("Images:" + str(len(instances['images'])))
+
+	train_ann = {
+		'year': instances['year'],
+		'categories': instances['categories'],
+		'annotations': [],
+		'licenses': instances['licenses'],
+		'type': instances['type'],
+		'info': instances['info'],
+		'images': []
+	}
+	val_ann = copy.deepcopy(train_ann)
+	test_ann = copy.deepcopy(train_ann)
+
+
+	images_ids = np.array([img['id'] for img in instances['images']], dtype=np.int64)
+
+	# now apply probability. one draw per image, in the same order as before, so a seed always gives the same sets
+	images_set = split_images(len(images_ids), split_percs)
+	# has for each image (in the order of instances['images']) its set (train{0}, val{1}, test{2})
+
+	ann_set = annotations_sets(images_ids, images_set, np.array([ann['image_id'] for ann in instances['annotations']], dtype=np.int64))
+	# has for each annotation the set of its image, -1 if the image is not in the annotations file
+
+	cat_anns = count_category_annotations(np.array([ann['category_id'] for ann in instances['annotations']], dtype=np.int64), ann_set, len(instances['categories']))
+	# has [category][set (train{0}, val{1}, test{2})] and as value the number of annotations in that set for that category
+
+	print("Annotations categories for each image recorded")
+
+	print_category_percentages(cat_anns)
+
+	print()
+	print("Adding annotations..")
+	for set_index, set_ann in enumerate([train_ann, val_ann, test_ann]):
+		set_ann['images'] = [instances['images'][i] for i in np.flatnonzero(images_set == set_index).tolist()]
+		set_ann['annotations'] = [instances['annotations'][i] for i in np.flatnonzero(ann_set == set_index).tolist()]
+	print()
+	print("Result sum annotations:" + str(sum([len(train_ann['annotations']), len(val_ann['annotations']), len(test_ann['annotations'])])))
+	print("Result sum images:" + str(sum([len(train_ann['images']), len(val_ann['images']), len(test_ann['images'])])))
+	print()
+	print("Now writing files..")
+	for set_name, set_ann in zip(sets_names, [train_ann, val_ann, test_ann]):
+		write_json(set_ann, ann_path + 'instances_' + set_name + '.json')
+		manifest.set_output('instances_' + set_name + '.json', ann_path + 'instances_' + set_name + '.json', split_hash)
+	manifest.close()
+
+
+if __name__ == '__main__':
+	main()
\ No newline at end of file
@@ -1,102 +1,211 @@
 import json
 import os
 
-with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json') as f:
-	print(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json')
-	savedvars = json.load(f)
-path = savedvars['datapath']
-
 import io
-import lmdb
+import hashlib
 import sqlite3
+import time
 import pandas as pd
 from PIL import Image
-import sqlalchemy
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+from maskrcnn_modanet.manifest import Manifest
+from maskrcnn_modanet.photodata import PhotoData, photo_data
 
 # name of the set we are getting the annotations from. in the case of modanet, the set containing all info is the train one.
 set_name = 'train'
 
+# how many photos every worker copies before asking for more work
+chunk_size = 256
+
+# magic numbers of the formats found in the photos database
+signatures = [
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+]
+
+extensions = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.gif': 'GIF',
+    '.bmp': 'BMP',
+}
+
+
+def sniff_format(data):
+    ''' Returns the image format of the encoded data, looking at its first bytes. None if unknown '''
+    head = bytes(data[:8])
+    for signature, image_format in signatures:
+        if head.startswith(signature):
+            return image_format
+    return None
+
 
-img_orig_path = path + 'datasets/paperdoll/data/chictopia/'
-ann_orig_path = path + 'datasets/modanet/annotations/'
-img_path = path + "datasets/coco/images/"
-ann_path = path + "datasets/coco/annotations/"
-
-print("Img coming from : " + img_orig_path)
-print("Ann coming from : " + ann_orig_path)
-print("Img are now here: " + img_path)
-print("Ann are now here: " + ann_path)
-
-
-print(img_orig_path + 'chictopia.sqlite3')
-db = sqlite3.connect(img_orig_path + 'chictopia.sqlite3')
-
-with open(ann_orig_path + 'modanet2018_instances_' + set_name + '.json') as f:
-    instances = json.load(f)
-
-#instances['images'][i]['id']
-photosIDs = []
-photosFILE_NAMEs = [None] * 1115985 #1097474
-for instance in instances['images']:
-    photosIDs.append(instance['id'])
-    photosFILE_NAMEs[instance['id']] = instance['file_name']
-#import ipdb; ipdb.set_trace()
-#photosIDs = [100014, 100040]
-photosIDsString = ''
-for photoID in photosIDs:
-    photosIDsString += str(photoID) + ', '
-photosIDsString = photosIDsString[:-2]
-#print(photosIDsString)
-
-sql = str(sqlalchemy.text("""
-    SELECT
-        *,
-        'http://images2.chictopia.com/' || path AS url
-    FROM photos
-    WHERE photos.post_id IS NOT NULL AND file_file_size IS NOT NULL
-        AND photos.id IN ( %s )
-""" % photosIDsString))
-
-photos = pd.read_sql(sql, con=db)
-print('photos = %d' % (len(photos)))
-photos.head()
-
-class PhotoData(object):
-    def __init__(self, path):
-        self.env = lmdb.open(
-            path, map_size=2**36, readonly=True, lock=False
-        )
-        
-    def __iter__(self):
-        with self.env.begin() as t:
-            with t.cursor() as c:
-                for key, value in c:
-                    yield key, value
-        
-    def __getitem__(self, index):
-        key = str(index).encode('ascii')
-        with self.env.begin() as t:
-            data = t.get(key)
-        if not data:
-            return None
+# every worker process opens the lmdb environment once and keeps it for all its chunks
+_worker_photo_data = None
+
+def _init_worker(lmdb_path):
+    global _worker_photo_data
+    _worker_photo_data = photo_data(lmdb_path)
+
+def save_photo(data, img_path, passthrough=True):
+    ''' Saves the encoded photo to img_path.
+        With passthrough the stored bytes are written as they are when their format matches the extension,
+        otherwise the photo is decoded and encoded again in the format of the extension.
+        The file is written under a temporary name and then renamed, so an interrupted copy never leaves a truncated photo.
+        Returns the size and the md5 checksum of the file written '''
+    target_format = extensions.get(os.path.splitext(img_path)[1].lower())
+    if not (passthrough and target_format is not None and sniff_format(data) == target_format):
         with io.BytesIO(data) as f:
             image = Image.open(f)
             image.load()
-            return image
-        
-    def __len__(self):
-        return self.env.stat()['entries']
-
-photo_data = PhotoData(img_orig_path + 'photos.lmdb')
-print("Total # of photos (also the ones without annotations) is " + str(len(photo_data)))
-print()
-print('Copying photos to the new folder (just for the first run)')
-from progressbar import ProgressBar
-pbar = ProgressBar()
-for i in pbar(range(len(photosIDs))):
-    photo = photos.iloc[i]
-    if not os.path.isfile(img_path + photosFILE_NAMEs[photo.id]):
-    	photo_data[photo.id].save(img_path + photosFILE_NAMEs[photo.id])
-
-print()
-print()
\ No newline at end of file
+        with io.BytesIO() as f:
+            image.save(f, format=target_format or image.format)
+            data = f.getvalue()
+    with open(img_path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(img_path + '.tmp', img_path)
+    return len(data), hashlib.md5(data).hexdigest()
+
+def _copy_chunk(chunk, passthrough=True):
+    ''' Copies a chunk of (photo id, destination path) pairs, sorted by key.
+        Returns a (photo id, file name, size, checksum) row for every photo written '''
+    destinations = dict(chunk)
+    rows = []
+    for photo_id, data in _worker_photo_data.walk(destinations, buffers=True):
+        size, checksum = save_photo(data, destinations[photo_id], passthrough)
+        rows.append((photo_id, os.path.basename(destinations[photo_id]), size, checksum))
+    return rows
+
+
+def copy_photos(lmdb_path, destinations, workers=None, passthrough=True, manifest=None):
+    ''' Copies the photos out of the lmdb database.
+        destinations is a list of (photo id, destination path) pairs.
+        With passthrough, photos already in the format of their extension are copied byte by byte.
+        Every finished chunk is recorded in the manifest, if given, so an interrupted copy can be resumed.
+        Returns the number of photos written '''
+    if workers is None:
+        workers = cpu_count()
+    # chunks are contiguous runs of the lmdb key order, so each worker reads its pages sequentially
+    destinations = sorted(destinations, key=lambda d: str(d[0]).encode('ascii'))
+    chunks = [destinations[i:i + chunk_size] for i in range(0, len(destinations), chunk_size)]
+
+    from progressbar import ProgressBar
+    pbar = ProgressBar(maxval=len(destinations)).start()
+    copied = 0
+    done = 0
+    if workers <= 1:
+        _init_worker(lmdb_path)
+        for chunk in chunks:
+            rows = _copy_chunk(chunk, passthrough)
+            if manifest is not None:
+                manifest.add_photos(rows)
+            copied += len(rows)
+            done += len(chunk)
+            pbar.update(done)
+    else:
+        with Pool(workers, initializer=_init_worker, initargs=(lmdb_path,)) as pool:
+            for rows in pool.imap_unordered(partial(_copy_chunk, passthrough=passthrough), chunks):
+                if manifest is not None:
+                    manifest.add_photos(rows)
+                copied += len(rows)
+                done = min(done + chunk_size, len(destinations))
+                pbar.update(done)
+    pbar.finish()
+    return copied
+
+
+def query_photos_ids(db, photosIDs, chunksize=10000):
+    ''' Yields, chunk by chunk, numpy arrays with the ids of the photos that are in the chictopia database.
+        The ids are loaded in a temporary table and joined, so the statement does not grow with the list '''
+    db.execute('CREATE TEMP TABLE IF NOT EXISTS modanet_ids (id INTEGER PRIMARY KEY)')
+    db.execute('DELETE FROM modanet_ids')
+    db.executemany('INSERT OR IGNORE INTO modanet_ids (id) VALUES (?)', ((int(photoID),) for photoID in photosIDs))
+
+    sql = """
+        SELECT photos.id AS id
+        FROM modanet_ids
+        JOIN photos ON photos.id = modanet_ids.id
+        WHERE photos.post_id IS NOT NULL AND photos.file_file_size IS NOT NULL
+        ORDER BY photos.id
+    """
+    for chunk in pd.read_sql(sql, con=db, chunksize=chunksize):
+        yield chunk['id'].values
+
+
+def main(workers=None, passthrough=True, streaming=False):
+    with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json') as f:
+        print(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json')
+        savedvars = json.load(f)
+    path = savedvars['datapath']
+
+    img_orig_path = path + 'datasets/paperdoll/data/chictopia/'
+    ann_orig_path = path + 'datasets/modanet/annotations/'
+    img_path = path + "datasets/coco/images/"
+    ann_path = path + "datasets/coco/annotations/"
+
+    print("Img coming from : " + img_orig_path)
+    print("Ann coming from : " + ann_orig_path)
+    print("Img are now here: " + img_path)
+    print("Ann are now here: " + ann_path)
+
+
+    print(img_orig_path + 'chictopia.sqlite3')
+    db = sqlite3.connect(img_orig_path + 'chictopia.sqlite3')
+
+    #instances['images'][i]['id']
+    photosIDs = []
+    photosFILE_NAMEs = {}
+    with open(ann_orig_path + 'modanet2018_instances_' + set_name + '.json', 'rb' if streaming else 'r') as f:
+        if streaming:
+            # only one record at a time in memory, whatever the number of annotations
+            from maskrcnn_modanet.arrange_annotations import parse_top_level
+            images = (image for in_array, key, image in parse_top_level(f) if in_array and key == 'images')
+        else:
+            images = json.load(f)['images']
+        for instance in images:
+            photosIDs.append(instance['id'])
+            photosFILE_NAMEs[instance['id']] = instance['file_name']
+        del images
+
+    photos_db = PhotoData(img_orig_path + 'photos.lmdb')
+    print("Total # of photos (also the ones without annotations) is " + str(len(photos_db)))
+    # environments must not be inherited by the copying processes
+    photos_db.close()
+    print()
+    print('Copying photos to the new folder (just for the first run)')
+    # photos recorded in the manifest and still on disk with the same size are not copied again
+    manifest = Manifest(path + 'datasets/coco/manifest.sqlite3')
+    exported = manifest.exported_photos(img_path)
+    missing = {}
+    n_photos = 0
+    for ids in query_photos_ids(db, photosIDs):
+        n_photos += len(ids)
+        for photo_id in ids.tolist():
+            if photo_id not in exported:
+                missing[photo_id] = photosFILE_NAMEs[photo_id]
+    # photos already in the folder from a run before the manifest existed
+    seeded = manifest.seed_photos(img_path, missing)
+    if seeded:
+        print('%d photos found in the images folder added to the manifest' % len(seeded))
+    destinations = [(photo_id, img_path + file_name) for photo_id, file_name in missing.items() if photo_id not in seeded]
+    print('photos = %d' % n_photos)
+    print('%d photos already exported, %d to go' % (n_photos - len(destinations), len(destinations)))
+
+    start = time.time()
+    copied = copy_photos(img_orig_path + 'photos.lmdb', destinations, workers, passthrough, manifest)
+    elapsed = time.time() - start
+    print("Copied %d photos in %.1f seconds (%.1f photos/sec)" % (copied, elapsed, copied / elapsed if elapsed > 0 else 0))
+    manifest.close()
+
+    print()
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,15 @@ def print_help(ctx, param, value):
     click.echo(ctx.get_help())
     ctx.exit()
 
+def get_resolution(config, image_min_side, image_max_side, no_upscale):
+	''' The resolution policy of the options, falling back to the [resolution] section of the config file '''
+	from maskrcnn_modanet.resolution import resolution_policy
+	if config:
+		import configparser
+		path, config = config, configparser.ConfigParser()
+		config.read(path)
+	return resolution_policy(config, image_min_side, image_max_side, False if no_upscale else None)
+
 @click.group()
 def main():
 	"""Main CLI."""
@@ -24,6 +33,7 @@ def datasets():
 	run 
 	  \n\n1 -> maskrcnn-modanet datasets download [your path here]
 	  	\n2 -> maskrcnn-modanet datasets arrange
+	  	\n3 (optional) -> maskrcnn-modanet datasets pack
 	 '''
 	pass
 
@@ -93,6 +103,29 @@ def viewannotation(ctx, img_path):
 		print_help(ctx, None,  value=True)
 
 
+@main.command()
+@click.option('-s', '--set-name', default='val', type=click.Choice(['val', 'test']), help='The set to score the model on, instances_val.json or instances_test.json')
+@click.option('-m', '--model-path', default=None, callback=validators.check_if_file_exists, help='The snapshot to evaluate. Defaults to the last one written by the training')
+@click.option('-t', '--threshold-score', default=0.05, callback=validators.check_if_score_is_valid, help='Lowest score of the detections that are scored')
+@click.option('--store-threshold', default=0.05, callback=validators.check_if_score_is_valid, help='Lowest score of the detections saved, so that scoring again at a higher threshold does not run the model again')
+@click.option('-b', '--batch-size', default=4, type=int, help='Images that go through the model at once')
+@click.option('-w', '--workers', default=None, type=int, help='Number of processes computing the mAPs. Defaults to the number of cpus')
+@click.option('--threads', default=4, type=int, help='Number of threads reading the images and encoding the masks')
+@click.option('--output-dir', default=None, help='Where the detections and the scores are saved. Defaults to results/evaluation/<snapshot>_<set>/')
+@click.option('--restart', is_flag=True, default=False, help='Run the model again on all the images, instead of going on from the detections already saved')
+@click.option('--from-lmdb', is_flag=True, default=False, help='Read the images straight from the paperdoll photos database instead of the images folder')
+@click.option('--image-min-side', default=None, type=int, help='Rescale the image so the smallest side is min_side. Defaults to the [resolution] section of --config, or 800')
+@click.option('--image-max-side', default=None, type=int, help='Rescale the image if the largest side is larger than max_side. Defaults to the [resolution] section of --config, or 1333')
+@click.option('--no-upscale', is_flag=True, default=False, help='Keep the images smaller than the min / max sides at their native resolution. Give the same resolution options used for training')
+@click.option('--config', default=None, callback=validators.check_if_file_exists, help='The .ini file used for training, to read its [resolution] section')
+def evaluate(set_name, model_path, threshold_score, store_threshold, batch_size, workers, threads, output_dir, restart, from_lmdb, image_min_side, image_max_side, no_upscale, config):
+	''' Scores a snapshot on the val or test set: COCO bbox and segmentation mAPs.
+		The detections are saved as they are computed, so an interrupted run goes on where it stopped and scoring at another threshold does not run the model again '''
+	from maskrcnn_modanet import evaluate
+	evaluate.main(set_name, model_path, threshold_score, store_threshold, batch_size, workers, threads, output_dir, restart, from_lmdb,
+		resolution=get_resolution(config, image_min_side, image_max_side, no_upscale))
+
+
 @datasets.command()
 @click.argument('path', callback=validators.check_if_folder_exists)
 def download(path):
@@ -133,12 +166,27 @@ def download(path):
 
 
 @datasets.command()
-def arrange():
+@click.option('-w', '--workers', default=None, type=int, help='Number of processes copying the photos out of the database. Defaults to the number of cpus')
+@click.option('--reencode', is_flag=True, default=False, help='Decode and save again every photo instead of copying the stored bytes as they are')
+@click.option('--streaming', is_flag=True, default=False, help='Read (and write) the annotations record by record, so that memory does not grow with their number')
+def arrange(workers, reencode, streaming):
 	''' Arranges the dataset for training!
 
 	'''
 	from .. import arrange_images
+	arrange_images.main(workers, passthrough=not reencode, streaming=streaming)
 	from .. import arrange_annotations
+	arrange_annotations.main(streaming)
+
+@datasets.command()
+@click.option('--from-lmdb', is_flag=True, default=False, help='Read the images from the paperdoll photos database instead of the images folder')
+@click.option('--shard-size', default=1024, type=int, help='Size of every shard file in MB')
+def pack(from_lmdb, shard_size):
+	''' Packs the arranged train, val and test sets in large shard files for training.
+		Run after arrange, then train with: maskrcnn-modanet train coco --packed
+	'''
+	from .. import pack_dataset
+	pack_dataset.main(from_lmdb, shard_size * 2**20)
 
 @savedvars.command()
 def show():
@@ -181,12 +229,19 @@ def save():
 @click.option('-a', '--all-set', is_flag=True, default=False, help='Results for each image in the validation set')
 @click.option('-m', '--model-path', default=None, callback=validators.check_if_file_exists, help='If you want to use a custom model other than the best one found in results')
 @click.option('-t', '--threshold-score', default=0.5, callback=validators.check_if_score_is_valid, help='Set the lowest level of confidence to show annotations for the image')
+@click.option('--from-lmdb', is_flag=True, default=False, help='Works with option -a. Reads the images straight from the paperdoll photos database instead of the images folder')
+@click.option('--image-min-side', default=None, type=int, help='Rescale the image so the smallest side is min_side. Defaults to the [resolution] section of --config, or 800')
+@click.option('--image-max-side', default=None, type=int, help='Rescale the image if the largest side is larger than max_side. Defaults to the [resolution] section of --config, or 1333')
+@click.option('--no-upscale', is_flag=True, default=False, help='Keep the images smaller than the min / max sides at their native resolution. Give the same resolution options used for training')
+@click.option('--config', default=None, callback=validators.check_if_file_exists, help='The .ini file used for training, to read its [resolution] section')
+@click.option('--profile-steps', default=None, help='Trace the TensorFlow ops of the images first,last (or of a single image, counted from 1), saving Chrome traces and a summary of the top ops in results/logs/profile')
 @click.pass_context
-def image(ctx, proc_img_path, proc_img_url, segments, all_set, model_path, threshold_score):
+def image(ctx, proc_img_path, proc_img_url, segments, all_set, model_path, threshold_score, from_lmdb, image_min_side, image_max_side, no_upscale, config, profile_steps):
 	''' Show processed image '''
 	
 	if (not segments or (segments and not all_set) ) and ((1 if proc_img_path else 0)+(1 if proc_img_url else 0)+(1 if all_set else 0)) == 1:
-		processimages.main(proc_img_path, proc_img_url, all_set, None, model_path, segments, False, threshold_score)
+		processimages.main(proc_img_path, proc_img_url, all_set, None, model_path, segments, False, threshold_score, from_lmdb=from_lmdb,
+			resolution=get_resolution(config, image_min_side, image_max_side, no_upscale), profile_steps=profile_steps)
 	else:
 		print_help(ctx, None,  value=True)
 
@@ -195,12 +250,18 @@ def image(ctx, proc_img_path, proc_img_url, segments, all_set, model_path, thres
 @click.option('-u', '--proc-img-url', callback=validators.check_if_url_downloadable)
 @click.option('-m', '--model-path', default=None, callback=validators.check_if_file_exists, help='If you want to use a custom model other than the best one found in results')
 @click.option('-t', '--threshold-score', default=0.5, callback=validators.check_if_score_is_valid, help='Set the lowest level of confidence to show annotations for the image')
+@click.option('--image-min-side', default=None, type=int, help='Rescale the image so the smallest side is min_side. Defaults to the [resolution] section of --config, or 800')
+@click.option('--image-max-side', default=None, type=int, help='Rescale the image if the largest side is larger than max_side. Defaults to the [resolution] section of --config, or 1333')
+@click.option('--no-upscale', is_flag=True, default=False, help='Keep the images smaller than the min / max sides at their native resolution. Give the same resolution options used for training')
+@click.option('--config', default=None, callback=validators.check_if_file_exists, help='The .ini file used for training, to read its [resolution] section')
+@click.option('--profile-steps', default=None, help='Trace the TensorFlow ops of the images first,last (or of a single image, counted from 1), saving Chrome traces and a summary of the top ops in results/logs/profile')
 @click.pass_context
-def annotations(ctx, proc_img_path, proc_img_url, model_path, threshold_score):
+def annotations(ctx, proc_img_path, proc_img_url, model_path, threshold_score, image_min_side, image_max_side, no_upscale, config, profile_steps):
 	''' Show processed image annotations '''
 	segments = True; all_set = False
 	if (not segments or (segments and not all_set) ) and ((1 if proc_img_path else 0)+(1 if proc_img_url else 0)+(1 if all_set else 0)) == 1:
-		print(processimages.main(proc_img_path, proc_img_url, False, None, model_path, segments, True, threshold_score)) #function returns the annotations
+		print(processimages.main(proc_img_path, proc_img_url, False, None, model_path, segments, True, threshold_score,
+			resolution=get_resolution(config, image_min_side, image_max_side, no_upscale), profile_steps=profile_steps)) #function returns the annotations
 	else:
 		print_help(ctx, None,  value=True)
 
@@ -214,11 +275,18 @@ def annotations(ctx, proc_img_path, proc_img_url, model_path, threshold_score):
 @click.option('-m', '--model-path', default=None, callback=validators.check_if_file_exists, help='If you want to use a custom model other than the best one found in results')
 @click.option('-t', '--threshold-score', default=0.5, callback=validators.check_if_score_is_valid, help='Set the lowest level of confidence to show annotations for the image')
 @click.option('--save-path', default='default', callback=validators.check_if_file_folder_exists, help='Set your save path (including extension .jpg). Defaults inside the processimages folder')
+@click.option('--from-lmdb', is_flag=True, default=False, help='Works with option -a. Reads the images straight from the paperdoll photos database instead of the images folder')
+@click.option('--image-min-side', default=None, type=int, help='Rescale the image so the smallest side is min_side. Defaults to the [resolution] section of --config, or 800')
+@click.option('--image-max-side', default=None, type=int, help='Rescale the image if the largest side is larger than max_side. Defaults to the [resolution] section of --config, or 1333')
+@click.option('--no-upscale', is_flag=True, default=False, help='Keep the images smaller than the min / max sides at their native resolution. Give the same resolution options used for training')
+@click.option('--config', default=None, callback=validators.check_if_file_exists, help='The .ini file used for training, to read its [resolution] section')
+@click.option('--profile-steps', default=None, help='Trace the TensorFlow ops of the images first,last (or of a single image, counted from 1), saving Chrome traces and a summary of the top ops in results/logs/profile')
 @click.pass_context
-def image(ctx, proc_img_path, proc_img_url, save_path, segments, all_set, model_path, threshold_score, limit):
+def image(ctx, proc_img_path, proc_img_url, save_path, segments, all_set, model_path, threshold_score, limit, from_lmdb, image_min_side, image_max_side, no_upscale, config, profile_steps):
 	''' Save processed image '''
 	if (not segments or (segments and not all_set) ) and ((1 if proc_img_path else 0)+(1 if proc_img_url else 0)+(1 if all_set else 0)) == 1:
-		processimages.main(proc_img_path, proc_img_url, all_set, save_path, model_path, segments, False, threshold_score, limit)
+		processimages.main(proc_img_path, proc_img_url, all_set, save_path, model_path, segments, False, threshold_score, limit, from_lmdb,
+			resolution=get_resolution(config, image_min_side, image_max_side, no_upscale), profile_steps=profile_steps)
 	else:
 		print_help(ctx, None,  value=True)
 
@@ -228,11 +296,17 @@ def image(ctx, proc_img_path, proc_img_url, save_path, segments, all_set, model_
 @click.option('-m', '--model-path', default=None, callback=validators.check_if_file_exists, help='If you want to use a custom model other than the best one found in results')
 @click.option('-t', '--threshold-score', default=0.5, callback=validators.check_if_score_is_valid, help='Set the lowest level of confidence to show annotations for the image')
 @click.option('--save-path', default='default', callback=validators.check_if_file_folder_exists, help='Set your save path (including extension .jpg). Defaults inside the processimages folder')
+@click.option('--image-min-side', default=None, type=int, help='Rescale the image so the smallest side is min_side. Defaults to the [resolution] section of --config, or 800')
+@click.option('--image-max-side', default=None, type=int, help='Rescale the image if the largest side is larger than max_side. Defaults to the [resolution] section of --config, or 1333')
+@click.option('--no-upscale', is_flag=True, default=False, help='Keep the images smaller than the min / max sides at their native resolution. Give the same resolution options used for training')
+@click.option('--config', default=None, callback=validators.check_if_file_exists, help='The .ini file used for training, to read its [resolution] section')
+@click.option('--profile-steps', default=None, help='Trace the TensorFlow ops of the images first,last (or of a single image, counted from 1), saving Chrome traces and a summary of the top ops in results/logs/profile')
 @click.pass_context
-def annotations(ctx, proc_img_path, proc_img_url, save_path, model_path, threshold_score):
+def annotations(ctx, proc_img_path, proc_img_url, save_path, model_path, threshold_score, image_min_side, image_max_side, no_upscale, config, profile_steps):
 	''' Save processed image annotations '''
 	segments = True; all_set = False
 	if (not segments or (segments and not all_set) ) and ((1 if proc_img_path else 0)+(1 if proc_img_url else 0)+(1 if all_set else 0)) == 1:
-		processimages.main(proc_img_path, proc_img_url, False, save_path, model_path, segments, True, threshold_score)
+		processimages.main(proc_img_path, proc_img_url, False, save_path, model_path, segments, True, threshold_score,
+			resolution=get_resolution(config, image_min_side, image_max_side, no_upscale), profile_steps=profile_steps)
 	else:
 		print_help(ctx, None,  value=True)
@@ -30,11 +30,19 @@ def check_if_image_exists_in_dataset(ctx, param, value):
 		savedvars = json.load(f)
 	path = savedvars['datapath']
 	images_path = path + "datasets/coco/images/"
+	ann_path = path + "datasets/coco/annotations/"
 	#making path absolute
 	value_path = images_path + value
 
-	# checking if image exists in dataset
-	if not os.path.isfile(value_path):
+	# checking if image exists in dataset, through the annotations index when there is one
+	from maskrcnn_modanet.annotations_index import AnnotationsIndex, index_name
+	if os.path.isfile(ann_path + index_name):
+		index = AnnotationsIndex(ann_path + index_name)
+		exists = index.image(value) is not None
+		index.close()
+	else:
+		exists = os.path.isfile(value_path)
+	if not exists:
 		raise BadParameter("This image doesn't exist in the database. Check if your input is similar to \'01234.jpg\'", ctx, param)
 	return value
 
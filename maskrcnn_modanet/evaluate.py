@@ -0,0 +1,327 @@
+''' Scores a snapshot on the val or test set, without training: the bbox and segm mAPs of COCOeval.
+
+	The model runs on batches of images, read and resized by a pool of threads, and the detections of every image over
+	the store threshold are streamed to <output>/detections.jsonl as they are computed, one line per image with the boxes,
+	scores, categories and RLE masks. A run that was interrupted goes on from the images already in the file, and scoring
+	again at another threshold only reads the file.
+
+	The ground truth of a set is read from an index built once next to its annotations (instances_<set>.gt.sqlite3),
+	with the masks already encoded as RLE. The mAPs are computed by a pool of processes, each running COCOeval.evaluate
+	on a contiguous range of image ids; their per image results are put back together and accumulated as a single
+	COCOeval would. '''
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json') as f:
+	savedvars = json.load(f)
+path = savedvars['datapath']
+
+img_path = path + "datasets/coco/images/"
+ann_path = path + "datasets/coco/annotations/"
+lmdb_path = path + "datasets/paperdoll/data/chictopia/photos.lmdb"
+
+gt_index_name = 'instances_{}.gt.sqlite3'
+detections_name = 'detections.jsonl'
+meta_name = 'meta.json'
+
+
+def build_gt_index(ann_file, index_file):
+	''' Builds the ground truth index of ann_file: its images, categories and annotations, with the masks as RLE '''
+	from pycocotools.coco import COCO
+
+	coco = COCO(ann_file)
+	if os.path.isfile(index_file + '.tmp'):
+		os.remove(index_file + '.tmp')
+	db = sqlite3.connect(index_file + '.tmp')
+	db.execute('CREATE TABLE images (id INTEGER PRIMARY KEY, file_name TEXT NOT NULL, height INTEGER NOT NULL, width INTEGER NOT NULL)')
+	db.execute('CREATE TABLE annotations (id INTEGER PRIMARY KEY, image_id INTEGER NOT NULL, data TEXT NOT NULL)')
+	db.execute('CREATE TABLE categories (id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+
+	for image in coco.dataset['images']:
+		db.execute('INSERT INTO images (id, file_name, height, width) VALUES (?, ?, ?, ?)', (image['id'], image['file_name'], image['height'], image['width']))
+	for category in coco.dataset['categories']:
+		db.execute('INSERT INTO categories (id, data) VALUES (?, ?)', (category['id'], json.dumps(category)))
+	for annotation in coco.dataset['annotations']:
+		# COCOeval would convert the polygons at every evaluation
+		rle = coco.annToRLE(annotation)
+		if not isinstance(rle['counts'], str):
+			rle['counts'] = rle['counts'].decode()
+		data = {key: annotation[key] for key in ('id', 'image_id', 'category_id', 'bbox', 'area') if key in annotation}
+		data['iscrowd']      = annotation.get('iscrowd', 0)
+		data['segmentation'] = rle
+		db.execute('INSERT INTO annotations (id, image_id, data) VALUES (?, ?, ?)', (annotation['id'], annotation['image_id'], json.dumps(data)))
+
+	db.execute('CREATE INDEX annotations_image_id ON annotations (image_id)')
+	db.commit()
+	db.close()
+	os.replace(index_file + '.tmp', index_file)
+
+
+def gt_index(set_name):
+	''' Path of the ground truth index of instances_<set_name>.json, built first if it is missing or older than the annotations '''
+	ann_file   = ann_path + 'instances_{}.json'.format(set_name)
+	index_file = ann_path + gt_index_name.format(set_name)
+	if not os.path.isfile(index_file) or os.path.getmtime(index_file) < os.path.getmtime(ann_file):
+		print('Indexing the ground truth of the {} set, just for the first time..'.format(set_name))
+		build_gt_index(ann_file, index_file)
+	return index_file
+
+
+class GroundTruth(object):
+	''' Read only lookups on a ground truth index '''
+	def __init__(self, index_file):
+		self.db = sqlite3.connect('file:' + index_file + '?mode=ro', uri=True)
+
+	def close(self):
+		self.db.close()
+
+	def images(self):
+		''' (id, file_name, height, width) of every image, by id '''
+		return self.db.execute('SELECT id, file_name, height, width FROM images ORDER BY id').fetchall()
+
+	def categories(self):
+		return [json.loads(row[0]) for row in self.db.execute('SELECT data FROM categories ORDER BY id')]
+
+	def coco(self, first, last):
+		''' A pycocotools COCO of the images with ids from first to last, with their annotations '''
+		images = [{'id': row[0], 'file_name': row[1], 'height': row[2], 'width': row[3]}
+			for row in self.db.execute('SELECT id, file_name, height, width FROM images WHERE id BETWEEN ? AND ? ORDER BY id', (first, last))]
+		annotations = [json.loads(row[0]) for row in self.db.execute(
+			'SELECT annotations.data FROM annotations JOIN images ON annotations.image_id = images.id WHERE images.id BETWEEN ? AND ? ORDER BY annotations.id', (first, last))]
+		return make_coco({'images': images, 'annotations': annotations, 'categories': self.categories()})
+
+
+def make_coco(dataset):
+	from pycocotools.coco import COCO
+
+	coco = COCO()
+	coco.dataset = dataset
+	coco.createIndex()
+	return coco
+
+
+def encode_detections(boxes, scores, labels, masks, scale, height, width, threshold, categories):
+	''' The detections over threshold of an image (outputs of the model for it) in its original size, with (x, y, w, h) boxes and RLE masks '''
+	import cv2
+	from pycocotools import mask as mask_utils
+
+	detections = []
+	for box, score, label, mask in zip(boxes, scores, labels, masks):
+		# scores are sorted by the network
+		if score < threshold:
+			break
+		box = box / scale
+		x1, y1, x2, y2 = np.rint(box).astype(int).tolist()
+		w, h = max(x2 - x1, 1), max(y2 - y1, 1)
+		mask = (cv2.resize(mask[:, :, label].astype(np.float32), (w, h)) > 0.5).astype(np.uint8)
+
+		# the part of the box inside the image
+		segmentation = np.zeros((height, width), dtype=np.uint8)
+		cx1, cy1, cx2, cy2 = max(x1, 0), max(y1, 0), min(x1 + w, width), min(y1 + h, height)
+		if cx2 > cx1 and cy2 > cy1:
+			segmentation[cy1:cy2, cx1:cx2] = mask[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1]
+		rle = mask_utils.encode(np.asfortranarray(segmentation))
+		rle['counts'] = rle['counts'].decode()
+
+		detections.append({
+			'category_id'  : categories[label],
+			'score'        : round(float(score), 5),
+			'bbox'         : [round(float(value), 2) for value in (box[0], box[1], box[2] - box[0], box[3] - box[1])],
+			'segmentation' : rle,
+		})
+	return detections
+
+
+def read_detections(detections_file):
+	''' The detections of every image id in detections_file. A last line cut short by an interrupted run is removed from the file '''
+	detections = {}
+	if not os.path.isfile(detections_file):
+		return detections
+	with open(detections_file, 'rb+') as f:
+		complete = 0
+		for line in f:
+			try:
+				record = json.loads(line.decode()) if line.endswith(b'\n') else None
+			except ValueError:
+				record = None
+			if record is None:
+				break
+			detections[record['image_id']] = record['detections']
+			complete += len(line)
+		f.truncate(complete)
+	return detections
+
+
+def detect(model, images, detections_file, categories, resolution, threshold, batch_size, threads, from_lmdb):
+	''' Runs the model on images (rows of the ground truth index) in batches, appending the detections of every image to detections_file '''
+	from concurrent.futures import ThreadPoolExecutor
+	from keras_retinanet.utils.image import read_image_bgr, preprocess_image
+
+	from maskrcnn_modanet.photodata import photo_data
+
+	def prepare(image):
+		image_id, file_name, height, width = image
+		bgr = photo_data(lmdb_path).read_image_bgr(image_id) if from_lmdb else read_image_bgr(img_path + file_name)
+		resized, scale = resolution.resize_image(preprocess_image(bgr))
+		return resized, scale, bgr.shape[0], bgr.shape[1]
+
+	def batch_inputs(prepared):
+		# padded at the bottom right like the generator batches, so the boxes are the same
+		shape  = np.max([image.shape for image, _, _, _ in prepared], axis=0)
+		inputs = np.zeros((len(prepared),) + tuple(shape), dtype=np.float32)
+		for i, (image, _, _, _) in enumerate(prepared):
+			inputs[i, :image.shape[0], :image.shape[1]] = image
+		return inputs
+
+	batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+	with ThreadPoolExecutor(threads) as executor, open(detections_file, 'a') as f:
+		# the images of the next batch are read while the model runs
+		pending = [executor.submit(lambda batch: list(map(prepare, batch)), batch) for batch in batches[:2]]
+		for b, batch in enumerate(batches):
+			prepared = pending.pop(0).result()
+			if b + 2 < len(batches):
+				pending.append(executor.submit(lambda batch: list(map(prepare, batch)), batches[b + 2]))
+
+			boxes, scores, labels, masks = model.predict_on_batch(batch_inputs(prepared))[-4:]
+			encoded = executor.map(lambda i: encode_detections(boxes[i], scores[i], labels[i], masks[i], prepared[i][1], prepared[i][2], prepared[i][3], threshold, categories),
+				range(len(batch)))
+			for image, detections in zip(batch, encoded):
+				f.write(json.dumps({'image_id': image[0], 'detections': detections}) + '\n')
+			f.flush()
+			print('{}/{}'.format(min((b + 1) * batch_size, len(images)), len(images)), end='\r')
+	print()
+
+
+def evaluate_images(task):
+	''' COCOeval.evaluate of iou_type on the images with ids from first to last of the ground truth index. Returns the per image results '''
+	import contextlib
+	import io
+	from pycocotools.cocoeval import COCOeval
+
+	index_file, first, last, detections, iou_type = task
+	# without the prints of every process
+	with contextlib.redirect_stdout(io.StringIO()):
+		ground_truth = GroundTruth(index_file)
+		coco_gt = ground_truth.coco(first, last)
+		ground_truth.close()
+
+		# the area, for the area ranges, of the mask for segm and of the box for bbox
+		drop = 'bbox' if iou_type == 'segm' else 'segmentation'
+		results = [{key: value for key, value in detection.items() if key != drop} for detection in detections]
+		if results:
+			coco_dt = coco_gt.loadRes(results)
+		else:
+			coco_dt = make_coco({'images': coco_gt.dataset['images'], 'annotations': [], 'categories': coco_gt.dataset['categories']})
+
+		coco_eval = COCOeval(coco_gt, coco_dt, iou_type)
+		coco_eval.params.imgIds = sorted(coco_gt.getImgIds())
+		coco_eval.evaluate()
+	return coco_eval.evalImgs
+
+
+def score(index_file, image_ids, category_ids, detections, iou_type, workers):
+	''' The COCOeval stats of iou_type of the detections (by image id) on image_ids, splitting the evaluation of the images among workers processes '''
+	import copy
+	import multiprocessing
+	from pycocotools.cocoeval import COCOeval
+
+	image_ids = sorted(image_ids)
+	chunks    = [chunk.tolist() for chunk in np.array_split(image_ids, min(workers * 4, len(image_ids))) if len(chunk)]
+	tasks     = [(index_file, chunk[0], chunk[-1], [dict(detection, image_id=image_id) for image_id in chunk for detection in detections.get(image_id, [])], iou_type)
+		for chunk in chunks]
+
+	# spawned, not forked from the process with the TensorFlow session
+	with multiprocessing.get_context('spawn').Pool(workers) as pool:
+		parts = pool.map(evaluate_images, tasks)
+
+	coco_eval = COCOeval(iouType=iou_type)
+	coco_eval.params.imgIds = image_ids
+	coco_eval.params.catIds = sorted(category_ids)
+
+	# evaluate lists the results by category, area range and image: the chunks are put back together on the images
+	areas = len(coco_eval.params.areaRng)
+	evaluated = []
+	for k in range(len(coco_eval.params.catIds) * areas):
+		for part, chunk in zip(parts, chunks):
+			evaluated.extend(part[k * len(chunk):(k + 1) * len(chunk)])
+	coco_eval.evalImgs    = evaluated
+	coco_eval._paramsEval = copy.deepcopy(coco_eval.params)
+
+	print('\n{}:'.format(iou_type))
+	coco_eval.accumulate()
+	coco_eval.summarize()
+	return coco_eval.stats
+
+
+def main(set_name='val', model_path=None, threshold=0.05, store_threshold=0.05, batch_size=4, workers=None, threads=4, output_dir=None, restart=False, from_lmdb=False, resolution=None):
+	from multiprocessing import cpu_count
+
+	from maskrcnn_modanet.processimages import default_model_path
+	from maskrcnn_modanet.resolution import ResolutionPolicy
+
+	if resolution is None:
+		resolution = ResolutionPolicy()
+	if workers is None:
+		workers = cpu_count()
+	if not model_path:
+		model_path = default_model_path()
+	if output_dir is None:
+		output_dir = path + 'results/evaluation/' + os.path.splitext(os.path.basename(model_path))[0] + '_' + set_name + '/'
+	os.makedirs(output_dir, exist_ok=True)
+	print(model_path)
+
+	index_file   = gt_index(set_name)
+	ground_truth = GroundTruth(index_file)
+	images       = ground_truth.images()
+	category_ids = [category['id'] for category in ground_truth.categories()]
+	ground_truth.close()
+
+	# the detections saved by a previous run are kept if they come from the same model, resolution and a low enough threshold
+	detections_file = os.path.join(output_dir, detections_name)
+	meta = {'model': model_path, 'model_mtime': os.path.getmtime(model_path), 'set': set_name, 'resolution': repr(resolution), 'store_threshold': min(store_threshold, threshold)}
+	try:
+		with open(os.path.join(output_dir, meta_name)) as f:
+			saved = json.load(f)
+	except (IOError, ValueError):
+		saved = None
+	if restart or saved is None or any(saved.get(key) != meta[key] for key in ('model', 'model_mtime', 'set', 'resolution')) or saved['store_threshold'] > threshold:
+		if saved is not None and os.path.isfile(detections_file):
+			print('Running the model again on all the images: {}'.format('--restart' if restart else 'the saved detections are of another model, resolution or a higher threshold'))
+		if os.path.isfile(detections_file):
+			os.remove(detections_file)
+		with open(os.path.join(output_dir, meta_name), 'w') as f:
+			json.dump(meta, f, indent=2)
+	else:
+		meta = saved
+
+	detections = read_detections(detections_file)
+	missing    = [image for image in images if image[0] not in detections]
+	if missing:
+		import keras
+
+		from maskrcnn_modanet.processimages import get_session
+		from maskrcnn_modanet.train.snapshots import load_snapshot
+
+		print('Detecting the {} images left of {}'.format(len(missing), len(images)))
+		keras.backend.tensorflow_backend.set_session(get_session())
+		model = load_snapshot(model_path, backbone_name='resnet50')
+		# the labels of the model are the categories by id
+		detect(model, missing, detections_file, category_ids, resolution, meta['store_threshold'], batch_size, threads, from_lmdb)
+		detections = read_detections(detections_file)
+
+	detections = {image_id: [detection for detection in image_detections if detection['score'] >= threshold] for image_id, image_detections in detections.items()}
+	image_ids  = [image[0] for image in images]
+
+	from maskrcnn_modanet.train.evaluation import stat_names
+	scores = {'model': model_path, 'set': set_name, 'threshold': threshold}
+	for iou_type in ('bbox', 'segm'):
+		stats = score(index_file, image_ids, category_ids, detections, iou_type, workers)
+		scores[iou_type] = dict(zip(stat_names, [float(value) for value in stats]))
+
+	with open(os.path.join(output_dir, 'scores_{}.json'.format(threshold)), 'w') as f:
+		json.dump(scores, f, indent=2)
+	print('\nbbox mAP {:.3f}, segm mAP {:.3f}, saved in {}'.format(scores['bbox']['mAP'], scores['segm']['mAP'], output_dir))
+	return scores
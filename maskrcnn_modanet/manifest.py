@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+
+def file_checksum(path, block_size=2**20):
+	''' md5 of the content of the file, read block by block '''
+	md5 = hashlib.md5()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			md5.update(block)
+	return md5.hexdigest()
+
+def inputs_hash(*inputs):
+	''' Hash of json serializable inputs (checksums, seeds, percentages..), used to know if an output is still valid '''
+	return hashlib.md5(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Manifest(object):
+	''' Persistent record of the work done by datasets arrange.
+
+		photos:  every photo exported to the images folder, with its size and checksum
+		outputs: every file produced from other inputs (like the annotations splits) with the hash of those inputs
+		files:   checksums of input files, so that they are computed again only when size or modification time change
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.db = sqlite3.connect(path)
+		self.db.execute('CREATE TABLE IF NOT EXISTS photos (id INTEGER PRIMARY KEY, file_name TEXT NOT NULL, size INTEGER NOT NULL, checksum TEXT NOT NULL)')
+		self.db.execute('CREATE TABLE IF NOT EXISTS outputs (name TEXT PRIMARY KEY, inputs_hash TEXT NOT NULL, size INTEGER NOT NULL, checksum TEXT NOT NULL)')
+		self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, checksum TEXT NOT NULL)')
+		self.db.commit()
+
+	def close(self):
+		self.db.close()
+
+	def exported_photos(self, folder):
+		''' Returns the ids of the photos recorded as exported whose file is still in folder with the recorded size.
+			The folder is listed once instead of checking every file '''
+		sizes = {}
+		if os.path.isdir(folder):
+			for entry in os.scandir(folder):
+				if entry.is_file():
+					sizes[entry.name] = entry.stat().st_size
+		exported = set()
+		for photo_id, file_name, size in self.db.execute('SELECT id, file_name, size FROM photos'):
+			if sizes.get(file_name) == size:
+				exported.add(photo_id)
+		return exported
+
+	def seed_photos(self, folder, file_names):
+		''' Records the photos of file_names ({id: file name}) that are in folder, like the ones exported before there was a manifest,
+			so that they are not copied again. Returns their ids.
+			Only a manifest without photos is seeded: once it records the copies, a file it does not know about may have been
+			left by an interrupted copy, and is copied again '''
+		if self.db.execute('SELECT 1 FROM photos LIMIT 1').fetchone():
+			return set()
+		rows = []
+		for photo_id, file_name in file_names.items():
+			path = os.path.join(folder, file_name)
+			if os.path.isfile(path) and os.path.getsize(path) > 0:
+				rows.append((photo_id, file_name, os.path.getsize(path), file_checksum(path)))
+		self.add_photos(rows)
+		return {row[0] for row in rows}
+
+	def add_photos(self, rows):
+		''' rows are (id, file_name, size, checksum). Committed right away, so an interrupted run keeps them '''
+		self.db.executemany('INSERT OR REPLACE INTO photos (id, file_name, size, checksum) VALUES (?, ?, ?, ?)', rows)
+		self.db.commit()
+
+	def file_checksum(self, path):
+		''' Checksum of an input file, cached until its size or modification time change '''
+		stat = os.stat(path)
+		row = self.db.execute('SELECT size, mtime_ns, checksum FROM files WHERE path = ?', (path,)).fetchone()
+		if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+			return row[2]
+		checksum = file_checksum(path)
+		self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime_ns, checksum) VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns, checksum))
+		self.db.commit()
+		return checksum
+
+	def output_is_current(self, name, path, inputs_hash):
+		''' True if path was produced by inputs with the same hash and was not modified since '''
+		row = self.db.execute('SELECT inputs_hash, size FROM outputs WHERE name = ?', (name,)).fetchone()
+		if not row or row[0] != inputs_hash:
+			return False
+		return os.path.isfile(path) and os.path.getsize(path) == row[1]
+
+	def output_checksum(self, name):
+		row = self.db.execute('SELECT checksum FROM outputs WHERE name = ?', (name,)).fetchone()
+		return row[0] if row else None
+
+	def set_output(self, name, path, inputs_hash):
+		''' Records that path has been fully written from inputs with this hash '''
+		checksum = self.file_checksum(path)
+		self.db.execute('INSERT OR REPLACE INTO outputs (name, inputs_hash, size, checksum) VALUES (?, ?, ?, ?)', (name, inputs_hash, os.path.getsize(path), checksum))
+		self.db.commit()
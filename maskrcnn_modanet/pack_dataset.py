@@ -0,0 +1,210 @@
+import json
+import mmap
+import os
+
+import numpy as np
+
+# Packed sets are made of shard files (set-0000.rec, set-0001.rec..) and an index (set.idx.npy).
+# Every record is a contiguous run of bytes in a shard:
+#   encoded image | bboxes float32 (n, 4) | labels int32 (n,) | annotations ids int64 (n,) | rle lengths int32 (n,) | rle counts
+# bboxes are x1, y1, x2, y2 already clipped to the image, labels are the coco category ids
+# and the masks are compressed coco RLEs of the whole image.
+index_dtype = np.dtype([
+	('image_id',    '<i8'),
+	('shard',       '<i4'),
+	('offset',      '<i8'),
+	('image_size',  '<i8'),
+	('annotations', '<i4'),
+	('rle_size',    '<i8'),
+	('height',      '<i4'),
+	('width',       '<i4'),
+])
+
+sets_names = ['train', 'val', 'test']
+
+
+def shard_path(path, set_name, shard):
+	return os.path.join(path, '{}-{:04d}.rec'.format(set_name, shard))
+
+def index_path(path, set_name):
+	return os.path.join(path, set_name + '.idx.npy')
+
+
+def encode_annotations(annotations, height, width):
+	''' Returns the bboxes, labels, ids and RLE counts of the annotations, skipping crowds and the ones with basically no width / height '''
+	from pycocotools import mask as maskUtils
+
+	bboxes, labels, ids, counts = [], [], [], []
+	for a in annotations:
+		if a.get('iscrowd', 0) or a['bbox'][2] < 1 or a['bbox'][3] < 1:
+			continue
+		bboxes.append([
+			a['bbox'][0],
+			a['bbox'][1],
+			min(a['bbox'][0] + a['bbox'][2], width),
+			min(a['bbox'][1] + a['bbox'][3], height),
+		]) # normalizing annotations that exit boundaries
+		labels.append(a['category_id'])
+		ids.append(a['id'])
+		rle = maskUtils.merge(maskUtils.frPyObjects(a['segmentation'], height, width))
+		counts.append(rle['counts'])
+
+	return (
+		np.array(bboxes, dtype='<f4').reshape((-1, 4)),
+		np.array(labels, dtype='<i4'),
+		np.array(ids, dtype='<i8'),
+		counts,
+	)
+
+
+def pack_set(ann_file, out_path, set_name, read_image, shard_size=2**30):
+	''' Writes the images and annotations of ann_file in shards of about shard_size bytes.
+		read_image(image_info) returns the encoded image. Returns the number of records written '''
+	with open(ann_file) as f:
+		instances = json.load(f)
+
+	images_anns = {}
+	for ann in instances['annotations']:
+		images_anns.setdefault(ann['image_id'], []).append(ann)
+	images = sorted(instances['images'], key=lambda img: img['id'])
+	del instances
+
+	index = np.zeros(len(images), dtype=index_dtype)
+	shard = 0
+	out = open(shard_path(out_path, set_name, shard) + '.tmp', 'wb')
+	shards = [shard_path(out_path, set_name, shard)]
+
+	from progressbar import ProgressBar
+	pbar = ProgressBar()
+	for i in pbar(range(len(images))):
+		img = images[i]
+		if out.tell() >= shard_size:
+			out.close()
+			shard += 1
+			out = open(shard_path(out_path, set_name, shard) + '.tmp', 'wb')
+			shards.append(shard_path(out_path, set_name, shard))
+
+		data = read_image(img)
+		bboxes, labels, ids, counts = encode_annotations(images_anns.get(img['id'], []), img['height'], img['width'])
+		lengths = np.array([len(c) for c in counts], dtype='<i4')
+
+		index[i] = (img['id'], shard, out.tell(), len(data), len(labels), lengths.sum(), img['height'], img['width'])
+		out.write(data)
+		for array in (bboxes, labels, ids, lengths):
+			out.write(array.tobytes())
+		for c in counts:
+			out.write(c)
+	empty = out.tell() == 0
+	out.close()
+	if empty:
+		# an empty set (or shard) has nothing to map, so it is not written
+		os.remove(shards.pop() + '.tmp')
+
+	# shards and index only appear once complete
+	for path in shards:
+		os.replace(path + '.tmp', path)
+	np.save(index_path(out_path, set_name) + '.tmp.npy', index)
+	os.replace(index_path(out_path, set_name) + '.tmp.npy', index_path(out_path, set_name))
+	return len(index)
+
+
+class PackedSet(object):
+	''' Reads the records of a packed set. Shards are memory mapped once in every process that reads them '''
+	def __init__(self, path, set_name):
+		self.path     = path
+		self.set_name = set_name
+		self.index    = np.load(index_path(path, set_name))
+		self.position = {image_id: i for i, image_id in enumerate(self.index['image_id'].tolist())}
+		self._pid     = None
+		self._shards  = {}
+
+	def __getstate__(self):
+		# memory maps are not shared, every process maps the shards again
+		state = self.__dict__.copy()
+		state['_pid'] = None
+		state['_shards'] = {}
+		return state
+
+	def __len__(self):
+		return len(self.index)
+
+	def shard(self, shard):
+		if self._pid != os.getpid():
+			self._pid = os.getpid()
+			self._shards = {}
+		if shard not in self._shards:
+			with open(shard_path(self.path, self.set_name, shard), 'rb') as f:
+				# mmap cannot map an empty file
+				if os.fstat(f.fileno()).st_size == 0:
+					self._shards[shard] = b''
+				else:
+					self._shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return self._shards[shard]
+
+	def record(self, image_id):
+		''' Returns the record of image_id as a dict with the encoded image and its annotations.
+			Arrays are read only views on the shard '''
+		entry = self.index[self.position[image_id]]
+		buf = memoryview(self.shard(int(entry['shard'])))
+		offset = int(entry['offset'])
+		n = int(entry['annotations'])
+
+		image = buf[offset:offset + int(entry['image_size'])]
+		offset += int(entry['image_size'])
+		bboxes = np.frombuffer(buf, dtype='<f4', count=n * 4, offset=offset).reshape((n, 4))
+		offset += n * 16
+		labels = np.frombuffer(buf, dtype='<i4', count=n, offset=offset)
+		offset += n * 4
+		ids = np.frombuffer(buf, dtype='<i8', count=n, offset=offset)
+		offset += n * 8
+		lengths = np.frombuffer(buf, dtype='<i4', count=n, offset=offset)
+		offset += n * 4
+
+		size = [int(entry['height']), int(entry['width'])]
+		rles = []
+		for length in lengths.tolist():
+			rles.append({'size': size, 'counts': bytes(buf[offset:offset + length])})
+			offset += length
+
+		return {
+			'image'  : image,
+			'bboxes' : bboxes,
+			'labels' : labels,
+			'ids'    : ids,
+			'rles'   : rles,
+			'height' : size[0],
+			'width'  : size[1],
+		}
+
+
+def main(from_lmdb=False, shard_size=2**30):
+	with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json') as f:
+		savedvars = json.load(f)
+	path = savedvars['datapath']
+
+	img_path = path + "datasets/coco/images/"
+	ann_path = path + "datasets/coco/annotations/"
+	packed_path = path + "datasets/coco/packed/"
+	os.makedirs(packed_path, exist_ok=True)
+
+	if from_lmdb:
+		from maskrcnn_modanet.photodata import photo_data
+		photos = photo_data(path + 'datasets/paperdoll/data/chictopia/photos.lmdb')
+		def read_image(img):
+			data = photos.read(img['id'])
+			if data is None:
+				raise ValueError('Photo {} is not in the photos database'.format(img['id']))
+			return data
+	else:
+		def read_image(img):
+			with open(img_path + img['file_name'], 'rb') as f:
+				return f.read()
+
+	for set_name in sets_names:
+		print('Packing ' + set_name + ' set in ' + packed_path)
+		records = pack_set(ann_path + 'instances_' + set_name + '.json', packed_path, set_name, read_image, shard_size)
+		print('%d records written' % records)
+
+
+if __name__ == '__main__':
+	main()
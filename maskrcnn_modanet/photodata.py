@@ -0,0 +1,84 @@
+import io
+import os
+
+import lmdb
+import numpy as np
+from PIL import Image
+
+
+def decode_image_bgr(data):
+    ''' Decodes an encoded image (bytes or memoryview) the same way keras_retinanet.utils.image.read_image_bgr reads a file '''
+    with io.BytesIO(data) as f:
+        image = np.asarray(Image.open(f).convert('RGB'))
+    return image[:, :, ::-1].copy()
+
+
+class PhotoData(object):
+    ''' The paperdoll photos database. Keys are the photo ids, values the encoded photos '''
+    def __init__(self, path):
+        self.env = lmdb.open(
+            path, map_size=2**36, readonly=True, lock=False, readahead=True
+        )
+
+    def __iter__(self):
+        with self.env.begin() as t:
+            with t.cursor() as c:
+                for key, value in c:
+                    yield key, value
+
+    def __getitem__(self, index):
+        key = str(index).encode('ascii')
+        with self.env.begin() as t:
+            data = t.get(key)
+        if not data:
+            return None
+        with io.BytesIO(data) as f:
+            image = Image.open(f)
+            image.load()
+            return image
+
+    def __len__(self):
+        return self.env.stat()['entries']
+
+    def walk(self, indexes, buffers=False):
+        ''' Yields (index, data) for the indexes given, visiting them in key order with a single cursor.
+            Indexes that are not in the database are skipped.
+            With buffers=True data is a memoryview into the database, only valid until the next item is requested '''
+        keys = sorted(str(index).encode('ascii') for index in indexes)
+        with self.env.begin(buffers=buffers) as t:
+            with t.cursor() as c:
+                for key in keys:
+                    if c.set_key(key):
+                        yield int(key), c.value()
+
+    def read_image_bgr(self, index):
+        ''' Same as keras_retinanet.utils.image.read_image_bgr, but reading the photo from the database '''
+        key = str(index).encode('ascii')
+        with self.env.begin() as t:
+            data = t.get(key)
+        if not data:
+            raise ValueError('Photo {} is not in the photos database'.format(index))
+        return decode_image_bgr(data)
+
+    def read(self, index):
+        ''' Returns the encoded photo as it is stored, None if not in the database '''
+        with self.env.begin() as t:
+            return t.get(str(index).encode('ascii'))
+
+    def close(self):
+        self.env.close()
+
+
+# one read only environment for each process, opened the first time it is needed
+_photo_data = {}
+
+def photo_data(path):
+    ''' Returns the PhotoData for path opened by this process.
+        Environments inherited from a parent process (like keras multiprocessing workers) are closed and opened again '''
+    pid, data = _photo_data.get(path, (None, None))
+    if pid != os.getpid():
+        if data is not None:
+            data.close()
+        data = PhotoData(path)
+        _photo_data[path] = (os.getpid(), data)
+    return data
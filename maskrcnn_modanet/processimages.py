@@ -8,8 +8,26 @@ path = savedvars['datapath']
 img_path = path + "datasets/coco/images/"
 ann_path = path + "datasets/coco/annotations/"
 snp_path = path + "results/snapshots"
+lmdb_path = path + "datasets/paperdoll/data/chictopia/photos.lmdb"
 
 
+def default_model_path():
+	''' The last snapshot written by the training, or the one with the highest epoch for older snapshot folders without an index '''
+	from maskrcnn_modanet.train.snapshots import latest_snapshot
+
+	model_path = latest_snapshot(snp_path)
+	if not model_path:
+		# get all models names in the results folder
+		modelnames = [f for f in os.listdir(snp_path) if os.path.isfile(os.path.join(snp_path, f))]
+		import re
+
+		def extract_number(f):
+		    s = re.findall("\d+$",f)
+		    return (int(s[0]) if s else -1,f)
+		# get the model name with the highest epoch
+		model_path = os.path.join(snp_path, max(modelnames,key=extract_number))
+	return model_path
+
 def get_session():
 	import tensorflow as tf
 
@@ -77,16 +95,18 @@ def draw_mask_only(image, box, mask, label=None, color=None, binarize_threshold=
 	indices = np.where(mask != color)
 	image[indices[0], indices[1], :] = 0 * image[indices[0], indices[1], :]
 
-def main(proc_img_path=None, proc_img_url=None, all_set=True, save_path=None, model_path=None, segments=False, annotations=False, threshold_score=0.5, limit=None):
+def main(proc_img_path=None, proc_img_url=None, all_set=True, save_path=None, model_path=None, segments=False, annotations=False, threshold_score=0.5, limit=None, from_lmdb=False, resolution=None, profile_steps=None):
 	# import keras
 	import keras
 
 	# import keras_retinanet
-	from keras_maskrcnn import models
 	from keras_maskrcnn.utils.visualization import draw_mask
 	from keras_retinanet.utils.visualization import draw_box, draw_caption, draw_annotations
-	from keras_retinanet.utils.image import read_image_bgr, preprocess_image, resize_image
+	from keras_retinanet.utils.image import read_image_bgr, preprocess_image
 	from keras_retinanet.utils.colors import label_color
+	from maskrcnn_modanet.photodata import photo_data
+	from maskrcnn_modanet.resolution import ResolutionPolicy
+	from maskrcnn_modanet.train.snapshots import load_snapshot
 
 	# import miscellaneous modules
 	import matplotlib.pyplot as plt
@@ -103,23 +123,28 @@ def main(proc_img_path=None, proc_img_url=None, all_set=True, save_path=None, mo
 	# set the modified tf session as backend in keras
 	keras.backend.tensorflow_backend.set_session(get_session())
 
+	# the same resolution the model was trained with
+	if resolution is None:
+		resolution = ResolutionPolicy()
+	processing_time = 0.
+	processed = 0
+
 	# adjust this to point to your trained model
 	if not model_path:
-		# get all models names in the results folder
-		modelnames = [f for f in os.listdir(snp_path) if os.path.isfile(os.path.join(snp_path, f))]
-		import re
-
-		def extract_number(f):
-		    s = re.findall("\d+$",f)
-		    return (int(s[0]) if s else -1,f)
-		# get the model name with the highest epoch
-		print(max(modelnames,key=extract_number))
-		model_path = os.path.join(snp_path, max(modelnames,key=extract_number))
+		model_path = default_model_path()
+	print(model_path)
 
-	# load retinanet model
-	model = models.load_model(model_path, backbone_name='resnet50')
+	# load retinanet model, or build it for weights only snapshots
+	model = load_snapshot(model_path, backbone_name='resnet50')
 	#print(model.summary())
 
+	profiler = None
+	if profile_steps:
+		# steps are the images processed, from 1
+		from maskrcnn_modanet.profiling import OpProfiler, parse_steps
+		profiler = OpProfiler(parse_steps(profile_steps), path + 'results/logs/profile/', 'processimage')
+		model._make_predict_function()
+
 	# load label to names mapping for visualization purposes
 	labels_to_names = {0: 'bag', 1: 'belt', 2: 'boots', 3: 'footwear', 4: 'outer', 5: 'dress', 6: 'sunglasses', 7: 'pants', 8: 'top', 9: 'shorts', 10: 'skirt', 11: 'headwear', 12: 'scarf/tie'}
 
@@ -167,7 +192,10 @@ def main(proc_img_path=None, proc_img_url=None, all_set=True, save_path=None, mo
 			if limit and i >= limit:
 				break
 
-			if all_set:
+			if all_set and from_lmdb:
+				# the image id is the photo id in the paperdoll database
+				image = photo_data(lmdb_path).read_image_bgr(img['id'])
+			elif all_set:
 				image = read_image_bgr(img['file_name'])
 			elif proc_img_path:
 				image = read_image_bgr(img['file_name'])
@@ -198,11 +226,17 @@ def main(proc_img_path=None, proc_img_url=None, all_set=True, save_path=None, mo
 
 			# preprocess image for network
 			image = preprocess_image(image)
-			image, scale = resize_image(image)
+			image, scale = resolution.resize_image(image)
 
 			# process image
+			if profiler:
+				profiler.before(processed + 1, model.predict_function)
 			start = time.time()
 			outputs = model.predict_on_batch(np.expand_dims(image, axis=0))
+			processing_time += time.time() - start
+			processed += 1
+			if profiler:
+				profiler.after(processed, model.predict_function)
 			print("processing time: ", time.time() - start, "\t(Ctrl+c and close image to exit)")
 
 			boxes  = outputs[-4][0]
@@ -293,14 +327,20 @@ def main(proc_img_path=None, proc_img_url=None, all_set=True, save_path=None, mo
 	except KeyboardInterrupt:
 		pass
 
+	if processed > 1:
+		print('{} images processed at {}, {:.1f} ms per image, {:.2f} images/s'.format(
+			processed, resolution, 1000. * processing_time / processed, processed / processing_time))
+
 
-def apply_mask(model, image, threshold_score=0.5):
-	''' Process image numpy matrix using model and return the annotations '''
+def apply_mask(model, image, threshold_score=0.5, resolution=None):
+	''' Process image numpy matrix using model and return the annotations.
+		resolution is the ResolutionPolicy the model was trained with, the default one if None '''
 
 
 
-	from keras_retinanet.utils.image import preprocess_image, resize_image
+	from keras_retinanet.utils.image import preprocess_image
 	from keras_retinanet.utils.colors import label_color
+	from maskrcnn_modanet.resolution import ResolutionPolicy
 
 	# import miscellaneous modules
 	import numpy as np
@@ -319,7 +359,7 @@ def apply_mask(model, image, threshold_score=0.5):
 
 	# preprocess image for network
 	image = preprocess_image(image)
-	image, scale = resize_image(image)
+	image, scale = (resolution or ResolutionPolicy()).resize_image(image)
 
 	# process image
 	start = time.time()
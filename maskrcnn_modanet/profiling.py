@@ -0,0 +1,101 @@
+''' Op level profiling of the session runs of a keras model, for training and inference.
+	The runs of a window of steps are traced with full RunOptions, each trace is saved as a Chrome trace (open it in chrome://tracing)
+	and the time of every op over the window is summed up in a text summary of the top ops. Works on CPU only machines too '''
+import os
+
+
+def parse_steps(steps):
+	''' The window of steps "first,last" (1-based, both included) or "step", as (first, last). None if steps is None '''
+	if steps is None:
+		return None
+	values = [int(value) for value in str(steps).split(',')]
+	if len(values) not in (1, 2) or values[0] < 1 or values[-1] < values[0]:
+		raise ValueError('Expected the steps to profile as first,last or as a single step, got: {}'.format(steps))
+	return values[0], values[-1]
+
+
+def op_type(node):
+	''' The op type of a node in the step stats, from its timeline label "name = Type(inputs)" '''
+	if ' = ' in node.timeline_label:
+		return node.timeline_label.split(' = ', 1)[1].split('(', 1)[0]
+	return node.node_name
+
+
+class OpProfiler(object):
+	''' Traces the runs of keras functions (model.train_function, model.predict_function) of the steps in window (see parse_steps),
+		saving name_step_<step>.json Chrome traces and name_top_ops.txt in output_dir '''
+	def __init__(self, window, output_dir, name):
+		self.first, self.last = window
+		self.output_dir = output_dir
+		self.name       = name
+		self.ops        = {}
+		self.steps      = 0
+		self.metadata   = None
+
+	def trace(self, function, options, metadata):
+		# the options are part of the callable keras makes for the function, so it is made again
+		function.run_options  = options
+		function.run_metadata = metadata
+		for key, value in (('options', options), ('run_metadata', metadata)):
+			if value is None:
+				function.session_kwargs.pop(key, None)
+			else:
+				function.session_kwargs[key] = value
+		function._callable_fn = None
+
+	def before(self, step, function):
+		''' To call before the run of step '''
+		import tensorflow as tf
+
+		if self.first <= step <= self.last:
+			self.metadata = tf.RunMetadata()
+			self.trace(function, tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), self.metadata)
+
+	def after(self, step, function):
+		''' To call after the run of step '''
+		from tensorflow.python.client import timeline
+
+		if self.metadata is None:
+			return
+		self.trace(function, None, None)
+
+		os.makedirs(self.output_dir, exist_ok=True)
+		with open(os.path.join(self.output_dir, '{}_step_{}.json'.format(self.name, step)), 'w') as f:
+			f.write(timeline.Timeline(self.metadata.step_stats).generate_chrome_trace_format())
+
+		for device in self.metadata.step_stats.dev_stats:
+			# on gpus the kernels are also listed by stream, they are already in stream:all
+			if '/stream:' in device.device and not device.device.endswith('/stream:all'):
+				continue
+			for node in device.node_stats:
+				if node.node_name == '_SOURCE':
+					continue
+				key = (node.node_name, op_type(node), device.device.split('/')[-1])
+				micros, calls = self.ops.get(key, (0, 0))
+				self.ops[key] = (micros + node.all_end_rel_micros, calls + 1)
+		self.steps   += 1
+		self.metadata = None
+
+		if step == self.last:
+			summary = self.summary()
+			print(summary)
+			with open(os.path.join(self.output_dir, '{}_top_ops.txt'.format(self.name)), 'w') as f:
+				f.write(summary + '\n')
+
+	def summary(self, top=25):
+		''' The top ops by time over the traced steps, by op and by op type '''
+		total = float(sum(micros for micros, _ in self.ops.values())) or 1.
+
+		types = {}
+		for (_, kind, _), (micros, _) in self.ops.items():
+			types[kind] = types.get(kind, 0) + micros
+
+		lines = ['Top ops of {} steps ({}), {:.1f} ms of ops per step'.format(self.steps, self.name, total / 1000. / max(self.steps, 1)), '',
+			'{:>10} {:>7}  {}'.format('ms/step', '%', 'op type')]
+		for kind, micros in sorted(types.items(), key=lambda item: -item[1])[:top]:
+			lines.append('{:>10.2f} {:>6.1f}%  {}'.format(micros / 1000. / max(self.steps, 1), 100. * micros / total, kind))
+
+		lines += ['', '{:>10} {:>7}  {}'.format('ms/step', '%', 'op (type, device)')]
+		for (name, kind, device), (micros, _) in sorted(self.ops.items(), key=lambda item: -item[1][0])[:top]:
+			lines.append('{:>10.2f} {:>6.1f}%  {} ({}, {})'.format(micros / 1000. / max(self.steps, 1), 100. * micros / total, name, kind, device))
+		return '\n'.join(lines)
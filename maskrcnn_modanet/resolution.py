@@ -0,0 +1,49 @@
+''' The size images are resized to before going through the network.
+	Training, evaluation and inference all use the same policy, so a model always sees images at the size it was trained on '''
+
+default_min_side = 800
+default_max_side = 1333
+
+
+class ResolutionPolicy(object):
+	''' Images are scaled so that their smaller side is min_side, unless their larger side would exceed max_side.
+		Without upscale images smaller than that are kept at their native resolution '''
+	def __init__(self, min_side=default_min_side, max_side=default_max_side, upscale=True):
+		self.min_side = min_side
+		self.max_side = max_side
+		self.upscale  = upscale
+
+	def __repr__(self):
+		return 'ResolutionPolicy(min_side={}, max_side={}, upscale={})'.format(self.min_side, self.max_side, self.upscale)
+
+	def scale(self, height, width):
+		scale = self.min_side / min(height, width)
+		if max(height, width) * scale > self.max_side:
+			scale = self.max_side / max(height, width)
+		if not self.upscale:
+			scale = min(scale, 1.)
+		return scale
+
+	def resize_image(self, image):
+		''' Same as keras_retinanet.utils.image.resize_image, following the policy. Returns the image and its scale '''
+		import cv2
+
+		scale = self.scale(image.shape[0], image.shape[1])
+		if scale == 1.:
+			return image, scale
+		return cv2.resize(image, None, fx=scale, fy=scale), scale
+
+
+def resolution_policy(config=None, min_side=None, max_side=None, upscale=None):
+	''' The policy of the [resolution] section of config (a configparser with min_side, max_side and upscale keys, all optional).
+		Arguments that are not None take precedence over config '''
+	section = config['resolution'] if config and 'resolution' in config else {}
+
+	if min_side is None:
+		min_side = int(section.get('min_side', default_min_side))
+	if max_side is None:
+		max_side = int(section.get('max_side', default_max_side))
+	if upscale is None:
+		upscale = str(section.get('upscale', 'true')).lower() in ('1', 'true', 'yes', 'on')
+
+	return ResolutionPolicy(min_side, max_side, upscale)
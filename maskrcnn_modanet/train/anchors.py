@@ -0,0 +1,122 @@
+"""
+Anchors and their regression / classification targets, computed once per batch.
+
+anchor_targets_bbox gives the same targets of keras_retinanet.utils.anchors.anchor_targets_bbox,
+but computes the overlaps of the anchors with the boxes of the whole batch in a single call, and
+the regression targets of the positive anchors of all the images at once. The regression targets of
+the other anchors are left at zero (keras_retinanet computes them for every anchor, but its smooth L1
+loss only uses the positive ones). AnchorCache keeps the anchors of the last input shapes, that are
+the same for every batch of a shape.
+"""
+import collections
+
+import numpy as np
+import keras
+
+from keras_retinanet.utils.anchors import anchors_for_shape, bbox_transform
+from keras_retinanet.utils.compute_overlap import compute_overlap
+
+
+class AnchorCache(object):
+    """ The anchors of the last max_shapes input shapes, for anchor_params and shapes_callback (see anchors_for_shape).
+    """
+    def __init__(self, anchor_params=None, shapes_callback=None, max_shapes=32):
+        self.anchor_params   = anchor_params
+        self.shapes_callback = shapes_callback
+        self.max_shapes      = max_shapes
+        self.anchors         = collections.OrderedDict()
+
+    def __call__(self, image_shape):
+        # every operation on the dict is atomic, so the threads of a tf.data pipeline can share the cache
+        key     = tuple(image_shape[:2])
+        anchors = self.anchors.get(key)
+        if anchors is None:
+            anchors = anchors_for_shape(image_shape, anchor_params=self.anchor_params, shapes_callback=self.shapes_callback)
+            anchors.setflags(write=False)
+            self.anchors[key] = anchors
+            while len(self.anchors) > self.max_shapes:
+                try:
+                    self.anchors.popitem(last=False)
+                except KeyError:
+                    break
+        else:
+            try:
+                self.anchors.move_to_end(key)
+            except KeyError:
+                # evicted by another thread meanwhile
+                pass
+        return anchors
+
+
+def anchor_targets_bbox(
+    anchors,
+    image_group,
+    annotations_group,
+    num_classes,
+    negative_overlap=0.4,
+    positive_overlap=0.5
+):
+    """ Generate anchor targets for bbox detection, for the whole batch at once.
+
+    Args
+        anchors           : np.array of annotations of shape (N, 4) for (x1, y1, x2, y2).
+        image_group       : List of BGR images.
+        annotations_group : List of annotations (np.array of shape (N, 5) for (x1, y1, x2, y2, label)).
+        num_classes       : Number of classes to predict.
+        negative_overlap  : IoU overlap for negative anchors (all anchors with overlap < negative_overlap are negative).
+        positive_overlap  : IoU overlap or positive anchors (all anchors with overlap > positive_overlap are positive).
+
+    Returns
+        regression_batch : batch that contains bounding-box regression targets for an image & anchor states (np.array of shape (batch_size, N, 4 + 1)).
+        labels_batch     : batch that contains labels & anchor states (np.array of shape (batch_size, N, num_classes + 1)).
+    """
+    assert(len(image_group) == len(annotations_group)), "The length of the images and annotations need to be equal."
+    assert(len(annotations_group) > 0), "No data received to compute anchor targets for."
+
+    batch_size = len(image_group)
+
+    regression_batch = np.zeros((batch_size, anchors.shape[0], 4 + 1), dtype=keras.backend.floatx())
+    labels_batch     = np.zeros((batch_size, anchors.shape[0], num_classes + 1), dtype=keras.backend.floatx())
+
+    # the overlaps with the boxes of all the images, each image then looks at its own columns
+    counts   = [annotations['bboxes'].shape[0] for annotations in annotations_group]
+    offsets  = np.cumsum([0] + counts)
+    if offsets[-1]:
+        boxes    = np.concatenate([annotations['bboxes'] for annotations in annotations_group], axis=0).astype(np.float64)
+        overlaps = compute_overlap(anchors.astype(np.float64), boxes)
+
+        argmax_overlaps_inds = np.zeros((batch_size, anchors.shape[0]), dtype=np.int64)
+        for index in np.flatnonzero(counts).tolist():
+            image_overlaps = overlaps[:, offsets[index]:offsets[index + 1]]
+            argmax_overlaps_inds[index] = offsets[index] + np.argmax(image_overlaps, axis=1)
+        max_overlaps = np.take_along_axis(overlaps, argmax_overlaps_inds.T, axis=1).T
+
+        # assign "dont care" labels, only to the images with boxes
+        positive = (max_overlaps >= positive_overlap)
+        ignore   = (max_overlaps > negative_overlap) & ~positive
+        positive[np.asarray(counts) == 0] = False
+        ignore[np.asarray(counts) == 0]   = False
+
+        labels_batch[ignore, -1]       = -1
+        labels_batch[positive, -1]     = 1
+        regression_batch[ignore, -1]   = -1
+        regression_batch[positive, -1] = 1
+
+        # compute target class labels
+        labels = np.concatenate([annotations['labels'] for annotations in annotations_group]).astype(int)
+        batch_indices, anchor_indices = np.nonzero(positive)
+        positive_boxes = argmax_overlaps_inds[batch_indices, anchor_indices]
+        labels_batch[batch_indices, anchor_indices, labels[positive_boxes]] = 1
+
+        # regression targets of the positive anchors only, the regression loss ignores all the other ones
+        regression_batch[batch_indices, anchor_indices, :-1] = bbox_transform(anchors[anchor_indices], boxes[positive_boxes])
+
+    # ignore annotations outside of image
+    anchors_centers = np.vstack([(anchors[:, 0] + anchors[:, 2]) / 2, (anchors[:, 1] + anchors[:, 3]) / 2]).T
+    shapes  = np.array([image.shape[:2] for image in image_group])
+    outside = (anchors_centers[None, :, 0] >= shapes[:, None, 1]) | (anchors_centers[None, :, 1] >= shapes[:, None, 0])
+
+    labels_batch[outside, -1]     = -1
+    regression_batch[outside, -1] = -1
+
+    return regression_batch, labels_batch
@@ -0,0 +1,177 @@
+"""
+Augmentation of a whole group of images at once.
+
+The random affine transforms of the group are drawn together as (batch, 3, 3) matrices, with the
+parameters of the [augmentation] section of the config (see augmentation_policy). Then:
+
+    identity transforms are skipped,
+    flips only reverse the images and the mask crops, without warping them,
+    the other images, and their mask crops, are warped with cv2.warpAffine,
+    the boxes of the whole group are transformed at once.
+
+Transforms are about the center of the image in pixel coordinates (pixel i at i), so that a flip
+mirrors the pixels exactly; boxes, whose coordinates are at the pixel edges, are transformed accordingly.
+"""
+import numpy as np
+
+from keras_retinanet.utils.image import apply_transform
+
+from maskrcnn_modanet.train.masks import warp_masks, flip_masks
+
+
+def translations(x, y):
+    matrices = np.tile(np.identity(3), (len(x), 1, 1))
+    matrices[:, 0, 2] = x
+    matrices[:, 1, 2] = y
+    return matrices
+
+
+class BatchAugmentation(object):
+    """ Random rotation (radians), translation (fraction of the image size, x and y), shear (radians), scaling (x and y) and flips of the images of a group.
+        The ranges are the ones of keras_retinanet.utils.transform.random_transform_generator.
+    """
+    def __init__(
+        self,
+        min_rotation=0.,
+        max_rotation=0.,
+        min_translation=(0., 0.),
+        max_translation=(0., 0.),
+        min_shear=0.,
+        max_shear=0.,
+        min_scaling=(1., 1.),
+        max_scaling=(1., 1.),
+        flip_x_chance=0.,
+        flip_y_chance=0.,
+        prng=np.random
+    ):
+        self.min_rotation    = min_rotation
+        self.max_rotation    = max_rotation
+        self.min_translation = np.asarray(min_translation, dtype=float)
+        self.max_translation = np.asarray(max_translation, dtype=float)
+        self.min_shear       = min_shear
+        self.max_shear       = max_shear
+        self.min_scaling     = np.asarray(min_scaling, dtype=float)
+        self.max_scaling     = np.asarray(max_scaling, dtype=float)
+        self.flip_x_chance   = flip_x_chance
+        self.flip_y_chance   = flip_y_chance
+        self.prng            = prng
+
+    def __repr__(self):
+        return 'BatchAugmentation(rotation={}..{}, translation={}..{}, shear={}..{}, scaling={}..{}, flip_x_chance={}, flip_y_chance={})'.format(
+            self.min_rotation, self.max_rotation, self.min_translation.tolist(), self.max_translation.tolist(), self.min_shear, self.max_shear,
+            self.min_scaling.tolist(), self.max_scaling.tolist(), self.flip_x_chance, self.flip_y_chance)
+
+    def random_transforms(self, sizes):
+        """ Random transforms (n, 3, 3) of images of sizes (n, 2) of height, width, in pixel coordinates. """
+        n = len(sizes)
+        height, width = sizes[:, 0].astype(float), sizes[:, 1].astype(float)
+
+        rotation  = self.prng.uniform(self.min_rotation, self.max_rotation, n)
+        shift     = self.prng.uniform(self.min_translation, self.max_translation, (n, 2)) * np.stack([width, height], axis=1)
+        shear     = self.prng.uniform(self.min_shear, self.max_shear, n)
+        scaling   = self.prng.uniform(self.min_scaling, self.max_scaling, (n, 2))
+        flips     = self.prng.uniform(0, 1, (n, 2)) < [self.flip_x_chance, self.flip_y_chance]
+        scaling  *= 1 - 2 * flips
+
+        # rotation . translation . shear . scaling and flip, like random_transform_generator
+        matrices = np.tile(np.identity(3), (n, 1, 1))
+        matrices[:, 0, 0] = np.cos(rotation)
+        matrices[:, 0, 1] = -np.sin(rotation)
+        matrices[:, 1, 0] = np.sin(rotation)
+        matrices[:, 1, 1] = np.cos(rotation)
+        matrices = np.matmul(matrices, translations(shift[:, 0], shift[:, 1]))
+
+        shears = np.tile(np.identity(3), (n, 1, 1))
+        shears[:, 0, 1] = -np.sin(shear)
+        shears[:, 1, 1] = np.cos(shear)
+        matrices = np.matmul(matrices, shears)
+
+        matrices[:, :, 0] *= scaling[:, 0, None]
+        matrices[:, :, 1] *= scaling[:, 1, None]
+
+        # about the center of the image
+        center_x, center_y = (width - 1) / 2, (height - 1) / 2
+        return np.matmul(np.matmul(translations(center_x, center_y), matrices), translations(-center_x, -center_y))
+
+    def __call__(self, image_group, annotations_group, transform_parameters):
+        """ Augments the images of the group, with their annotations (bboxes, and masks crops at mask_windows). Returns the new group. """
+        sizes      = np.array([image.shape[:2] for image in image_group]).reshape((-1, 2))
+        transforms = self.random_transforms(sizes)
+
+        identity  = np.all(np.abs(transforms - np.identity(3)) < 1e-9, axis=(1, 2))
+        flip_x    = transforms[:, 0, 0] < 0
+        flip_y    = transforms[:, 1, 1] < 0
+        flips     = np.tile(np.identity(3), (len(sizes), 1, 1))
+        flips[:, 0, 0] = 1 - 2 * flip_x
+        flips[:, 0, 2] = flip_x * (sizes[:, 1] - 1)
+        flips[:, 1, 1] = 1 - 2 * flip_y
+        flips[:, 1, 2] = flip_y * (sizes[:, 0] - 1)
+        flip_only = ~identity & np.all(np.abs(transforms - flips) < 1e-9, axis=(1, 2))
+        warp      = ~identity & ~flip_only
+
+        image_group       = list(image_group)
+        annotations_group = [dict(annotations) for annotations in annotations_group]
+
+        for index in np.flatnonzero(flip_only).tolist():
+            height, width = sizes[index]
+            annotations = annotations_group[index]
+            image_group[index] = np.ascontiguousarray(image_group[index][::-1 if flip_y[index] else 1, ::-1 if flip_x[index] else 1])
+            annotations['masks'], annotations['mask_windows'] = flip_masks(
+                annotations['masks'], annotations['mask_windows'], flip_x[index], flip_y[index], height, width)
+
+        for index in np.flatnonzero(warp).tolist():
+            height, width = sizes[index]
+            annotations = annotations_group[index]
+            image_group[index] = apply_transform(transforms[index], image_group[index], transform_parameters)
+            annotations['masks'], annotations['mask_windows'] = warp_masks(
+                annotations['masks'], annotations['mask_windows'], transforms[index], height, width)
+
+        # the boxes of the whole group at once, in pixel edge coordinates
+        counts = [len(annotations['bboxes']) if not identity[index] else 0 for index, annotations in enumerate(annotations_group)]
+        if sum(counts):
+            changed = np.flatnonzero(counts).tolist()
+            boxes   = np.concatenate([annotations_group[index]['bboxes'] for index in changed]).astype(float)
+            edges   = np.matmul(np.matmul(translations([.5], [.5]), transforms[np.repeat(changed, [counts[index] for index in changed])]), translations([-.5], [-.5]))
+            x1, y1, x2, y2 = boxes.T
+            corners = np.matmul(edges, np.stack([np.stack([x1, x2, x1, x2], axis=1), np.stack([y1, y2, y2, y1], axis=1), np.ones((len(boxes), 4))], axis=1))
+            boxes   = np.concatenate([corners[:, :2].min(axis=2), corners[:, :2].max(axis=2)], axis=1)
+            offsets = np.cumsum([0] + [counts[index] for index in changed])
+            for position, index in enumerate(changed):
+                annotations_group[index]['bboxes'] = boxes[offsets[position]:offsets[position + 1]]
+
+        return image_group, annotations_group
+
+
+def augmentation_policy(config=None):
+    """ The BatchAugmentation of the [augmentation] section of config (a configparser), by default only flipping half of the images horizontally.
+
+        [augmentation]
+        min_rotation    = -0.1
+        max_rotation    = 0.1
+        min_translation = -0.1 -0.1
+        max_translation = 0.1 0.1
+        min_shear       = -0.1
+        max_shear       = 0.1
+        min_scaling     = 0.9 0.9
+        max_scaling     = 1.1 1.1
+        flip_x_chance   = 0.5
+        flip_y_chance   = 0
+    """
+    section = config['augmentation'] if config and 'augmentation' in config else {}
+
+    def pair(name, default):
+        values = [float(value) for value in str(section.get(name, default)).split()]
+        return (values[0], values[-1])
+
+    return BatchAugmentation(
+        min_rotation=float(section.get('min_rotation', 0)),
+        max_rotation=float(section.get('max_rotation', 0)),
+        min_translation=pair('min_translation', 0),
+        max_translation=pair('max_translation', 0),
+        min_shear=float(section.get('min_shear', 0)),
+        max_shear=float(section.get('max_shear', 0)),
+        min_scaling=pair('min_scaling', 1),
+        max_scaling=pair('max_scaling', 1),
+        flip_x_chance=float(section.get('flip_x_chance', 0.5)),
+        flip_y_chance=float(section.get('flip_y_chance', 0)),
+    )
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+Compares the CPU time per batch of the anchor generation and target assignment of the keras_retinanet
+generator (anchors generated again for every batch, targets computed image by image) with the cached
+anchors and batch targets of CocoGenerator, checking that both give the same targets (the regression
+targets only for the positive anchors, the only ones the loss uses).
+
+run with
+python -m maskrcnn_modanet.train.benchmark_targets --batch-size 4 --batches 50
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+
+def main(args=None):
+    with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json') as f:
+        savedvars = json.load(f)
+
+    parser = argparse.ArgumentParser(prog='benchmark_targets', description='Time the anchors and targets computation of the training generator.')
+    parser.add_argument('--coco-path',      help='Path to dataset directory.', default=savedvars['datapath'] + 'datasets/coco/')
+    parser.add_argument('--set',            help='Set whose images are used.', default='val')
+    parser.add_argument('--batch-size',     help='Size of the batches.', default=4, type=int)
+    parser.add_argument('--batches',        help='Number of batches timed.', default=50, type=int)
+    parser.add_argument('--aspect-buckets', help='Form the batches in this many aspect ratio buckets, like train coco --aspect-buckets.', type=int, default=None)
+    parser.add_argument('--config',         help='Path to the configuration .ini file used for training.')
+    args = parser.parse_args(args)
+
+    from keras_retinanet.utils.anchors import anchor_targets_bbox as image_anchor_targets_bbox, anchors_for_shape
+    from keras_retinanet.utils.config import read_config_file, parse_anchor_parameters
+    from maskrcnn_modanet.train.coco import CocoGenerator
+
+    config = read_config_file(args.config) if args.config else None
+    generator = CocoGenerator(args.coco_path, args.set, batch_size=args.batch_size, aspect_buckets=args.aspect_buckets, config=config)
+
+    # preprocessed groups, so that only the targets are timed
+    groups = []
+    for group in generator.groups[:args.batches]:
+        image_group, annotations_group = generator.filter_annotations(generator.load_image_group(group), generator.load_annotations_group(group), group)
+        groups.append(generator.preprocess_group(image_group, annotations_group))
+
+    def base_targets(image_group, annotations_group):
+        anchor_params = None
+        if config and 'anchor_parameters' in config:
+            anchor_params = parse_anchor_parameters(config)
+        anchors = anchors_for_shape(generator.batch_shape(image_group), anchor_params=anchor_params, shapes_callback=generator.compute_shapes)
+        return image_anchor_targets_bbox(anchors, image_group, annotations_group, generator.num_classes())
+
+    def cached_targets(image_group, annotations_group):
+        anchors = generator.generate_anchors(generator.batch_shape(image_group))
+        return generator.compute_anchor_targets(anchors, image_group, annotations_group, generator.num_classes())
+
+    for name, targets in (('base', base_targets), ('cached', cached_targets)):
+        start = time.process_time()
+        for image_group, annotations_group in groups:
+            targets(image_group, annotations_group)
+        print('{:>6}: {:.1f} ms of cpu per batch'.format(name, 1000. * (time.process_time() - start) / max(len(groups), 1)))
+
+    for image_group, annotations_group in groups:
+        (base_regression, base_labels), (regression, labels) = base_targets(image_group, annotations_group), cached_targets(image_group, annotations_group)
+        assert np.array_equal(base_labels, labels), 'the labels targets differ from the base ones'
+        assert np.array_equal(base_regression[..., -1], regression[..., -1]), 'the anchor states differ from the base ones'
+        # only the regression targets of the positive anchors are used, and computed
+        positive = base_regression[..., -1] == 1
+        assert np.allclose(base_regression[positive], regression[positive]), 'the regression targets differ from the base ones'
+    print('{} batches of {} images, {} input shapes: same targets'.format(len(groups), args.batch_size, len(set(generator.batch_shape(g[0]) for g in groups))))
+
+
+if __name__ == '__main__':
+    main()
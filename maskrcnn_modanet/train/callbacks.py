@@ -0,0 +1,182 @@
+import os
+import time
+
+import keras
+
+
+class CacheStats(keras.callbacks.Callback):
+    """ Reports the hit rate and the traffic of a MaskCache or ImageCache at the end of every epoch.
+
+    The values are also added to the epoch logs as name_hit_rate, name_mb_read.., so the TensorBoard callback (when it comes after this one) writes them too.
+    """
+    def __init__(self, cache, name):
+        super(CacheStats, self).__init__()
+        self.cache = cache
+        self.name  = name
+
+    def on_epoch_end(self, epoch, logs=None):
+        # both caches start their stats with the same counters
+        from maskrcnn_modanet.train.image_cache import HITS, MISSES, BYTES_READ, BYTES_WRITTEN, EVICTIONS
+
+        with self.cache.stats.get_lock():
+            stats = list(self.cache.stats)
+            for i in range(len(stats)):
+                self.cache.stats[i] = 0
+
+        requests = stats[HITS] + stats[MISSES]
+        values = {
+            'hit_rate'   : stats[HITS] / float(requests) if requests else 0.,
+            'mb_read'    : stats[BYTES_READ] / 2.**20,
+            'mb_written' : stats[BYTES_WRITTEN] / 2.**20,
+        }
+        if len(stats) > EVICTIONS:
+            values['evictions'] = stats[EVICTIONS]
+
+        print('\n{}: {:.1%} hits of {} requests, {:.1f} MB read, {:.1f} MB written{}'.format(
+            self.name.replace('_', ' ').capitalize(), values['hit_rate'], requests, values['mb_read'], values['mb_written'],
+            ', {} evicted'.format(values['evictions']) if 'evictions' in values else ''))
+
+        if logs is not None:
+            for key, value in values.items():
+                logs[self.name + '_' + key] = value
+
+
+class Throughput(keras.callbacks.Callback):
+    """ Reports the images per second and the seconds per epoch of the training, also adding them to the epoch logs.
+    """
+    def __init__(self, batch_size):
+        super(Throughput, self).__init__()
+        self.batch_size = batch_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+        self.images      = 0
+
+    def on_batch_end(self, batch, logs=None):
+        self.images += (logs or {}).get('size', self.batch_size)
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.time() - self.epoch_start
+        print('\nThroughput: {:.2f} images/s, {:.1f} ms per image, {:.0f} s per epoch'.format(
+            self.images / seconds, 1000. * seconds / max(self.images, 1), seconds))
+
+        if logs is not None:
+            logs['images_per_second'] = self.images / seconds
+            logs['seconds_per_epoch'] = seconds
+
+
+class LoaderStats(keras.callbacks.Callback):
+    """ Reports the batches per second and the queue occupancy of a SharedMemoryLoader at the end of every epoch, also adding them to the epoch logs.
+    """
+    def __init__(self, loader):
+        super(LoaderStats, self).__init__()
+        self.loader = loader
+
+    def on_epoch_end(self, epoch, logs=None):
+        stats = self.loader.stats()
+        self.loader.reset_stats()
+        print('\nLoader: {:.2f} batches/s, {:.1f} of {} batches ready on average, waited for data {:.0%} of the time{}'.format(
+            stats['batches_per_second'], stats['queue_occupancy'], len(self.loader.slots), stats['wait_fraction'],
+            ', {} batches too large for the slots'.format(stats['pickled_batches']) if stats['pickled_batches'] else ''))
+
+        if logs is not None:
+            for key, value in stats.items():
+                logs['loader_' + key] = value
+
+
+class StepTimes(keras.callbacks.Callback):
+    """ Splits every training step in the time waiting for the generator, the time of the forward / backward pass and the time of the other callbacks.
+
+    StepTimes goes first in the callbacks and its end callback last, so that their batch begin / end calls enclose the ones of all the other callbacks:
+
+        end.on_batch_end ... data wait ... on_batch_begin ... callbacks ... end.on_batch_begin ... compute ... on_batch_end ... callbacks ... end.on_batch_end
+
+    At the end of every epoch the percentiles of the three times (in ms) are printed, added to the epoch logs as step_<time>_p<percentile>_ms
+    (so the TensorBoard callback writes them too) and appended to the json file at path.
+    """
+    times = ('data_wait', 'compute', 'callbacks')
+
+    def __init__(self, path, percentiles=(50, 90, 99)):
+        super(StepTimes, self).__init__()
+        self.path        = path
+        self.percentiles = percentiles
+        self.epochs      = []
+        self.end         = StepTimesEnd(self)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = {name: [] for name in self.times}
+        self.last  = None
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_begin = time.time()
+        # the first step of an epoch waits from the end of the epoch begin callbacks
+        if self.last is not None:
+            self.steps['data_wait'].append(self.batch_begin - self.last)
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch_end = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        import json
+        import numpy as np
+
+        summary = {'epoch': epoch, 'steps': len(self.steps['compute'])}
+        for name in self.times:
+            times = 1000. * np.array(self.steps[name] or [0.])
+            summary[name + '_mean_ms'] = float(times.mean())
+            for percentile, value in zip(self.percentiles, np.percentile(times, self.percentiles).tolist()):
+                summary['{}_p{}_ms'.format(name, percentile)] = value
+        total = sum(sum(self.steps[name]) for name in self.times)
+        summary['data_wait_fraction'] = sum(self.steps['data_wait']) / total if total else 0.
+
+        print('\nStep times (p{}): {}, waiting for data {:.0%} of the time'.format(
+            ' / p'.join(str(percentile) for percentile in self.percentiles),
+            ', '.join('{} {} ms'.format(name.replace('_', ' '), ' / '.join('{:.1f}'.format(summary['{}_p{}_ms'.format(name, percentile)]) for percentile in self.percentiles)) for name in self.times),
+            summary['data_wait_fraction']))
+
+        if logs is not None:
+            for key, value in summary.items():
+                if key not in ('epoch', 'steps'):
+                    logs['step_' + key] = value
+
+        # the whole file is written again, in place of the old one
+        self.epochs.append(summary)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.epochs, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class StepTimesEnd(keras.callbacks.Callback):
+    """ The last callback of StepTimes. """
+    def __init__(self, step_times):
+        super(StepTimesEnd, self).__init__()
+        self.step_times = step_times
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.step_times.last = time.time()
+
+    def on_batch_begin(self, batch, logs=None):
+        self.compute_begin = time.time()
+        self.callbacks     = self.compute_begin - self.step_times.batch_begin
+
+    def on_batch_end(self, batch, logs=None):
+        self.step_times.steps['compute'].append(self.step_times.batch_end - self.compute_begin)
+        self.step_times.last = time.time()
+        self.step_times.steps['callbacks'].append(self.callbacks + self.step_times.last - self.step_times.batch_end)
+
+
+class OpProfile(keras.callbacks.Callback):
+    """ Traces the ops of the training steps of the window of an OpProfiler (steps counted from the start of the training, 1-based).
+    """
+    def __init__(self, profiler):
+        super(OpProfile, self).__init__()
+        self.profiler = profiler
+        self.step     = 0
+
+    def on_batch_begin(self, batch, logs=None):
+        self.step += 1
+        self.model._make_train_function()
+        self.profiler.before(self.step, self.model.train_function)
+
+    def on_batch_end(self, batch, logs=None):
+        self.profiler.after(self.step, self.model.train_function)
@@ -14,14 +14,23 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import numpy as np
-import cv2
 import keras
 import os
+import random
 
 from pycocotools.coco import COCO
+from pycocotools import mask as mask_utils
 
 from keras_maskrcnn.preprocessing.generator import Generator
-from keras_retinanet.utils.image import read_image_bgr
+from keras_retinanet.utils.image import read_image_bgr, adjust_transform_for_image, apply_transform
+from keras_retinanet.utils.transform import transform_aabb
+from keras_retinanet.utils.config import parse_anchor_parameters
+
+from maskrcnn_modanet.photodata import photo_data, decode_image_bgr
+from maskrcnn_modanet.pack_dataset import PackedSet
+from maskrcnn_modanet.resolution import ResolutionPolicy
+from maskrcnn_modanet.train.anchors import AnchorCache, anchor_targets_bbox
+from maskrcnn_modanet.train.masks import mask_windows, rasterize_polygons, warp_masks, resize_masks, paste_masks
 
 
 class CocoGenerator(Generator):
@@ -29,16 +38,52 @@ class CocoGenerator(Generator):
             self,
             data_dir,
             set_name,
+            lmdb_path=None,
+            packed_path=None,
+            mask_cache=None,
+            image_cache=None,
+            aspect_buckets=None,
+            upscale=True,
+            augmentation=None,
             **kwargs):
-        self.data_dir  = data_dir
-        self.set_name  = set_name
-        self.coco      = COCO(os.path.join(data_dir, 'annotations', 'instances_' + set_name + '.json'))
-        self.image_ids = self.coco.getImgIds()
+        """ Initialize a COCO data generator.
+
+        Args
+            data_dir  : Path to where the COCO dataset is stored.
+            set_name  : Name of the set to parse.
+            lmdb_path : Path to the paperdoll photos.lmdb. If given, images are read by id from it instead of from data_dir/images.
+            packed_path : Path to the shards written by 'maskrcnn-modanet datasets pack'. If given, images and annotations are read from them.
+            mask_cache : MaskCache where the rasterized masks are kept between epochs, None to rasterize them every time.
+            image_cache : ImageCache where the decoded images are shared between the processes, None to decode them every time.
+            aspect_buckets : If given, batches are formed within this many aspect ratio buckets, and padded to the fixed shape of their bucket.
+            upscale : If False, images smaller than image_min_side / image_max_side keep their native resolution.
+            augmentation : BatchAugmentation applied to every group at once, before the preprocessing (and the transform_generator, if any).
+        """
+        self.data_dir       = data_dir
+        self.set_name       = set_name
+        self.lmdb_path      = lmdb_path
+        self.packed         = PackedSet(packed_path, set_name) if packed_path else None
+        self.mask_cache     = mask_cache
+        self.image_cache    = image_cache
+        self.aspect_buckets = aspect_buckets
+        self.bucket_shapes  = None
+        self.upscale        = upscale
+        self.augmentation   = augmentation
+        self.coco           = COCO(os.path.join(data_dir, 'annotations', 'instances_' + set_name + '.json'))
+        self.image_ids      = self.coco.getImgIds()
 
         self.load_classes()
+        self.load_annotations_store()
 
+        # targets of the whole batch at once, unless another function is given
+        kwargs.setdefault('compute_anchor_targets', anchor_targets_bbox)
         super(CocoGenerator, self).__init__(**kwargs)
 
+        anchor_params = None
+        if self.config and 'anchor_parameters' in self.config:
+            anchor_params = parse_anchor_parameters(self.config)
+        self.anchor_cache = AnchorCache(anchor_params, self.compute_shapes)
+
     def load_classes(self):
         # load class names (name -> label)
         categories = self.coco.loadCats(self.coco.getCatIds())
@@ -57,6 +102,52 @@ class CocoGenerator(Generator):
         for key, value in self.classes.items():
             self.labels[value] = key
 
+    def load_annotations_store(self):
+        """ Loads the annotations of all the images in flat arrays, so that every sample only takes a slice.
+
+        image_sizes        : (images, 2) array of height, width.
+        annotations_offset : the annotations of image i are at [annotations_offset[i]:annotations_offset[i + 1]].
+        annotations_bboxes : (annotations, 4) array of x1, y1, x2, y2, clipped to the image.
+        annotations_labels : (annotations,) array of labels.
+        annotations_ids    : (annotations,) array of the coco annotations ids.
+        annotations_segmentations : list of the polygons of every annotation.
+        Crowd annotations and the ones with basically no width / height are left out.
+        """
+        images = self.coco.loadImgs(self.image_ids)
+        self.image_sizes = np.array([[image['height'], image['width']] for image in images], dtype=np.int64).reshape((-1, 2))
+
+        if self.packed is not None:
+            # annotations are in the packed records
+            return
+
+        position    = {image_id: i for i, image_id in enumerate(self.image_ids)}
+        annotations = [a for a in self.coco.dataset.get('annotations', []) if not a.get('iscrowd', 0) and a['image_id'] in position]
+        for a in annotations:
+            if 'segmentation' not in a:
+                raise ValueError('Expected \'segmentation\' key in annotation, got: {}'.format(a))
+
+        image_index = np.array([position[a['image_id']] for a in annotations], dtype=np.int64)
+        bboxes      = np.array([a['bbox'] for a in annotations], dtype=float).reshape((-1, 4))
+        labels      = np.array([self.coco_label_to_label(a['category_id']) for a in annotations], dtype=float)
+        ids         = np.array([a['id'] for a in annotations], dtype=np.int64)
+
+        # some annotations have basically no width / height, skip them
+        keep = np.flatnonzero((bboxes[:, 2] >= 1) & (bboxes[:, 3] >= 1))
+        # sort by image, keeping the annotations order within an image
+        keep = keep[np.argsort(image_index[keep], kind='stable')]
+        image_index = image_index[keep]
+
+        # normalizing annotations that exit boundaries
+        bboxes = bboxes[keep]
+        bboxes[:, 2] = np.minimum(bboxes[:, 0] + bboxes[:, 2], self.image_sizes[image_index, 1])
+        bboxes[:, 3] = np.minimum(bboxes[:, 1] + bboxes[:, 3], self.image_sizes[image_index, 0])
+
+        self.annotations_offset        = np.searchsorted(image_index, np.arange(len(self.image_ids) + 1))
+        self.annotations_bboxes        = bboxes
+        self.annotations_labels        = labels[keep]
+        self.annotations_ids           = ids[keep]
+        self.annotations_segmentations = [annotations[i]['segmentation'] for i in keep.tolist()]
+
     def size(self):
         return len(self.image_ids)
 
@@ -79,55 +170,263 @@ class CocoGenerator(Generator):
         return self.coco_labels[label]
 
     def image_aspect_ratio(self, image_index):
-        image = self.coco.loadImgs(self.image_ids[image_index])[0]
-        return float(image['width']) / float(image['height'])
+        height, width = self.image_sizes[image_index]
+        return float(width) / float(height)
+
+    def image_aspect_ratios(self):
+        return self.image_sizes[:, 1] / self.image_sizes[:, 0].astype(float)
+
+    def resized_sizes(self):
+        """ (images, 2) array of the height, width of every image after resize_image.
+        """
+        sizes = self.image_sizes.astype(float)
+        scale = self.image_min_side / sizes.min(axis=1)
+        scale = np.where(sizes.max(axis=1) * scale > self.image_max_side, self.image_max_side / sizes.max(axis=1), scale)
+        if not self.upscale:
+            scale = np.minimum(scale, 1.)
+        return np.rint(sizes * scale[:, None]).astype(np.int64)
+
+    def resize_image(self, image):
+        return ResolutionPolicy(self.image_min_side, self.image_max_side, self.upscale).resize_image(image)
+
+    def group_images(self):
+        """ Same groups of the base generator, computing all the aspect ratios at once. With aspect_buckets, see group_buckets.
+        """
+        if self.aspect_buckets:
+            self.group_buckets()
+            return
+
+        order = np.arange(self.size())
+        if self.group_method == 'random':
+            random.shuffle(order)
+        elif self.group_method == 'ratio':
+            order = np.argsort(self.image_aspect_ratios(), kind='stable')
+        order = order.tolist()
+
+        # divide into groups, one group = one batch
+        self.groups = [[order[x % len(order)] for x in range(i, i + self.batch_size)] for i in range(0, len(order), self.batch_size)]
+
+    def group_buckets(self):
+        """ Splits the images in aspect_buckets buckets of about the same number of images by aspect ratio.
+        Every bucket gets the shape of its largest resized image, rounded up to a multiple of 32 so that it fits every pyramid level.
+        """
+        ratios = self.image_aspect_ratios()
+        edges  = np.unique(np.quantile(ratios, np.linspace(0, 1, self.aspect_buckets + 1)[1:-1]))
+        bucket = np.searchsorted(edges, ratios, side='right')
+
+        resized = self.resized_sizes()
+        self.buckets       = [np.flatnonzero(bucket == b) for b in range(len(edges) + 1)]
+        self.buckets       = [members for members in self.buckets if len(members)]
+        self.bucket_shapes = np.array([(resized[members].max(axis=0) + 31) // 32 * 32 for members in self.buckets]).reshape((-1, 2))
+        self.fill_bucket_groups()
+
+    def fill_bucket_groups(self):
+        # a group never mixes buckets, the last one of a bucket is completed with its first images
+        self.groups = []
+        for members in self.buckets:
+            members = members.tolist()
+            self.groups.extend([[members[x % len(members)] for x in range(i, i + self.batch_size)] for i in range(0, len(members), self.batch_size)])
+
+    def on_epoch_end(self):
+        self.reshuffle(random)
+
+    def reshuffle(self, rng):
+        """ Shuffles the groups with rng (random or a random.Random), forming new batches within every bucket. Nothing changes without shuffle_groups.
+        """
+        if not self.shuffle_groups:
+            return
+        if self.bucket_shapes is not None:
+            for members in self.buckets:
+                rng.shuffle(members)
+            self.fill_bucket_groups()
+        rng.shuffle(self.groups)
+
+    def pass_groups(self, rng):
+        """ The groups of a new pass over the images, formed again and shuffled with rng, leaving the groups of the generator as they are.
+        """
+        groups = self.groups
+        self.group_images()
+        self.reshuffle(rng)
+        groups, self.groups = self.groups, groups
+        return groups
+
+    def batch_shape(self, image_group):
+        """ Shape of the batch of image_group: its largest image shape, rounded up to the smallest bucket shape containing it.
+        """
+        shape = tuple(max(image.shape[x] for image in image_group) for x in range(3))
+        if self.bucket_shapes is not None:
+            fits = np.flatnonzero((self.bucket_shapes[:, 0] >= shape[0]) & (self.bucket_shapes[:, 1] >= shape[1]))
+            if len(fits):
+                best = fits[np.argmin(self.bucket_shapes[fits].prod(axis=1))]
+                return (int(self.bucket_shapes[best, 0]), int(self.bucket_shapes[best, 1]), shape[2])
+        return shape
 
     def load_image(self, image_index):
+        if self.image_cache is not None:
+            return self.image_cache.load(self.image_ids[image_index], lambda: self.decode_image(image_index))
+        return self.decode_image(image_index)
+
+    def decode_image(self, image_index):
+        if self.packed is not None:
+            return decode_image_bgr(self.packed.record(self.image_ids[image_index])['image'])
+
+        if self.lmdb_path:
+            # every process opens its own read only environment
+            return photo_data(self.lmdb_path).read_image_bgr(self.image_ids[image_index])
+
+        return read_image_bgr(self.image_path(image_index))
+
+    def image_path(self, image_index):
         image_info = self.coco.loadImgs(self.image_ids[image_index])[0]
-        path       = os.path.join(self.data_dir, 'images', image_info['file_name']) #, self.set_name
-        return read_image_bgr(path)
+        return os.path.join(self.data_dir, 'images', image_info['file_name']) #, self.set_name
+
+    def load_masks(self, ids, height, width, windows, rasterize):
+        """ The crops of the masks at windows, from the mask cache when there is one. rasterize(i) draws the i-th crop.
+        """
+        if self.mask_cache is not None:
+            return self.mask_cache.load(ids, int(height), int(width), windows, rasterize)
+        return [rasterize(i) for i in range(len(windows))]
+
+    def load_packed_annotations(self, image_index):
+        record  = self.packed.record(self.image_ids[image_index])
+        bboxes  = record['bboxes'].astype(float)
+        windows = mask_windows(bboxes, record['height'], record['width'])
+
+        def rasterize(i):
+            x1, y1, x2, y2 = windows[i]
+            return np.ascontiguousarray(mask_utils.decode(record['rles'][i])[y1:y2, x1:x2])
+
+        return {
+            'labels': np.array([self.coco_label_to_label(l) for l in record['labels'].tolist()], dtype=float),
+            'bboxes': bboxes,
+            'masks': self.load_masks(record['ids'].tolist(), record['height'], record['width'], windows.tolist(), rasterize),
+            'mask_windows': windows,
+        }
 
     def load_annotations(self, image_index):
-        # get image info
-        image_info = self.coco.loadImgs(self.image_ids[image_index])[0]
+        """ Returns the labels and bboxes of the image, with its masks as uint8 crops ('masks') at their windows ('mask_windows').
+        """
+        if self.packed is not None:
+            return self.load_packed_annotations(image_index)
+
+        start, end = self.annotations_offset[image_index], self.annotations_offset[image_index + 1]
+        height, width = self.image_sizes[image_index]
+        segmentations = self.annotations_segmentations[start:end]
 
-        # get ground truth annotations
-        annotations_ids = self.coco.getAnnIds(imgIds=self.image_ids[image_index], iscrowd=False)
-        annotations     = {
-            'labels': np.empty((0,)),
-            'bboxes': np.empty((0, 4)),
-            'masks': [],
+        # copies, the generator scales the boxes in place
+        annotations = {
+            'labels': self.annotations_labels[start:end].copy(),
+            'bboxes': self.annotations_bboxes[start:end].copy(),
         }
+        annotations['mask_windows'] = mask_windows(annotations['bboxes'], height, width)
 
-        # some images might miss annotations
-        if len(annotations_ids) == 0:
-            return annotations
+        windows = annotations['mask_windows'].tolist()
+        annotations['masks'] = self.load_masks(
+            self.annotations_ids[start:end].tolist(), height, width, windows,
+            lambda i: rasterize_polygons(segmentations[i], windows[i])
+        )
 
-        # parse annotations
-        coco_annotations = self.coco.loadAnns(annotations_ids)
-        for idx, a in enumerate(coco_annotations):
-            if 'segmentation' not in a:
-                raise ValueError('Expected \'segmentation\' key in annotation, got: {}'.format(a))
+        return annotations
+
+    def random_transform_group_entry(self, image, annotations, transform=None):
+        """ Randomly transforms image and annotation, warping only the crops of the masks.
+        """
+        if transform is not None or self.transform_generator:
+            if transform is None:
+                transform = adjust_transform_for_image(next(self.transform_generator), image, self.transform_parameters.relative_translation)
+
+            annotations['masks'], annotations['mask_windows'] = warp_masks(
+                annotations['masks'], annotations['mask_windows'], transform, image.shape[0], image.shape[1])
+
+            image = apply_transform(transform, image, self.transform_parameters)
+
+            annotations['bboxes'] = annotations['bboxes'].copy()
+            for index in range(annotations['bboxes'].shape[0]):
+                annotations['bboxes'][index, :] = transform_aabb(transform, annotations['bboxes'][index, :])
+
+        return image, annotations
+
+    def preprocess_group(self, image_group, annotations_group):
+        """ Augments the whole group, when there is an augmentation, then preprocesses every image.
+        """
+        if self.augmentation is not None:
+            image_group, annotations_group = self.augmentation(image_group, annotations_group, self.transform_parameters)
+
+        for index in range(len(image_group)):
+            image_group[index], annotations_group[index] = self.preprocess_group_entry(image_group[index], annotations_group[index])
+
+        return image_group, annotations_group
+
+    def preprocess_group_entry(self, image, annotations):
+        """ Preprocess image and its annotations, the masks crops follow the image scale.
+        """
+        image = self.preprocess_image(image)
+        image, annotations = self.random_transform_group_entry(image, annotations)
+        image, image_scale = self.resize_image(image)
+
+        annotations['masks'], annotations['mask_windows'] = resize_masks(
+            annotations['masks'], annotations['mask_windows'], image_scale, image.shape[0], image.shape[1])
+        annotations['bboxes'] *= image_scale
+
+        image = keras.backend.cast_to_floatx(image)
+
+        return image, annotations
+
+    def max_batch_nbytes(self):
+        """ Upper bound of the bytes of the inputs and targets of a batch, for the largest resized images and the most annotations of an image.
+        """
+        if self.bucket_shapes is not None:
+            height, width = self.bucket_shapes.max(axis=0)
+        else:
+            height, width = self.resized_sizes().max(axis=0)
+        if self.packed is not None:
+            max_annotations = int(self.packed.index['annotations'].max())
+        else:
+            max_annotations = int(np.diff(self.annotations_offset).max())
+        anchors = self.generate_anchors((int(height), int(width), 3)).shape[0]
+
+        values = height * width * 3 + anchors * (4 + 1) + anchors * (self.num_classes() + 1) + max_annotations * (5 + 2 + height * width)
+        # and the 64 bytes alignment of each of the 4 arrays in a loader slot
+        return int(self.batch_size * values * np.dtype(keras.backend.floatx()).itemsize) + 4 * 64
+
+    def generate_anchors(self, image_shape):
+        # the same for every batch of a shape
+        return self.anchor_cache(image_shape)
+
+    def compute_inputs(self, image_group):
+        image_batch = np.zeros((self.batch_size,) + self.batch_shape(image_group), dtype=keras.backend.floatx())
+
+        # copy all images to the upper left part of the image batch object
+        for image_index, image in enumerate(image_group):
+            image_batch[image_index, :image.shape[0], :image.shape[1], :image.shape[2]] = image
 
-            # some annotations have basically no width / height, skip them
-            if a['bbox'][2] < 1 or a['bbox'][3] < 1:
-                continue
+        return image_batch
 
-            annotations['labels'] = np.concatenate([annotations['labels'], [self.coco_label_to_label(a['category_id'])]], axis=0)
-            annotations['bboxes'] = np.concatenate([annotations['bboxes'], [[
-                a['bbox'][0],
-                a['bbox'][1],
-                a['bbox'][0] + a['bbox'][2] if a['bbox'][0] + a['bbox'][2] <= image_info['width'] else image_info['width'],
-                a['bbox'][1] + a['bbox'][3] if a['bbox'][1] + a['bbox'][3] <= image_info['height'] else image_info['height'],
-            ]]], axis=0) # normalizing annotations that exit boundaries
+    def compute_targets(self, image_group, annotations_group):
+        """ Same targets of the base generator, for the batch_shape. The masks are expanded to the batch image size only here.
+        """
+        max_shape = self.batch_shape(image_group)
+        anchors   = self.generate_anchors(max_shape)
 
-            mask = np.zeros((image_info['height'], image_info['width'], 1), dtype=np.uint8)
-            for seg in a['segmentation']:
-                points = np.array(seg).reshape((len(seg) // 2, 2)).astype(int)
+        batches = self.compute_anchor_targets(
+            anchors,
+            image_group,
+            annotations_group,
+            self.num_classes()
+        )
 
-                # draw mask
-                cv2.fillPoly(mask, [points.astype(int)], (1,))
+        # copy all annotations / masks to the batch
+        max_annotations = max(len(a['masks']) for a in annotations_group)
+        # masks_batch has shape: (batch size, max_annotations, bbox_x1 + bbox_y1 + bbox_x2 + bbox_y2 + label + width + height + max_image_dimension)
+        masks_batch     = np.zeros((self.batch_size, max_annotations, 5 + 2 + max_shape[0] * max_shape[1]), dtype=keras.backend.floatx())
+        for index, annotations in enumerate(annotations_group):
+            masks_batch[index, :annotations['bboxes'].shape[0], :4] = annotations['bboxes']
+            masks_batch[index, :annotations['labels'].shape[0], 4] = annotations['labels']
+            masks_batch[index, :, 5] = max_shape[1]  # width
+            masks_batch[index, :, 6] = max_shape[0]  # height
 
-            annotations['masks'].append(mask.astype(float))
+            # every mask in the top left of a max_shape plane, like the images in compute_inputs
+            planes = [masks_batch[index, i, 7:].reshape(max_shape[:2]) for i in range(len(annotations['masks']))]
+            paste_masks(annotations['masks'], annotations['mask_windows'], planes)
 
-        return annotations
\ No newline at end of file
+        return list(batches) + [masks_batch]
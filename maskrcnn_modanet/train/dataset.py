@@ -0,0 +1,170 @@
+"""
+tf.data input pipeline for the coco training set.
+
+Instead of fit_generator calling CocoGenerator one batch at a time, the batches are built by a
+tf.data pipeline running in the TensorFlow thread pool:
+
+    groups of the generator  ->  images (parallel map)  ->  batches (parallel map)  ->  prefetch
+
+The images map decodes the jpeg and png images with TensorFlow, out of the GIL, when they are read
+from the images folder (otherwise through CocoGenerator.load_image, so from the packed shards, the
+photos lmdb, the image cache, or for the other formats), and loads the annotations with their
+rasterized mask crops (through the mask cache when there is one). The batches map augments, resizes and computes the targets with the code of the
+generator, so the batches are the same of the generator ones.
+
+Only the jpeg and png decoding runs out of the GIL. The annotations, the masks and the whole batches map
+are tf.py_func calls, that share the interpreter of the training process: the parallel calls overlap on
+the reading and on the numpy and OpenCV work that releases the GIL, not on the python code. When that
+stage dominates, the multiprocessing enqueuer (--workers N --multiprocessing) or the shared memory
+loader scale better with the number of workers.
+
+tf.data caching is not used: it replays the elements in the order of the first epoch, while the groups
+are shuffled again every epoch. The image and mask caches of the generator are used instead.
+"""
+import threading
+
+import numpy as np
+import keras
+import tensorflow as tf
+
+
+class LockedIterator(object):
+    """ Iterator over iterator that can be used by many threads at once, like the transform generator by the map threads. """
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.lock     = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            return next(self.iterator)
+
+    next = __next__
+
+
+class CocoDataset(object):
+    """ Iterates forever over the batches of generator (a CocoGenerator), built by a tf.data pipeline.
+
+    Args
+        generator      : The CocoGenerator whose groups are turned into batches. Its on_epoch_end is called after every pass.
+        parallel_calls : Images, and batches, processed at the same time.
+        prefetch       : Batches prepared in advance.
+    """
+    def __init__(self, generator, parallel_calls=4, prefetch=2):
+        self.generator      = generator
+        self.parallel_calls = parallel_calls
+        self.prefetch       = prefetch
+
+        if generator.transform_generator is not None:
+            generator.transform_generator = LockedIterator(generator.transform_generator)
+
+        self.next_batch = self.dataset().make_one_shot_iterator().get_next()
+
+    def __len__(self):
+        return len(self.generator)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = keras.backend.get_session().run(self.next_batch)
+        return batch[0], list(batch[1:])
+
+    next = __next__
+
+    def schedule(self):
+        """ The groups of the generator, over and over, shuffled again after every pass. """
+        while True:
+            for group in self.generator.groups:
+                yield np.array(group, dtype=np.int64)
+            self.generator.on_epoch_end()
+
+    def native_decode(self):
+        """ Whether the images can be decoded by TensorFlow: files in the images folder, without an image cache. Only jpeg and png files are, the others go through the generator. """
+        generator = self.generator
+        return generator.packed is None and not generator.lmdb_path and generator.image_cache is None
+
+    def load_annotations(self, image_index):
+        """ The annotations of the image, with the mask crops in a flat array. """
+        annotations = self.generator.load_annotations(int(image_index))
+        masks = [np.ravel(mask) for mask in annotations['masks']]
+        return (
+            annotations['bboxes'].astype(np.float64).reshape((-1, 4)),
+            annotations['labels'].astype(np.float64),
+            np.asarray(annotations['mask_windows'], dtype=np.int64).reshape((-1, 4)),
+            np.concatenate(masks).astype(np.uint8) if masks else np.zeros((0,), dtype=np.uint8),
+        )
+
+    def compute_batch(self, indices, images, shapes, counts, bboxes, labels, windows, masks):
+        """ Inputs and targets of a group, from the padded images and annotations of the images map. """
+        image_group       = []
+        annotations_group = []
+        for i in range(len(indices)):
+            image_group.append(images[i, :np.prod(shapes[i])].reshape(shapes[i]))
+
+            count          = counts[i]
+            image_windows  = windows[i, :count].copy()
+            sizes          = (image_windows[:, 3] - image_windows[:, 1]) * (image_windows[:, 2] - image_windows[:, 0])
+            offsets        = np.concatenate([[0], np.cumsum(sizes)])
+            annotations_group.append({
+                'bboxes'       : bboxes[i, :count].copy(),
+                'labels'       : labels[i, :count].copy(),
+                'masks'        : [masks[i, offsets[j]:offsets[j + 1]].reshape((y2 - y1, x2 - x1)) for j, (x1, y1, x2, y2) in enumerate(image_windows.tolist())],
+                'mask_windows' : image_windows,
+            })
+
+        generator = self.generator
+        image_group, annotations_group = generator.filter_annotations(image_group, annotations_group, indices.tolist())
+        image_group, annotations_group = generator.preprocess_group(image_group, annotations_group)
+        inputs  = generator.compute_inputs(image_group)
+        targets = generator.compute_targets(image_group, annotations_group)
+        return [inputs.astype(keras.backend.floatx())] + [target.astype(keras.backend.floatx()) for target in targets]
+
+    def dataset(self):
+        generator = self.generator
+        native    = self.native_decode()
+        if native:
+            paths = tf.constant([generator.image_path(i) for i in range(generator.size())])
+
+        def generator_image(image_index):
+            return tf.py_func(lambda i: generator.load_image(int(i)), [image_index], tf.uint8)
+
+        def load_image(image_index):
+            if native:
+                data = tf.read_file(tf.gather(paths, image_index))
+                head = tf.substr(data, 0, 8)
+                # jpeg and png by TensorFlow, in BGR like read_image_bgr. the other formats (a gif has frames) by the generator
+                image = tf.case([
+                    (tf.equal(tf.substr(head, 0, 3), b'\xff\xd8\xff'), lambda: tf.reverse(tf.image.decode_jpeg(data, channels=3), axis=[-1])),
+                    (tf.equal(head, b'\x89PNG\r\n\x1a\n'), lambda: tf.reverse(tf.image.decode_png(data, channels=3), axis=[-1])),
+                ], default=lambda: generator_image(image_index), exclusive=True)
+                image.set_shape([None, None, 3])
+            else:
+                image = generator_image(image_index)
+
+            bboxes, labels, windows, masks = tf.py_func(self.load_annotations, [image_index], [tf.float64, tf.float64, tf.int64, tf.uint8])
+            bboxes.set_shape([None, 4])
+            labels.set_shape([None])
+            windows.set_shape([None, 4])
+            masks.set_shape([None])
+
+            # flat, so that images of different shapes are batched together
+            return image_index, tf.reshape(image, [-1]), tf.shape(image), tf.shape(labels)[0], bboxes, labels, windows, masks
+
+        def compute_batch(*batch):
+            outputs = tf.py_func(self.compute_batch, batch, [tf.as_dtype(keras.backend.floatx())] * 4)
+            outputs[0].set_shape([None, None, None, 3])
+            outputs[1].set_shape([None, None, 5])
+            outputs[2].set_shape([None, None, generator.num_classes() + 1])
+            outputs[3].set_shape([None, None, None])
+            return tuple(outputs)
+
+        dataset = tf.data.Dataset.from_generator(self.schedule, tf.int64, tf.TensorShape([None]))
+        dataset = dataset.flat_map(tf.data.Dataset.from_tensor_slices)
+        dataset = dataset.map(load_image, num_parallel_calls=self.parallel_calls)
+        # every group has batch_size images, so the batches are the groups again
+        dataset = dataset.padded_batch(generator.batch_size, padded_shapes=([], [None], [3], [], [None, 4], [None], [None, 4], [None]))
+        dataset = dataset.map(compute_batch, num_parallel_calls=self.parallel_calls)
+        return dataset.prefetch(self.prefetch)
@@ -0,0 +1,291 @@
+"""
+Evaluation of the coco validation set during training.
+
+EvaluationSchedule decides which epochs are evaluated and on which images: every `every` epochs, on a
+fixed stratified subset of the images (see stratified_subset), and on all of them every `full_every`
+epochs and at the last epoch. The mAPs of the subset are logged as subset_mAP.., the full ones as mAP..
+
+CocoEvaluation evaluates in the training process, so the training waits for it, and adds the mAPs to
+the epoch logs too (so that a snapshot can be chosen by mAP). EvaluationProcess hands the epoch
+snapshots, once SnapshotWriter has written them, to a separate process that loads them and evaluates
+them while the training goes on. Both write the mAPs to the TensorBoard log dir of the training, at the
+epoch of the evaluated weights, so they show up in the same run.
+"""
+import multiprocessing
+import os
+import random
+
+import numpy as np
+import keras
+
+# the order of COCOeval.stats
+stat_names = [
+    'mAP', 'mAP_50', 'mAP_75', 'mAP_small', 'mAP_medium', 'mAP_large',
+    'mAR_1', 'mAR_10', 'mAR_100', 'mAR_small', 'mAR_medium', 'mAR_large',
+]
+
+
+def evaluate_coco(generator, model, indices, threshold=0.05, verbose=True):
+    """ The COCOeval segm stats of model on the images indices of generator, like keras_maskrcnn.utils.coco_eval.evaluate_coco.
+        None if nothing was detected.
+    """
+    import cv2
+    from pycocotools.cocoeval import COCOeval
+    from pycocotools import mask as mask_utils
+
+    results   = []
+    image_ids = []
+    for position, index in enumerate(indices):
+        image       = generator.load_image(index)
+        image_shape = image.shape
+        image       = generator.preprocess_image(image)
+        image, scale = generator.resize_image(image)
+
+        outputs = model.predict_on_batch(np.expand_dims(image, axis=0))
+        boxes   = outputs[-4]
+        scores  = outputs[-3]
+        labels  = outputs[-2]
+        masks   = outputs[-1]
+
+        # correct boxes for image scale, and change to (x, y, w, h)
+        boxes /= scale
+        boxes[..., 2] -= boxes[..., 0]
+        boxes[..., 3] -= boxes[..., 1]
+
+        for box, score, label, mask in zip(boxes[0], scores[0], labels[0], masks[0]):
+            # scores are sorted by the network
+            if score < threshold:
+                break
+
+            b    = box.astype(int)
+            mask = cv2.resize(mask[:, :, label].astype(np.float32), (b[2], b[3]))
+            mask = (mask > 0.5).astype(np.uint8)
+
+            segmentation = np.zeros((image_shape[0], image_shape[1]), dtype=np.uint8)
+            segmentation[b[1]:b[1] + b[3], b[0]:b[0] + b[2]] = mask
+            segmentation = mask_utils.encode(np.asfortranarray(segmentation))
+            if not isinstance(segmentation['counts'], str):
+                segmentation['counts'] = segmentation['counts'].decode()
+
+            results.append({
+                'image_id'     : generator.image_ids[index],
+                'category_id'  : generator.label_to_coco_label(label),
+                'score'        : float(score),
+                'bbox'         : box.tolist(),
+                'segmentation' : segmentation
+            })
+
+        image_ids.append(generator.image_ids[index])
+        if verbose:
+            print('{}/{}'.format(position + 1, len(indices)), end='\r')
+
+    if not results:
+        return None
+
+    coco_eval = COCOeval(generator.coco, generator.coco.loadRes(results), 'segm')
+    coco_eval.params.imgIds = image_ids
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize()
+    return coco_eval.stats
+
+
+def stratified_subset(generator, size, seed=0):
+    """ Indices of size images of generator, with the categories in about the proportions of the whole set.
+        Every image counts for its rarest category, and every category gets its share of the subset
+        (largest remainders first). The same seed gives the same subset.
+    """
+    if size >= generator.size():
+        return list(range(generator.size()))
+
+    categories = [{a['category_id'] for a in generator.coco.imgToAnns.get(image_id, [])} for image_id in generator.image_ids]
+    frequency  = {}
+    for image_categories in categories:
+        for category in image_categories:
+            frequency[category] = frequency.get(category, 0) + 1
+
+    strata = {}
+    for index, image_categories in enumerate(categories):
+        key = min(image_categories, key=lambda category: (frequency[category], category)) if image_categories else -1
+        strata.setdefault(key, []).append(index)
+
+    keys   = sorted(strata)
+    shares = {key: size * len(strata[key]) / float(generator.size()) for key in keys}
+    counts = {key: int(shares[key]) for key in keys}
+    for key in sorted(keys, key=lambda key: counts[key] - shares[key])[:size - sum(counts.values())]:
+        counts[key] += 1
+
+    rng = random.Random(seed)
+    return sorted(index for key in keys for index in rng.sample(strata[key], counts[key]))
+
+
+class EvaluationSchedule(object):
+    """ Evaluates every `every` epochs, on a stratified subset of subset images of generator if given, on all of them every full_every epochs and at the last one.
+        epochs is the number of epochs of the whole training, not of a single fit_generator call (a resumed training makes two of them).
+    """
+    def __init__(self, generator, epochs=None, every=1, subset=None, full_every=None, seed=0):
+        self.epochs     = epochs
+        self.every      = every
+        self.full_every = full_every
+        self.size       = generator.size()
+        self.subset     = stratified_subset(generator, subset, seed) if subset else None
+
+    def __call__(self, epoch):
+        """ The images to evaluate at epoch (from 0), and whether they are all of them. None if the epoch is not evaluated. """
+        number = epoch + 1
+        last   = self.epochs is not None and number >= self.epochs
+        if number % self.every and not last:
+            return None
+        if self.subset is None or last or (self.full_every and number % self.full_every == 0):
+            return list(range(self.size)), True
+        return self.subset, False
+
+
+def stats_logs(stats, full):
+    prefix = '' if full else 'subset_'
+    return {prefix + name: float(value) for name, value in zip(stat_names, stats)}
+
+
+def write_summaries(writer, values, epoch):
+    """ Writes values to a tf.summary.FileWriter at epoch, like the TensorBoard callback does with the epoch logs. """
+    import tensorflow as tf
+
+    summary = tf.Summary()
+    for name, value in sorted(values.items()):
+        summary_value              = summary.value.add()
+        summary_value.simple_value = value
+        summary_value.tag          = name
+    writer.add_summary(summary, epoch)
+    writer.flush()
+
+
+class CocoEvaluation(keras.callbacks.Callback):
+    """ Evaluates the model (the prediction model, through RedirectModel) on the epochs of schedule, in the training process.
+
+    Args
+        generator   : The CocoGenerator of the validation set.
+        schedule    : The EvaluationSchedule.
+        tensorboard : The TensorBoard callback, whose writer gets the mAPs. Optional.
+        threshold   : Score under which the detections are ignored.
+    """
+    def __init__(self, generator, schedule, tensorboard=None, threshold=0.05):
+        super(CocoEvaluation, self).__init__()
+        self.generator   = generator
+        self.schedule    = schedule
+        self.tensorboard = tensorboard
+        self.threshold   = threshold
+
+    def on_epoch_end(self, epoch, logs=None):
+        plan = self.schedule(epoch)
+        if plan is None:
+            return
+        indices, full = plan
+
+        stats = evaluate_coco(self.generator, self.model, indices, self.threshold)
+        if stats is None:
+            print('\nNothing detected on the {} validation images'.format(len(indices)))
+            return
+        values = stats_logs(stats, full)
+
+        if logs is not None:
+            logs.update(values)
+        if self.tensorboard is not None and getattr(self.tensorboard, 'writer', None) is not None:
+            write_summaries(self.tensorboard.writer, values, epoch)
+
+
+def evaluation_worker(tasks, spec, tensorboard_dir, threshold):
+    """ Evaluates the snapshots of tasks (path, epoch, indices, full) until None, on the CocoGenerator made with the keyword arguments spec. """
+    import tensorflow as tf
+    from keras_retinanet.utils.config import read_config_file
+
+    from maskrcnn_modanet.train.coco import CocoGenerator
+    from maskrcnn_modanet.train.snapshots import load_snapshot
+
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    keras.backend.tensorflow_backend.set_session(tf.Session(config=config))
+
+    spec = dict(spec)
+    if spec.get('config'):
+        spec['config'] = read_config_file(spec['config'])
+    generator = CocoGenerator(**spec)
+    writer    = tf.summary.FileWriter(tensorboard_dir) if tensorboard_dir else None
+
+    model = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        path, epoch, indices, full = task
+
+        try:
+            # the model is built once, then only the weights change
+            if model is None:
+                model = load_snapshot(path)
+            else:
+                model.load_weights(path)
+        except (IOError, OSError) as e:
+            print('\nSkipping the evaluation of {}, that could not be read (removed by --snapshot-keep?): {}'.format(path, e))
+            continue
+
+        print('\nEvaluating {} on {} images'.format(os.path.basename(path), len(indices)))
+        stats = evaluate_coco(generator, model, indices, threshold, verbose=False)
+        if stats is None:
+            print('\nNothing detected by {} on the {} validation images'.format(os.path.basename(path), len(indices)))
+            continue
+        if writer is not None:
+            write_summaries(writer, stats_logs(stats, full), epoch)
+
+    if writer is not None:
+        writer.close()
+
+
+class EvaluationProcess(keras.callbacks.Callback):
+    """ Evaluates the epoch snapshots of a SnapshotWriter on the epochs of schedule, in a separate process, so that the training goes on meanwhile.
+        It has to come before the SnapshotWriter. close() waits for the evaluations left and stops the process.
+
+    Args
+        snapshot_writer : The SnapshotWriter of the training.
+        schedule        : The EvaluationSchedule.
+        spec            : Keyword arguments of the CocoGenerator of the validation set, with the path of the config file as config.
+        tensorboard_dir : Log dir of the TensorBoard run the mAPs are written to. Optional.
+        threshold       : Score under which the detections are ignored.
+    """
+    def __init__(self, snapshot_writer, schedule, spec, tensorboard_dir=None, threshold=0.05):
+        super(EvaluationProcess, self).__init__()
+        self.snapshot_writer = snapshot_writer
+        self.schedule        = schedule
+        self.spec            = spec
+        self.tensorboard_dir = tensorboard_dir
+        self.threshold       = threshold
+        self.planned         = {}
+        self.process         = None
+        snapshot_writer.listeners.append(self.snapshot_written)
+
+    def on_train_begin(self, logs=None):
+        if self.process is not None:
+            return
+        # spawned, not forked from a process that has a TensorFlow session
+        context      = multiprocessing.get_context('spawn')
+        self.tasks   = context.Queue()
+        self.process = context.Process(target=evaluation_worker, args=(self.tasks, self.spec, self.tensorboard_dir, self.threshold), daemon=True)
+        self.process.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        plan = self.schedule(epoch)
+        if plan is not None:
+            self.planned[epoch + 1] = plan
+
+    def snapshot_written(self, path, entry):
+        # only the end of epoch snapshots, not the ones every some steps
+        if entry['file'] != self.snapshot_writer.name.format(epoch=entry['epoch'], step=entry['step']) or entry['epoch'] not in self.planned:
+            return
+        indices, full = self.planned.pop(entry['epoch'])
+        self.tasks.put((path, entry['epoch'] - 1, indices, full))
+
+    def close(self):
+        if self.process is None:
+            return
+        self.tasks.put(None)
+        self.process.join()
+        self.process = None
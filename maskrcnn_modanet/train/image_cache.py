@@ -0,0 +1,144 @@
+"""
+Cache of the decoded images, shared by all the data loading processes.
+
+Images are kept in an lmdb database (a memory mapped file) as raw uint8 arrays at their native
+resolution, keyed by image id, so any worker and the evaluation in the main process reuse the
+decode of any other one. The cache has a byte budget, over which the least recently used images
+are evicted. The recency is approximate: hits are only recorded in the database the next time
+the process writes to it.
+"""
+import multiprocessing
+import os
+import struct
+
+import lmdb
+import numpy as np
+
+header_format = '<iii'  # height, width, channels
+
+# positions in ImageCache.stats
+HITS, MISSES, BYTES_READ, BYTES_WRITTEN, EVICTIONS = range(5)
+
+
+class ImageCache(object):
+    """ The decoded images database at path, holding at most budget bytes of images.
+
+    Databases (named lmdb databases):
+        images : image id -> header and pixels.
+        access : image id -> last access tick and size.
+        lru    : last access tick, image id -> nothing, in order of access.
+        info   : b'bytes' and b'tick' -> the bytes of images stored and the last tick used.
+    """
+    def __init__(self, path, budget):
+        self.path     = path
+        self.budget   = budget
+        self.stats    = multiprocessing.Array('q', 5)
+        self._pid     = None
+        self._env     = None
+        self._pending = []
+
+    def __getstate__(self):
+        # environments are not shared between processes
+        state = self.__dict__.copy()
+        state['_pid']     = None
+        state['_env']     = None
+        state['_pending'] = []
+        return state
+
+    def env(self):
+        if self._pid != os.getpid():
+            # like photo_data, environments inherited from the parent process are closed and opened again
+            if self._env is not None:
+                self._env.close()
+            self._pid     = os.getpid()
+            self._pending = []
+            # the contents are only a cache, so nothing is synced to disk
+            self._env = lmdb.open(self.path, map_size=max(2 * self.budget, 2**30), max_dbs=4, sync=False, metasync=False, readahead=False)
+            self._dbs = {name: self._env.open_db(name.encode('ascii')) for name in ('images', 'access', 'lru', 'info')}
+        return self._env
+
+    def load(self, image_id, decode):
+        """ Returns the image image_id, calling decode() and storing its result when it is not cached. """
+        env = self.env()
+        key = struct.pack('<q', image_id)
+        with env.begin(db=self._dbs['images'], buffers=True) as t:
+            data = t.get(key)
+            if data is not None:
+                height, width, channels = struct.unpack_from(header_format, data)
+                image = np.frombuffer(data, dtype=np.uint8, offset=struct.calcsize(header_format)).reshape((height, width, channels)).copy()
+
+        if data is not None:
+            self._pending.append(key)
+            self.count(HITS, BYTES_READ, image.nbytes)
+            if len(self._pending) >= 256:
+                with env.begin(write=True) as t:
+                    self.touch(t)
+            return image
+
+        image = decode()
+        data = struct.pack(header_format, *image.shape) + np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+        if len(data) > self.budget:
+            self.count(MISSES, BYTES_WRITTEN, 0)
+            return image
+
+        evicted = 0
+        with env.begin(write=True) as t:
+            self.touch(t)
+            # another process could have stored it meanwhile
+            if t.get(key, db=self._dbs['access']) is None:
+                evicted = self.make_room(t, len(data))
+                t.put(key, data, db=self._dbs['images'])
+                self.access(t, key, len(data))
+                t.put(b'bytes', struct.pack('<q', self.info(t, b'bytes') + len(data)), db=self._dbs['info'])
+        self.count(MISSES, BYTES_WRITTEN, len(data), evicted)
+        return image
+
+    def count(self, kind, bytes_kind, size, evicted=0):
+        with self.stats.get_lock():
+            self.stats[kind] += 1
+            self.stats[bytes_kind] += size
+            self.stats[EVICTIONS] += evicted
+
+    def info(self, t, name):
+        value = t.get(name, db=self._dbs['info'])
+        return struct.unpack('<q', value)[0] if value is not None else 0
+
+    def access(self, t, key, size):
+        """ Moves key, of size bytes, to the most recently used end. """
+        tick = self.info(t, b'tick') + 1
+        t.put(key, struct.pack('<qq', tick, size), db=self._dbs['access'])
+        t.put(struct.pack('>q', tick) + key, b'', db=self._dbs['lru'])
+        t.put(b'tick', struct.pack('<q', tick), db=self._dbs['info'])
+
+    def touch(self, t):
+        """ Records the pending hits of this process. """
+        for key in self._pending:
+            access = t.get(key, db=self._dbs['access'])
+            # the image could have been evicted meanwhile
+            if access is not None:
+                old_tick, size = struct.unpack('<qq', access)
+                t.delete(struct.pack('>q', old_tick) + key, db=self._dbs['lru'])
+                self.access(t, key, size)
+        self._pending = []
+
+    def make_room(self, t, size):
+        """ Evicts the least recently used images until size more bytes fit in the budget. Returns how many were evicted. """
+        total   = self.info(t, b'bytes')
+        evicted = 0
+        with t.cursor(db=self._dbs['lru']) as c:
+            while total + size > self.budget and c.first():
+                lru_key = c.key()
+                key = lru_key[8:]
+                _, image_size = struct.unpack('<qq', t.get(key, db=self._dbs['access']))
+                c.delete()
+                t.delete(key, db=self._dbs['access'])
+                t.delete(key, db=self._dbs['images'])
+                total -= image_size
+                evicted += 1
+        t.put(b'bytes', struct.pack('<q', total), db=self._dbs['info'])
+        return evicted
+
+    def size(self):
+        """ Bytes of images stored """
+        with self.env().begin() as t:
+            return self.info(t, b'bytes')
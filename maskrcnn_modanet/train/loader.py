@@ -0,0 +1,231 @@
+"""
+Shared memory data loading for fit_generator.
+
+Worker processes compute the batches of a keras Sequence and write them in a ring of preallocated
+shared memory slots. Only the slot number and the layout of the arrays go through the queues, and
+the trainer reads the arrays in place, without unpickling or copying them.
+
+    free slots  ->  workers  ->  ready slots  ->  trainer  ->  free slots
+
+When every slot holds a batch the trainer did not take yet, the workers wait for a free one
+(back-pressure). The slot of a batch is given back when the trainer asks for the next batch, since
+keras is done with a batch by then. Batches larger than a slot are sent pickled through the queue.
+
+The slots are allocated up front, so the loader refuses slots that do not fit in the available memory,
+and default_slot_bytes caps the largest possible batch, that is rarely reached, to a share of it.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+
+def write_arrays(buffer, arrays):
+    """ Copies arrays in buffer one after the other. Returns their layout, None if they do not fit. """
+    layout = []
+    offset = 0
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        # every array starts 64 bytes aligned
+        offset = (offset + 63) // 64 * 64
+        if offset + array.nbytes > len(buffer):
+            return None
+        np.frombuffer(buffer, dtype=array.dtype, count=array.size, offset=offset).reshape(array.shape)[...] = array
+        layout.append((array.dtype.str, array.shape, offset))
+        offset += array.nbytes
+    return layout
+
+
+def read_arrays(buffer, layout):
+    """ Views on the arrays of layout in buffer """
+    return [np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape) for dtype, shape, offset in layout]
+
+
+def available_memory():
+    """ Bytes of memory available without swapping (MemAvailable of /proc/meminfo), None where it is not known. """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_slot_bytes(batch_nbytes, slots, memory_share=0.25):
+    """ The slot size for batches of at most batch_nbytes, capped so that the slots take at most memory_share of the available memory.
+        The few batches larger than the capped slots go pickled through the queue.
+    """
+    memory = available_memory()
+    if memory is None:
+        return batch_nbytes
+    return min(batch_nbytes, int(memory * memory_share / slots))
+
+
+def worker(sequence, slots, tasks, free_slots, ready):
+    """ Computes the batches of the groups in tasks until it gets None, writing them in the free slots """
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            # a group of images of the sequence, or just the index of a batch
+            inputs, targets = sequence.compute_input_output(task) if isinstance(task, list) else sequence[task]
+            arrays = [inputs] + list(targets)
+
+            slot = free_slots.get()
+            if slot is None:
+                break
+            layout = write_arrays(slots[slot], arrays)
+            if layout is None:
+                # too large for the slot, through the queue. the slot is still taken, for the back-pressure
+                ready.put(('pickled', slot, arrays))
+            else:
+                ready.put(('slot', slot, layout))
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        ready.put(('error', None, traceback.format_exc()))
+
+
+class SharedMemoryLoader(object):
+    """ Iterates forever over the batches of sequence, computed by workers processes in slots shared memory slots of slot_bytes each.
+    Groups are taken in order, calling sequence.on_epoch_end after every pass; batches come out in the order they are ready.
+    """
+    def __init__(self, sequence, workers, slots, slot_bytes):
+        memory = available_memory()
+        if memory is not None and slots * slot_bytes > memory:
+            raise ValueError('{} shared memory slots of {:.0f} MB do not fit in the {:.0f} MB of available memory, use fewer or smaller slots.'.format(
+                slots, slot_bytes / 2**20, memory / 2**20))
+
+        self.sequence   = sequence
+        self.slot_bytes = slot_bytes
+
+        context = multiprocessing.get_context('fork')
+        self.slots      = [context.RawArray('B', slot_bytes) for _ in range(slots)]
+        self.tasks      = context.Queue(maxsize=2 * workers)
+        self.free_slots = context.Queue()
+        self.ready      = context.Queue()
+
+        self.workers  = [context.Process(target=worker, args=(sequence, self.slots, self.tasks, self.free_slots, self.ready), daemon=True) for _ in range(workers)]
+        for process in self.workers:
+            process.start()
+        # after the workers are forked, so that no thread is running at fork time: putting in a queue starts its feeder thread
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        self.stopped  = threading.Event()
+        self.feeder   = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+
+        self.current = None
+        self.reset_stats()
+
+    def feed(self):
+        # the groups of the main process sequence, so that its on_epoch_end shuffle is seen by the workers
+        while True:
+            for index in range(len(self.sequence)):
+                task = self.sequence.groups[index] if hasattr(self.sequence, 'groups') else index
+                while True:
+                    if self.stopped.is_set():
+                        return
+                    try:
+                        self.tasks.put(task, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+            self.sequence.on_epoch_end()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.current is not None:
+            # keras is done with the previous batch
+            self.free_slots.put(self.current)
+            self.current = None
+
+        start = time.time()
+        occupancy = self.ready.qsize()
+        while True:
+            try:
+                kind, slot, value = self.ready.get(timeout=1.)
+                break
+            except queue.Empty:
+                # a worker killed (out of memory, a crash in native code) never reports an error
+                dead = [process for process in self.workers if not process.is_alive()]
+                if dead:
+                    self.close()
+                    raise RuntimeError('A data loading worker exited unexpectedly with exit code {}'.format(dead[0].exitcode))
+        self.waited    += time.time() - start
+        self.occupancy += occupancy
+        self.batches   += 1
+
+        if kind == 'error':
+            self.close()
+            raise RuntimeError('A data loading worker failed:\n' + value)
+        self.current = slot
+        if kind == 'pickled':
+            self.pickled += 1
+            arrays = value
+        else:
+            arrays = read_arrays(self.slots[slot], value)
+        return arrays[0], arrays[1:]
+
+    next = __next__
+
+    def reset_stats(self):
+        self.stats_start = time.time()
+        self.batches     = 0
+        self.waited      = 0.
+        self.occupancy   = 0
+        self.pickled     = 0
+
+    def stats(self):
+        """ Batches per second, mean number of ready batches when the trainer asked for one, fraction of the time the trainer waited for a batch,
+            batches too large for the slots, since the last reset_stats.
+        """
+        seconds = time.time() - self.stats_start
+        return {
+            'batches_per_second' : self.batches / seconds if seconds else 0.,
+            'queue_occupancy'    : self.occupancy / float(max(self.batches, 1)),
+            'wait_fraction'      : self.waited / seconds if seconds else 0.,
+            'pickled_batches'    : self.pickled,
+        }
+
+    def close(self):
+        """ Stops the feeder and the workers, waiting for them to exit """
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.feeder.join()
+
+        # drop the pending tasks, then one None for each worker, waiting for a task or a slot
+        try:
+            while True:
+                self.tasks.get_nowait()
+        except queue.Empty:
+            pass
+        for _ in self.workers:
+            self.tasks.put(None)
+            self.free_slots.put(None)
+
+        deadline = time.time() + 10
+        for process in self.workers:
+            # a worker blocked on a full ready queue needs it drained
+            while process.is_alive() and time.time() < deadline:
+                try:
+                    self.ready.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+                process.join(timeout=0.1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
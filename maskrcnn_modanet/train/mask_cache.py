@@ -0,0 +1,118 @@
+"""
+Persistent cache of the rasterized masks.
+
+Masks are stored once in an lmdb database, keyed by annotation id and image size, as the bits of
+their crop (see train/masks.py). The database is filled lazily: the first time an annotation is
+needed it is rasterized and written, then every epoch and every worker process decodes it from here.
+
+The key does not say where a mask comes from, so the database records the fingerprint of its source
+(the annotations files, and whether the masks are rasterized from polygons or decoded from the packed
+RLEs) and is emptied when it is opened for another one.
+"""
+import multiprocessing
+import os
+import struct
+
+import lmdb
+import numpy as np
+
+key_format    = '<qii'   # annotation id, image height, image width
+header_format = '<iiii'  # window x1, y1, x2, y2 of the crop
+meta_key      = b'fingerprint'  # not the size of a mask key
+
+# positions in MaskCache.stats
+HITS, MISSES, BYTES_READ, BYTES_WRITTEN = range(4)
+
+
+def encode_mask(mask, window):
+    return struct.pack(header_format, *window) + np.packbits(mask, axis=None).tobytes()
+
+
+def decode_mask(data, window):
+    """ The crop stored in data, None if it was stored for a different window """
+    header_size = struct.calcsize(header_format)
+    if list(struct.unpack_from(header_format, data)) != list(window):
+        return None
+    x1, y1, x2, y2 = window
+    bits = np.frombuffer(data, dtype=np.uint8, offset=header_size)
+    return np.unpackbits(bits, count=(y2 - y1) * (x2 - x1)).reshape((y2 - y1, x2 - x1))
+
+
+class MaskCache(object):
+    """ The masks database at path. Every process opens its own environment the first time it is used.
+        stats counts hits, misses, bytes read and bytes written by all the processes forked after its creation.
+        fingerprint identifies the source of the masks, the masks of another fingerprint are dropped.
+    """
+    def __init__(self, path, fingerprint=None, map_size=2**36):
+        self.path     = path
+        self.map_size = map_size
+        self.stats    = multiprocessing.Array('q', 4)
+        self._pid     = None
+        self._env     = None
+        if fingerprint is not None:
+            self.check_fingerprint(fingerprint)
+
+    def check_fingerprint(self, fingerprint):
+        """ Empties the database if its masks were stored for another fingerprint, and records this one. """
+        fingerprint = fingerprint.encode('utf-8')
+        env = self.env()
+        with env.begin(write=True) as t:
+            stored = t.get(meta_key)
+            if stored == fingerprint:
+                return
+            if env.stat()['entries']:
+                print('Emptying the mask cache {}, filled from other annotations'.format(self.path))
+                t.drop(env.open_db(txn=t), delete=False)
+            t.put(meta_key, fingerprint)
+
+    def __getstate__(self):
+        # environments are not shared between processes
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_env'] = None
+        return state
+
+    def env(self):
+        if self._pid != os.getpid():
+            # like photo_data, environments inherited from the parent process are closed and opened again
+            if self._env is not None:
+                self._env.close()
+            self._pid = os.getpid()
+            self._env = lmdb.open(self.path, map_size=self.map_size, readahead=False)
+        return self._env
+
+    def load(self, ids, height, width, windows, rasterize):
+        """ Returns the crops of the annotations ids in an image of height, width, at their windows.
+            rasterize(i) computes the i-th crop when it is not in the cache yet, it is then stored
+        """
+        keys  = [struct.pack(key_format, annotation_id, height, width) for annotation_id in ids]
+        masks = [None] * len(keys)
+        read  = 0
+        with self.env().begin(buffers=True) as t:
+            for i, (key, window) in enumerate(zip(keys, windows)):
+                data = t.get(key)
+                if data is not None:
+                    masks[i] = decode_mask(data, window)
+                    read += len(data)
+
+        missing = [i for i, mask in enumerate(masks) if mask is None]
+        written = 0
+        if missing:
+            with self.env().begin(write=True) as t:
+                for i in missing:
+                    masks[i] = rasterize(i)
+                    data = encode_mask(masks[i], windows[i])
+                    t.put(keys[i], data)
+                    written += len(data)
+
+        with self.stats.get_lock():
+            self.stats[HITS]          += len(keys) - len(missing)
+            self.stats[MISSES]        += len(missing)
+            self.stats[BYTES_READ]    += read
+            self.stats[BYTES_WRITTEN] += written
+        return masks
+
+    def entries(self):
+        # but the fingerprint
+        with self.env().begin() as t:
+            return self.env().stat()['entries'] - (t.get(meta_key) is not None)
@@ -0,0 +1,89 @@
+"""
+Compact masks for the training generator.
+
+Every mask is kept as a uint8 crop of 0 / 1 values, next to its window x1, y1, x2, y2 in image
+pixels (x2, y2 excluded). Augmentation and resizing only touch the crops, masks get the size of
+the image only when they are copied in the targets of the mask loss.
+"""
+import numpy as np
+import cv2
+
+
+def mask_windows(bboxes, height, width):
+    """ Integer windows of the pixels covered by bboxes (n, 4), clipped to the image and never empty. """
+    windows = np.empty((len(bboxes), 4), dtype=np.int64)
+    windows[:, 0] = np.clip(np.floor(bboxes[:, 0]), 0, width - 1)
+    windows[:, 1] = np.clip(np.floor(bboxes[:, 1]), 0, height - 1)
+    # the polygon points on the box border are drawn at their integer part, so the last pixel is included
+    windows[:, 2] = np.clip(np.floor(bboxes[:, 2]) + 1, windows[:, 0] + 1, width)
+    windows[:, 3] = np.clip(np.floor(bboxes[:, 3]) + 1, windows[:, 1] + 1, height)
+    return windows
+
+
+def rasterize_polygons(segmentation, window):
+    """ Draws the coco polygons of an annotation in the crop of window. """
+    x1, y1, x2, y2 = window
+    mask = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+    for seg in segmentation:
+        points = np.array(seg).reshape((len(seg) // 2, 2)).astype(int) - (x1, y1)
+        cv2.fillPoly(mask, [points], (1,))
+    return mask
+
+
+def warp_masks(masks, windows, transform, height, width):
+    """ Applies the affine transform, in image coordinates, to every crop.
+        The new windows cover the transformed crops, clipped to the (unchanged) image size.
+    """
+    warped      = []
+    new_windows = np.empty_like(windows)
+    for i, (mask, (x1, y1, x2, y2)) in enumerate(zip(masks, windows.tolist())):
+        # where the first and last pixels of the crop go, with one more pixel of margin when they are not integer
+        corners = transform.dot([[x1, x2 - 1, x1, x2 - 1], [y1, y2 - 1, y2 - 1, y1], [1, 1, 1, 1]])
+        nx1 = min(max(int(np.floor(corners[0].min())), 0), width - 1)
+        ny1 = min(max(int(np.floor(corners[1].min())), 0), height - 1)
+        nx2 = min(max(int(np.ceil(corners[0].max())) + 1, nx1 + 1), width)
+        ny2 = min(max(int(np.ceil(corners[1].max())) + 1, ny1 + 1), height)
+
+        # transform from the old crop to the new one
+        matrix = np.array([[1, 0, -nx1], [0, 1, -ny1], [0, 0, 1]]).dot(transform).dot([[1, 0, x1], [0, 1, y1], [0, 0, 1]])
+        warped.append(cv2.warpAffine(
+            mask,
+            matrix[:2, :],
+            dsize=(nx2 - nx1, ny2 - ny1),
+            flags=cv2.INTER_NEAREST,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
+        ))
+        new_windows[i] = (nx1, ny1, nx2, ny2)
+    return warped, new_windows
+
+
+def flip_masks(masks, windows, flip_x, flip_y, height, width):
+    """ Mirrors the crops, and their windows, of an image of height, width, without warping them. """
+    masks       = [np.ascontiguousarray(mask[::-1 if flip_y else 1, ::-1 if flip_x else 1]) for mask in masks]
+    new_windows = windows.copy()
+    if flip_x:
+        new_windows[:, 0], new_windows[:, 2] = width - windows[:, 2], width - windows[:, 0]
+    if flip_y:
+        new_windows[:, 1], new_windows[:, 3] = height - windows[:, 3], height - windows[:, 1]
+    return masks, new_windows
+
+
+def resize_masks(masks, windows, scale, height, width):
+    """ Scales the crops and their windows like an image resized by scale to height, width. """
+    new_windows = np.rint(windows * scale).astype(np.int64)
+    new_windows[:, 0] = np.clip(new_windows[:, 0], 0, width - 1)
+    new_windows[:, 1] = np.clip(new_windows[:, 1], 0, height - 1)
+    new_windows[:, 2] = np.clip(new_windows[:, 2], new_windows[:, 0] + 1, width)
+    new_windows[:, 3] = np.clip(new_windows[:, 3], new_windows[:, 1] + 1, height)
+
+    resized = []
+    for mask, (x1, y1, x2, y2) in zip(masks, new_windows.tolist()):
+        resized.append(cv2.resize(mask, (x2 - x1, y2 - y1), interpolation=cv2.INTER_NEAREST))
+    return resized, new_windows
+
+
+def paste_masks(masks, windows, planes):
+    """ Copies every crop at its window in planes, a (n, height, width) array. """
+    for plane, mask, (x1, y1, x2, y2) in zip(planes, masks, windows.tolist()):
+        plane[y1:y2, x1:x2] = mask
@@ -0,0 +1,204 @@
+"""
+Exact resume of an interrupted training.
+
+ResumableSequence makes the batches a function of the seed and of the number of the batch since the
+start of the training: the groups of every pass over the images are shuffled with a random.Random
+seeded by (seed, pass), and the augmentation is seeded by (seed, batch) before every batch. So the
+batches do not depend on which process computes them, nor on where the training was restarted.
+
+TrainingState saves, atomically, everything else a restarted run needs in state.npz: the weights of
+the model and of the optimizer, the learning rate, the epoch and step reached, the seed and the state
+of the callbacks (ReduceLROnPlateau, SnapshotWriter). load_state / restore_state put them back.
+"""
+import json
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import keras
+
+state_name = 'state.npz'
+
+
+def batch_seed(seed, number):
+    return (seed * 1000003 + number) % 2**32
+
+
+class ResumableSequence(keras.utils.Sequence):
+    """ The batches of generator for keras epochs of steps batches, from step start_step of epoch epoch (both from 0).
+        Use with fit_generator(shuffle=False), the shuffling is done here.
+    """
+    def __init__(self, generator, steps, seed, epoch=0, start_step=0):
+        self.generator  = generator
+        self.steps      = steps
+        self.seed       = seed
+        self.epoch      = epoch
+        self.start_step = start_step
+        self.passes     = {}
+        self.prepare()
+
+    def __len__(self):
+        return self.steps - self.start_step
+
+    def number(self, index):
+        """ Number of the batch index of the current epoch since the start of the training """
+        return self.epoch * self.steps + self.start_step + index
+
+    def groups(self, number):
+        """ The groups of the pass of the batch number """
+        images_pass = number // len(self.generator)
+        if images_pass not in self.passes:
+            rng = random.Random(batch_seed(self.seed, images_pass))
+            if hasattr(self.generator, 'pass_groups'):
+                self.passes[images_pass] = self.generator.pass_groups(rng)
+            else:
+                self.passes[images_pass] = list(self.generator.groups)
+                if self.generator.shuffle_groups:
+                    rng.shuffle(self.passes[images_pass])
+        return self.passes[images_pass]
+
+    def prepare(self):
+        # the groups of the passes of this epoch, before the worker processes get a copy of the sequence
+        first, last = self.number(0), self.number(len(self) - 1)
+        self.passes = {images_pass: groups for images_pass, groups in self.passes.items() if images_pass >= first // len(self.generator)}
+        for number in range(first, last + 1, len(self.generator)):
+            self.groups(number)
+        self.groups(last)
+
+    def __getitem__(self, index):
+        number = self.number(index)
+        # the augmentation only depends on the batch
+        np.random.seed(batch_seed(self.seed, number))
+        return self.generator.compute_input_output(self.groups(number)[number % len(self.generator)])
+
+    def on_epoch_end(self):
+        self.epoch     += 1
+        self.start_step = 0
+        self.prepare()
+
+
+def callback_state(callbacks):
+    """ The state of the callbacks that have one to resume, by class name """
+    from maskrcnn_modanet.train.snapshots import SnapshotWriter
+
+    states = {}
+    for callback in callbacks:
+        if isinstance(callback, keras.callbacks.ReduceLROnPlateau):
+            states['ReduceLROnPlateau'] = {'wait': int(callback.wait), 'best': float(callback.best), 'cooldown_counter': int(callback.cooldown_counter)}
+        elif isinstance(callback, SnapshotWriter):
+            states['SnapshotWriter'] = {'step': callback.step}
+    return states
+
+
+def restore_callback_state(callbacks, states):
+    for callback in callbacks:
+        for name, state in states.items():
+            if name in [cls.__name__ for cls in type(callback).__mro__]:
+                for key, value in state.items():
+                    setattr(callback, key, value)
+
+
+def load_state(snapshot_path):
+    """ The saved state of the training in snapshot_path, None if there is none """
+    path = os.path.join(snapshot_path, state_name)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        state = {key: data[key] for key in data.files}
+    state['info'] = json.loads(str(state['info']))
+    return state
+
+
+def restore_state(model, state):
+    """ Puts the weights of the model and of its optimizer, and the learning rate, of state back """
+    model.set_weights([state['model_{}'.format(i)] for i in range(state['info']['model_weights'])])
+    # the optimizer weights only exist once the training function is made
+    model._make_train_function()
+    model.optimizer.set_weights([state['optimizer_{}'.format(i)] for i in range(state['info']['optimizer_weights'])])
+    keras.backend.set_value(model.optimizer.lr, state['info']['lr'])
+
+
+class TrainingState(keras.callbacks.Callback):
+    """ Saves the state of the training in snapshot_path/state.npz at the end of every epoch and every every_steps steps if given.
+        It goes after all the other callbacks, so that their state at the end of an epoch is the final one; callbacks are the other callbacks.
+        The arrays are copied on the training thread and written by a background thread, to a temporary file renamed over the old state.
+    """
+    def __init__(self, snapshot_path, seed, steps, callbacks, every_steps=None, epoch=0, start_step=0, states=None):
+        super(TrainingState, self).__init__()
+        self.snapshot_path = snapshot_path
+        self.seed          = seed
+        self.steps         = steps
+        self.callbacks     = callbacks
+        self.every_steps   = every_steps
+        self.epoch         = epoch
+        self.start_step    = start_step
+        self.states        = states
+        self.thread        = None
+
+    def on_train_begin(self, logs=None):
+        # after the other callbacks reset themselves
+        if self.states:
+            restore_callback_state(self.callbacks, self.states)
+            self.states = None
+        self.pending = queue.Queue(maxsize=1)
+        self.error   = None
+        self.thread  = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        step = self.start_step + batch + 1
+        if self.every_steps and (self.epoch * self.steps + step) % self.every_steps == 0 and step < self.steps:
+            self.save(self.epoch, step)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.start_step = 0
+        self.save(epoch + 1, 0)
+
+    def on_train_end(self, logs=None):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def save(self, epoch, step):
+        """ Copies the state reached at step of epoch now, the background thread writes it """
+        if self.error:
+            raise self.error
+        optimizer = self.model.optimizer
+        arrays = {}
+        for prefix, values in (('model', self.model.get_weights()), ('optimizer', optimizer.get_weights())):
+            for i, value in enumerate(values):
+                arrays['{}_{}'.format(prefix, i)] = value
+        info = {
+            'epoch'             : epoch,
+            'step'              : step,
+            'steps'             : self.steps,
+            'seed'              : self.seed,
+            'lr'                : float(keras.backend.get_value(optimizer.lr)),
+            'model_weights'     : sum(1 for key in arrays if key.startswith('model_')),
+            'optimizer_weights' : sum(1 for key in arrays if key.startswith('optimizer_')),
+            'callbacks'         : callback_state(self.callbacks),
+        }
+        arrays['info'] = np.array(json.dumps(info))
+        self.pending.put(arrays)
+
+    def write(self):
+        path = os.path.join(self.snapshot_path, state_name)
+        while True:
+            arrays = self.pending.get()
+            if arrays is None:
+                break
+            try:
+                os.makedirs(self.snapshot_path, exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    np.savez(f, **arrays)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + '.tmp', path)
+            except Exception as e:
+                self.error = e
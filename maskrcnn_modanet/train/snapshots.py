@@ -0,0 +1,228 @@
+"""
+Weights only snapshots, written in the background, with an index.
+
+SnapshotWriter copies the weights of the model in memory (a single session run), and a background
+thread writes them to an .h5 file with the layout of keras' save_weights, so that training goes on
+while the file is written. Snapshots are taken at the end of every epoch and optionally every N steps.
+Only the last K snapshots, and the best one by the monitored value, are kept.
+
+Every snapshot folder has an index.json:
+
+    {
+        "model"     : {"backbone": "resnet50", "num_classes": 13, ...},   what is needed to build the model again
+        "monitor"   : "loss", "mode": "min",
+        "snapshots" : [{"file": ..., "epoch": ..., "step": ..., "time": ..., "value": ...}, ...],   oldest first
+        "latest"    : file of the last snapshot,
+        "best"      : file of the best snapshot
+    }
+
+latest_snapshot finds the last snapshot of a folder from it, load_snapshot builds the model of a
+weights only snapshot from it (full model snapshots are loaded as they are).
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+import h5py
+import numpy as np
+import keras
+
+index_name = 'index.json'
+
+
+def read_index(snapshot_path):
+    """ The index of the snapshots folder, None if there is none. """
+    try:
+        with open(os.path.join(snapshot_path, index_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_index(snapshot_path, index):
+    # written aside and renamed, readers never see half an index
+    path = os.path.join(snapshot_path, index_name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def latest_snapshot(snapshot_path):
+    """ Path of the last snapshot written in snapshot_path according to its index, None without an index. """
+    index = read_index(snapshot_path)
+    if not index or not index.get('latest'):
+        return None
+    return os.path.join(snapshot_path, index['latest'])
+
+
+def is_weights_only(path):
+    """ Whether the .h5 at path only has the weights, without the model. """
+    with h5py.File(path, 'r') as f:
+        return 'model_config' not in f.attrs
+
+
+def load_snapshot(path, backbone_name='resnet50'):
+    """ The model of the snapshot at path. A full model is loaded as it is, a weights only snapshot is built from the model of the index of its folder.
+    """
+    from keras_maskrcnn import models
+
+    if not is_weights_only(path):
+        return models.load_model(path, backbone_name=backbone_name)
+
+    index = read_index(os.path.dirname(path))
+    if not index or 'model' not in index:
+        raise ValueError('{} only has the weights, and there is no {} next to it to build the model'.format(path, index_name))
+    info = index['model']
+
+    anchor_params = None
+    if info.get('anchor_parameters'):
+        from keras_retinanet.utils.anchors import AnchorParameters
+        parameters    = info['anchor_parameters']
+        anchor_params = AnchorParameters(parameters['sizes'], parameters['strides'], np.array(parameters['ratios'], keras.backend.floatx()), np.array(parameters['scales'], keras.backend.floatx()))
+
+    model = models.backbone(info['backbone']).maskrcnn(
+        info['num_classes'],
+        nms=True,
+        class_specific_filter=info.get('class_specific_filter', True),
+        anchor_params=anchor_params
+    )
+    model.load_weights(path)
+    return model
+
+
+def save_weights(path, layers, values):
+    """ Writes the values of the weights of layers like keras' save_weights, to be read by load_weights. """
+    with h5py.File(path + '.tmp', 'w') as f:
+        f.attrs['layer_names']   = [layer.name.encode('utf8') for layer in layers]
+        f.attrs['backend']       = keras.backend.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+        for layer, layer_values in zip(layers, values):
+            group = f.create_group(layer.name)
+            names = [weight.name.encode('utf8') for weight in layer.weights]
+            group.attrs['weight_names'] = names
+            for name, value in zip(names, layer_values):
+                dataset = group.create_dataset(name, value.shape, dtype=value.dtype)
+                if not value.shape:
+                    dataset[()] = value
+                else:
+                    dataset[:] = value
+    os.replace(path + '.tmp', path)
+
+
+class SnapshotWriter(keras.callbacks.Callback):
+    """ Weights only snapshots of model in snapshot_path, at the end of every epoch and every every_steps steps if given.
+
+    Args
+        model       : The model whose weights are saved (the prediction model).
+        name        : File name of the snapshots, formatted with epoch (from 1) and step (from the start of the training).
+        step_name   : File name of the snapshots taken every every_steps steps, formatted the same way.
+        model_info  : What load_snapshot needs to build the model: backbone, num_classes, class_specific_filter, anchor_parameters.
+        keep        : Number of snapshots kept, besides the best one. None keeps all of them.
+        monitor     : Epoch log value that decides the best snapshot; mode is 'min', 'max' or 'auto' (max for accuracies and mAPs).
+    """
+    def __init__(self, model, snapshot_path, name, step_name, model_info, every_steps=None, keep=None, monitor='loss', mode='auto'):
+        super(SnapshotWriter, self).__init__()
+        self.snapshot_model = model
+        self.snapshot_path  = snapshot_path
+        self.name           = name
+        self.step_name      = step_name
+        self.every_steps    = every_steps
+        self.keep           = keep
+        self.monitor        = monitor
+        if mode == 'auto':
+            mode = 'max' if 'acc' in monitor.lower() or 'map' in monitor.lower() else 'min'
+        self.mode           = mode
+
+        os.makedirs(snapshot_path, exist_ok=True)
+        self.index = read_index(snapshot_path) or {'snapshots': [], 'latest': None, 'best': None}
+        self.index.update({'model': model_info, 'monitor': monitor, 'mode': mode})
+
+        self.step      = 0
+        self.epoch     = 0
+        # called on the writing thread with the path and the index entry of every snapshot written
+        self.listeners = []
+
+    def on_train_begin(self, logs=None):
+        # a thread for every fit, that on_train_end waits for
+        self.pending = queue.Queue(maxsize=1)
+        self.error   = None
+        self.thread  = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        self.step += 1
+        if self.every_steps and self.step % self.every_steps == 0:
+            self.snapshot(self.step_name.format(epoch=self.epoch + 1, step=self.step), None)
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        self.snapshot(self.name.format(epoch=epoch + 1, step=self.step), None if value is None else float(value))
+
+    def on_train_end(self, logs=None):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def snapshot(self, file_name, value):
+        """ Copies the weights now, and leaves them to the writing thread (waiting for the previous snapshot to be written). """
+        if self.error:
+            raise self.error
+        layers  = self.snapshot_model.layers
+        weights = [weight for layer in layers for weight in layer.weights]
+        flat    = keras.backend.batch_get_value(weights)
+
+        values = []
+        for layer in layers:
+            values.append(flat[:len(layer.weights)])
+            flat = flat[len(layer.weights):]
+
+        entry = {'file': file_name, 'epoch': self.epoch + 1, 'step': self.step, 'time': time.time(), 'value': value}
+        self.pending.put((layers, values, entry))
+
+    def write(self):
+        while True:
+            task = self.pending.get()
+            if task is None:
+                break
+            layers, values, entry = task
+            try:
+                start = time.time()
+                path  = os.path.join(self.snapshot_path, entry['file'])
+                save_weights(path, layers, values)
+                self.add(entry)
+                print('\nSnapshot {} written in {:.1f} s'.format(entry['file'], time.time() - start))
+                for listener in self.listeners:
+                    listener(path, entry)
+            except Exception as e:
+                self.error = e
+
+    def better(self, value, best):
+        return value < best if self.mode == 'min' else value > best
+
+    def add(self, entry):
+        """ Adds entry to the index, removing the snapshots over keep that are not the best one. """
+        snapshots = [snapshot for snapshot in self.index['snapshots'] if snapshot['file'] != entry['file']] + [entry]
+        self.index['latest'] = entry['file']
+
+        best = next((snapshot for snapshot in snapshots if snapshot['file'] == self.index['best']), None)
+        if entry['value'] is not None and (best is None or best['value'] is None or self.better(entry['value'], best['value'])):
+            self.index['best'] = entry['file']
+
+        if self.keep is not None:
+            kept    = snapshots[-self.keep:] if self.keep > 0 else []
+            removed = [snapshot for snapshot in snapshots if snapshot not in kept and snapshot['file'] != self.index['best']]
+            snapshots = [snapshot for snapshot in snapshots if snapshot not in removed]
+            for snapshot in removed:
+                try:
+                    os.remove(os.path.join(self.snapshot_path, snapshot['file']))
+                except OSError:
+                    pass
+
+        self.index['snapshots'] = snapshots
+        write_index(self.snapshot_path, self.index)
@@ -45,6 +45,9 @@ from keras_maskrcnn import losses
 from keras_maskrcnn import models
 from keras_maskrcnn.callbacks.eval import Evaluate
 
+from maskrcnn_modanet.resolution import resolution_policy
+from maskrcnn_modanet.train.callbacks import Throughput
+
 
 def get_session():
     config = tf.ConfigProto()  # allow_soft_placement=True) #, log_device_placement=True)
@@ -88,8 +91,8 @@ def create_models(backbone_retinanet, num_classes, weights, freeze_backbone=Fals
 def create_callbacks(model, training_model, prediction_model, validation_generator, args):
     callbacks = []
 
-    # save the prediction model
-    if args.snapshots:
+    # save the whole prediction model, with the optimizer state
+    if args.snapshots and args.full_snapshots:
         # ensure directory created first; otherwise h5py will error after epoch.
         os.makedirs(args.snapshot_path, exist_ok=True)
         checkpoint = keras.callbacks.ModelCheckpoint(
@@ -118,16 +121,57 @@ def create_callbacks(model, training_model, prediction_model, validation_generat
         )
         callbacks.append(tensorboard_callback)
 
+    snapshot_writer = None
+    if args.snapshots and not args.full_snapshots:
+        from maskrcnn_modanet.train.snapshots import SnapshotWriter
+        snapshot_writer = SnapshotWriter(
+            prediction_model,
+            args.snapshot_path,
+            '{backbone}_{dataset_type}_{{epoch:02d}}.h5'.format(backbone=args.backbone, dataset_type=args.dataset_type),
+            '{backbone}_{dataset_type}_{{epoch:02d}}_step_{{step:07d}}.h5'.format(backbone=args.backbone, dataset_type=args.dataset_type),
+            args.model_info,
+            every_steps=args.snapshot_every_steps,
+            keep=args.snapshot_keep,
+            monitor=args.snapshot_monitor
+        )
+
     if args.evaluation and validation_generator:
         if args.dataset_type == 'coco':
-            from keras_maskrcnn.callbacks.coco import CocoEval
-
-            # use prediction model for evaluation
-            evaluation = CocoEval(validation_generator)
+            from maskrcnn_modanet.train.evaluation import EvaluationSchedule
+
+            schedule = EvaluationSchedule(validation_generator, args.epochs, args.eval_every, args.eval_subset, args.eval_full_every)
+            if args.eval_process:
+                from maskrcnn_modanet.train.evaluation import EvaluationProcess
+
+                # the same validation set, built again in the evaluation process
+                spec = {
+                    'data_dir'       : args.coco_path,
+                    'set_name'       : 'val',
+                    'lmdb_path'      : args.photos_lmdb,
+                    'packed_path'    : args.packed,
+                    'batch_size'     : args.batch_size,
+                    'config'         : args.config_file,
+                    'image_min_side' : args.resolution.min_side,
+                    'image_max_side' : args.resolution.max_side,
+                    'upscale'        : args.resolution.upscale,
+                }
+                callbacks.append(EvaluationProcess(snapshot_writer, schedule, spec, args.tensorboard_dir))
+            else:
+                from maskrcnn_modanet.train.evaluation import CocoEvaluation
+
+                # use prediction model for evaluation
+                callbacks.append(RedirectModel(CocoEvaluation(validation_generator, schedule, tensorboard=tensorboard_callback), prediction_model))
         else:
             evaluation = Evaluate(validation_generator, tensorboard=tensorboard_callback, weighted_average=args.weighted_average)
-        evaluation = RedirectModel(evaluation, prediction_model)
-        callbacks.append(evaluation)
+            evaluation = RedirectModel(evaluation, prediction_model)
+            callbacks.append(evaluation)
+
+    # save the weights of the prediction model in the background, after the evaluation so that it can be monitored
+    if snapshot_writer is not None:
+        callbacks.append(snapshot_writer)
+
+    # first, so that its values are in the logs of the TensorBoard callback and the time does not include the evaluation
+    callbacks.insert(0, Throughput(args.batch_size))
 
     callbacks.append(keras.callbacks.ReduceLROnPlateau(
         monitor  = 'loss',
@@ -149,25 +193,61 @@ def create_generators(args):
 
     if args.dataset_type == 'coco':
         # import here to prevent unnecessary dependency on cocoapi
+        from maskrcnn_modanet.train.augmentation import augmentation_policy
         from maskrcnn_modanet.train.coco import CocoGenerator
 
+        # the coco generator augments every batch at once, following the [augmentation] section of the config
+        augmentation = augmentation_policy(args.config)
+        print('Augmentation: {}'.format(augmentation))
+
+        # one cache for both sets, annotation ids are unique in the dataset
+        mask_cache = None
+        if args.mask_cache:
+            from maskrcnn_modanet.manifest import file_checksum, inputs_hash
+            from maskrcnn_modanet.train.mask_cache import MaskCache
+
+            # the masks are rasterized from these annotations, or decoded from the packed ones
+            sources = [os.path.join(args.coco_path, 'annotations', 'instances_' + set_name + '.json') for set_name in ('train', 'val')]
+            if args.packed:
+                from maskrcnn_modanet.pack_dataset import index_path
+                sources += [index_path(args.packed, set_name) for set_name in ('train', 'val')]
+            fingerprint = inputs_hash('packed' if args.packed else 'polygons', [file_checksum(path) for path in sources])
+            mask_cache  = MaskCache(args.mask_cache, fingerprint)
+
+        # shared by the workers and by the evaluation, that reads the val images every epoch
+        image_cache = None
+        if args.image_cache:
+            from maskrcnn_modanet.train.image_cache import ImageCache
+            image_cache = ImageCache(args.image_cache, args.image_cache_size * 2**20)
+
         train_generator = CocoGenerator(
             args.coco_path,
             'train',
-            transform_generator=transform_generator,
+            lmdb_path=args.photos_lmdb,
+            packed_path=args.packed,
+            mask_cache=mask_cache,
+            image_cache=image_cache,
+            aspect_buckets=args.aspect_buckets,
+            augmentation=augmentation,
             batch_size=args.batch_size,
             config=args.config,
-            image_min_side=800,
-            image_max_side=1333
+            image_min_side=args.resolution.min_side,
+            image_max_side=args.resolution.max_side,
+            upscale=args.resolution.upscale
         )
 
         validation_generator = CocoGenerator(
             args.coco_path,
             'val',
+            lmdb_path=args.photos_lmdb,
+            packed_path=args.packed,
+            mask_cache=mask_cache,
+            image_cache=image_cache,
             batch_size=args.batch_size,
             config=args.config,
-            image_min_side=800,
-            image_max_side=1333
+            image_min_side=args.resolution.min_side,
+            image_max_side=args.resolution.max_side,
+            upscale=args.resolution.upscale
         )
     elif args.dataset_type == 'csv':
         from keras_maskrcnn.preprocessing.csv_generator import CSVGenerator
@@ -178,8 +258,8 @@ def create_generators(args):
             transform_generator=transform_generator,
             batch_size=args.batch_size,
             config=args.config,
-            image_min_side=800,
-            image_max_side=1333
+            image_min_side=args.resolution.min_side,
+            image_max_side=args.resolution.max_side
         )
 
         if args.val_annotations:
@@ -188,8 +268,8 @@ def create_generators(args):
                 args.classes,
                 batch_size=args.batch_size,
                 config=args.config,
-                image_min_side=800,
-                image_max_side=1333
+                image_min_side=args.resolution.min_side,
+                image_max_side=args.resolution.max_side
             )
         else:
             validation_generator = None
@@ -209,6 +289,21 @@ def check_args(parsed_args):
     :return: parsed_args
     """
 
+    if parsed_args.snapshot_keep is not None and parsed_args.snapshot_keep < 1:
+        raise ValueError('--snapshot-keep has to keep at least the last snapshot, got {}.'.format(parsed_args.snapshot_keep))
+
+    if getattr(parsed_args, 'tf_data', False) and parsed_args.shared_memory_loader:
+        raise ValueError('--tf-data and --shared-memory-loader are both input pipelines, choose one of them.')
+
+    if parsed_args.eval_process and (parsed_args.dataset_type != 'coco' or not parsed_args.snapshots or parsed_args.full_snapshots):
+        raise ValueError('--eval-process evaluates the weights only snapshots of the coco dataset, it does not work with --no-snapshots or --full-snapshots.')
+
+    if parsed_args.eval_every < 1:
+        raise ValueError('--eval-every has to be at least 1, got {}.'.format(parsed_args.eval_every))
+
+    if parsed_args.resume and (getattr(parsed_args, 'tf_data', False) or parsed_args.shared_memory_loader):
+        raise ValueError('--resume needs the batches in a fixed order, that --tf-data and --shared-memory-loader do not keep.')
+
     return parsed_args
 
 
@@ -219,6 +314,13 @@ def parse_args(args, savedvars):
 
     coco_parser = subparsers.add_parser('coco')
     coco_parser.add_argument('--coco-path', help='Path to dataset directory (ie. /tmp/COCO).', default=savedvars['datapath'] + 'datasets/coco/')
+    coco_parser.add_argument('--packed', help='Read images and annotations from the shards written by \'maskrcnn-modanet datasets pack\'. Optionally the path of the shards folder.', nargs='?', const=savedvars['datapath'] + 'datasets/coco/packed/', default=None)
+    coco_parser.add_argument('--mask-cache', help='Keep the rasterized masks in an lmdb database, filled during the first epoch and emptied when the annotations or --packed change. Optionally the path of the database.', nargs='?', const=savedvars['datapath'] + 'datasets/coco/masks.lmdb', default=None)
+    coco_parser.add_argument('--image-cache', help='Keep the decoded images in an lmdb database shared by all the workers. Optionally the path of the database.', nargs='?', const=savedvars['datapath'] + 'datasets/coco/images.lmdb', default=None)
+    coco_parser.add_argument('--image-cache-size', help='Size in MB over which the least recently used images are evicted from the image cache.', type=int, default=8192)
+    coco_parser.add_argument('--aspect-buckets', help='Form the training batches within this many aspect ratio buckets, each padded to a fixed shape, reshuffled every epoch.', type=int, default=None)
+    coco_parser.add_argument('--tf-data', help='Build the training batches with a tf.data pipeline, decoding and preparing --workers images and batches at once in the TensorFlow threads, --max-queue-size batches ahead. Only the jpeg and png decoding runs out of the GIL: the masks, augmentation and targets are python calls sharing the training process, so with many workers --multiprocessing can be faster.', action='store_true')
+    coco_parser.add_argument('--photos-lmdb', help='Read the images straight from the paperdoll photos.lmdb instead of the images folder. Optionally the path of the database.', nargs='?', const=savedvars['datapath'] + 'datasets/paperdoll/data/chictopia/photos.lmdb', default=None)
 
     csv_parser = subparsers.add_parser('csv')
     csv_parser.add_argument('annotations', help='Path to CSV file containing annotations for training.')
@@ -227,7 +329,7 @@ def parse_args(args, savedvars):
 
 
     group = parser.add_mutually_exclusive_group()
-    group.add_argument('--snapshot',          help='Resume training from a snapshot.')
+    group.add_argument('--snapshot',          help='Resume training from a snapshot. Weights only snapshots start with a new optimizer state.')
     group.add_argument('--imagenet-weights',  help='Initialize the model with pretrained imagenet weights. This is the default behaviour.', action='store_const', const=True, default=True)
     group.add_argument('--weights',           help='Initialize the model with weights from a file.')
     group.add_argument('--no-weights',        help='Don\'t initialize the model with any weights.', dest='imagenet_weights', action='store_const', const=False)
@@ -240,15 +342,33 @@ def parse_args(args, savedvars):
     parser.add_argument('--snapshot-path',    help='Path to store snapshots of models during training (defaults to \'yourpath/results/snapshots/\')', default=savedvars['datapath'] + 'results/snapshots/')
     parser.add_argument('--tensorboard-dir',  help='Log directory for Tensorboard output', default=savedvars['datapath'] + 'results/logs/')
     parser.add_argument('--no-snapshots',     help='Disable saving snapshots.', dest='snapshots', action='store_false')
+    parser.add_argument('--snapshot-every-steps', help='Also save a snapshot every this many steps, besides the one at the end of every epoch.', type=int, default=None)
+    parser.add_argument('--snapshot-keep',    help='Only keep the last snapshots, and the best one by --snapshot-monitor (keeps all of them by default).', type=int, default=None)
+    parser.add_argument('--snapshot-monitor', help='Epoch log value deciding the best snapshot, like loss or mAP.', default='loss')
+    parser.add_argument('--resume',           help='Resume an interrupted training from the state saved in the snapshot path, at the exact batch it was interrupted at.', action='store_true')
+    parser.add_argument('--seed',             help='Seed of the order of the batches and of the augmentation (random by default, the saved one with --resume).', type=int, default=None)
+    parser.add_argument('--state-every-steps', help='Also save the state of the training every this many steps, besides the end of every epoch.', type=int, default=None)
+    parser.add_argument('--full-snapshots',   help='Save the whole model with the optimizer state at the end of every epoch, instead of the weights only snapshots written in the background.', action='store_true')
     parser.add_argument('--no-evaluation',    help='Disable per epoch evaluation.', dest='evaluation', action='store_false')
+    parser.add_argument('--eval-every',       help='Evaluate every this many epochs (and after the last one).', type=int, default=1)
+    parser.add_argument('--eval-subset',      help='Evaluate on a fixed subset of this many validation images, with the categories in the proportions of the whole set (coco only).', type=int, default=None)
+    parser.add_argument('--eval-full-every',  help='With --eval-subset, evaluate on all the validation images every this many epochs (and after the last one).', type=int, default=None)
+    parser.add_argument('--eval-process',     help='Evaluate the snapshots in a separate process while the training goes on, logging the mAPs to the same TensorBoard run (coco only, the mAPs are not in the epoch logs).', action='store_true')
     parser.add_argument('--freeze-backbone',  help='Freeze training of backbone layers.', action='store_true')
     parser.add_argument('--no-class-specific-filter', help='Disables class specific filtering.', dest='class_specific_filter', action='store_false')
     parser.add_argument('--config',           help='Path to a configuration parameters .ini file.')
+    parser.add_argument('--image-min-side',   help='Rescale the image so the smallest side is min_side (overrides the [resolution] section of --config, default 800).', type=int)
+    parser.add_argument('--image-max-side',   help='Rescale the image if the largest side is larger than max_side (overrides the [resolution] section of --config, default 1333).', type=int)
+    parser.add_argument('--no-upscale',       help='Keep the images smaller than the min / max sides at their native resolution, only downscale the larger ones.', dest='upscale', action='store_const', const=False, default=None)
+    parser.add_argument('--step-times',       help='Record the time of every step spent waiting for data, computing and in the callbacks, logging their percentiles to TensorBoard and to step_times.json in the tensorboard dir.', action='store_true')
+    parser.add_argument('--profile-steps',    help='Trace the TensorFlow ops of the training steps first,last (or of a single step, counted from 1), saving Chrome traces and a summary of the top ops in the profile folder of the tensorboard dir.')
     parser.add_argument('--weighted-average', help='Compute the mAP using the weighted average of precisions among classes.', action='store_true')
 
     # Fit generator arguments
     parser.add_argument('--workers', help='Number of multiprocessing workers. To disable multiprocessing, set workers to 0', type=int, default=1)
     parser.add_argument('--max-queue-size', help='Queue length for multiprocessing workers in fit generator.', type=int, default=10)
+    parser.add_argument('--shared-memory-loader', help='With workers > 0, pass the batches from the workers through max-queue-size shared memory slots instead of pickling them.', action='store_true')
+    parser.add_argument('--loader-slot-size', help='Size in MB of each shared memory slot (defaults to the largest possible batch of the coco dataset, capped to a quarter of the available memory for all the slots).', type=int, default=None)
 
     return check_args(parser.parse_args(args))
 
@@ -276,12 +396,51 @@ def main(args=None):
     keras.backend.tensorflow_backend.set_session(get_session())
 
     # optionally load config parameters
+    args.config_file = args.config
     if args.config:
         args.config = read_config_file(args.config)
 
+    # the same resolution is used for training and evaluation, and printed to be used for inference too
+    args.resolution = resolution_policy(args.config, args.image_min_side, args.image_max_side, args.upscale)
+    print(args.resolution)
+
     # create the generators
     train_generator, validation_generator = create_generators(args)
 
+    # what is needed to build the model again from weights only snapshots
+    anchor_params = None
+    if args.config and 'anchor_parameters' in args.config:
+        anchor_params = parse_anchor_parameters(args.config)
+    args.model_info = {
+        'backbone'              : args.backbone,
+        'num_classes'           : train_generator.num_classes(),
+        'class_specific_filter' : args.class_specific_filter,
+        'anchor_parameters'     : None if anchor_params is None else {
+            'sizes'   : list(anchor_params.sizes),
+            'strides' : list(anchor_params.strides),
+            'ratios'  : anchor_params.ratios.tolist(),
+            'scales'  : anchor_params.scales.tolist(),
+        },
+    }
+
+    # the state of an interrupted training, put back once the model is created
+    state = None
+    if args.resume:
+        from maskrcnn_modanet.train.resume import load_state
+        state = load_state(args.snapshot_path)
+        if state is None:
+            raise ValueError('There is no saved training state in {} to resume from.'.format(args.snapshot_path))
+        if state['info']['steps'] != args.steps:
+            raise ValueError('The training to resume had {} steps per epoch, not {}.'.format(state['info']['steps'], args.steps))
+        args.snapshot, args.weights, args.imagenet_weights = None, None, False
+        print('Resuming from epoch {} step {}'.format(state['info']['epoch'] + 1, state['info']['step']))
+
+    # weights only snapshots resume from a new model
+    if args.snapshot is not None:
+        from maskrcnn_modanet.train.snapshots import is_weights_only
+        if is_weights_only(args.snapshot):
+            args.weights, args.snapshot = args.snapshot, None
+
     # create the model
     if args.snapshot is not None:
         print('Loading model, this may take a second...')
@@ -294,10 +453,6 @@ def main(args=None):
         if weights is None and args.imagenet_weights:
             weights = backbone.download_imagenet()
 
-        anchor_params = None
-        if args.config and 'anchor_parameters' in args.config:
-            anchor_params = parse_anchor_parameters(args.config)
-
         print('Creating model, this may take a second...')
         model, training_model, prediction_model = create_models(
             backbone_retinanet=backbone.maskrcnn,
@@ -308,6 +463,10 @@ def main(args=None):
             anchor_params=anchor_params
         )
 
+    if state is not None:
+        from maskrcnn_modanet.train.resume import restore_state
+        restore_state(training_model, state)
+
     # print model summary
     print(model.summary())
 
@@ -320,24 +479,124 @@ def main(args=None):
         args,
     )
 
+    # before the TensorBoard callback, so that it writes the cache stats too
+    for name in ('mask_cache', 'image_cache'):
+        if getattr(train_generator, name, None) is not None:
+            from maskrcnn_modanet.train.callbacks import CacheStats
+            callbacks.insert(0, CacheStats(getattr(train_generator, name), name))
+
     # Use multiprocessing if workers > 0
     if args.workers > 0:
         use_multiprocessing = True
     else:
         use_multiprocessing = False
 
+    generator = train_generator
+    workers   = args.workers
+    loader    = None
+    sequence  = None
+    epoch, start_step = (state['info']['epoch'], state['info']['step']) if state is not None else (0, 0)
+    if getattr(args, 'tf_data', False):
+        from maskrcnn_modanet.train.dataset import CocoDataset
+
+        # the pipeline has its own threads, keras just iterates over it
+        generator = CocoDataset(train_generator, parallel_calls=max(args.workers, 1), prefetch=args.max_queue_size)
+        workers, use_multiprocessing = 0, False
+    elif args.shared_memory_loader and args.workers > 0:
+        from maskrcnn_modanet.train.callbacks import LoaderStats
+        from maskrcnn_modanet.train.loader import SharedMemoryLoader, default_slot_bytes
+
+        if args.loader_slot_size is not None:
+            slot_bytes = args.loader_slot_size * 2**20
+        elif hasattr(train_generator, 'max_batch_nbytes'):
+            slot_bytes = default_slot_bytes(train_generator.max_batch_nbytes(), args.max_queue_size)
+        else:
+            raise ValueError('--loader-slot-size is needed for the {} dataset'.format(args.dataset_type))
+        print('Shared memory loader: {} slots of {:.0f} MB'.format(args.max_queue_size, slot_bytes / 2**20))
+
+        # the loader runs its own workers, keras just iterates over it
+        loader = SharedMemoryLoader(train_generator, args.workers, args.max_queue_size, slot_bytes)
+        generator, workers, use_multiprocessing = loader, 0, False
+        callbacks.insert(0, LoaderStats(loader))
+    else:
+        from maskrcnn_modanet.train.resume import ResumableSequence
+
+        if state is not None:
+            args.seed = state['info']['seed']
+        elif args.seed is None:
+            args.seed = int.from_bytes(os.urandom(4), 'little')
+        print('Seed: {}'.format(args.seed))
+        sequence  = ResumableSequence(train_generator, args.steps, args.seed, epoch, start_step)
+        generator = sequence
+
+    if args.profile_steps:
+        from maskrcnn_modanet.profiling import OpProfiler, parse_steps
+        from maskrcnn_modanet.train.callbacks import OpProfile
+        callbacks.append(OpProfile(OpProfiler(parse_steps(args.profile_steps), os.path.join(args.tensorboard_dir or args.snapshot_path, 'profile'), 'train')))
+
+    # after all the other callbacks (but inside the step times), so that it saves their state at the end of the epochs
+    training_state = None
+    if args.snapshots and sequence is not None:
+        from maskrcnn_modanet.train.resume import TrainingState
+        training_state = TrainingState(
+            args.snapshot_path,
+            args.seed,
+            args.steps,
+            list(callbacks),
+            every_steps=args.state_every_steps,
+            epoch=epoch,
+            start_step=start_step,
+            states=state['info']['callbacks'] if state is not None else None
+        )
+        callbacks.append(training_state)
+
+    # around all the other callbacks
+    if args.step_times:
+        from maskrcnn_modanet.train.callbacks import StepTimes
+        step_times = StepTimes(os.path.join(args.tensorboard_dir or args.snapshot_path, 'step_times.json'))
+        callbacks.insert(0, step_times)
+        callbacks.append(step_times.end)
+
+    def fit(steps, epochs, initial_epoch):
+        training_model.fit_generator(
+            generator=generator,
+            steps_per_epoch=steps,
+            epochs=epochs,
+            initial_epoch=initial_epoch,
+            verbose=1,
+            callbacks=callbacks,
+            workers=workers,
+            use_multiprocessing=use_multiprocessing,
+            max_queue_size=args.max_queue_size,
+            # the order of the batches is the one of the ResumableSequence
+            shuffle=False
+        )
 
     # start training
-    training_model.fit_generator(
-        generator=train_generator,
-        steps_per_epoch=args.steps,
-        epochs=args.epochs,
-        verbose=1,
-        callbacks=callbacks,
-        workers=args.workers,
-        use_multiprocessing=use_multiprocessing,
-        max_queue_size=args.max_queue_size
-    )
+    try:
+        if start_step > 0 and epoch < args.epochs:
+            # the rest of the interrupted epoch, then the next ones as usual
+            fit(args.steps - start_step, epoch + 1, epoch)
+            # whether keras or its enqueuer already moved the sequence to the next epoch or not
+            epoch, start_step   = epoch + 1, 0
+            sequence.epoch      = epoch
+            sequence.start_step = start_step
+            sequence.prepare()
+            if training_state is not None:
+                from maskrcnn_modanet.train.resume import callback_state
+                # the next fit resets them
+                training_state.states = callback_state(training_state.callbacks)
+        if epoch < args.epochs:
+            fit(args.steps, args.epochs, epoch)
+    finally:
+        if loader is not None:
+            loader.close()
+        if args.evaluation and args.eval_process:
+            from maskrcnn_modanet.train.evaluation import EvaluationProcess
+            for callback in callbacks:
+                if isinstance(callback, EvaluationProcess):
+                    # waits for the evaluations left
+                    callback.close()
 
 if __name__ == '__main__':
     main()
@@ -1,11 +1,10 @@
-
-
-
 def viewAnnotations(img_path):
 
 	import json
 	import os
 
+	from maskrcnn_modanet.annotations_index import annotations_index
+
 	with open(os.path.expanduser('~')+ '/.maskrcnn-modanet/' + 'savedvars.json') as f:
 		savedvars = json.load(f)
 	path = savedvars['datapath']
@@ -15,35 +14,11 @@ def viewAnnotations(img_path):
 	snp_path = path + "results/snapshots"
 
 
-	# load annotations
-	with open(ann_path + 'instances_all.json') as f:
-			instances = json.load(f)
-
-
-	images_ids = {
-		'file_name': 'id'
-	}
-
-	#images_filenames = [None] * 1115985
-
-
-	for img in instances['images']:
-		images_ids[img['file_name']] = img['id']
-		#images_filenames[img['id']] = img['file_name']
-
-
-	# images_anns contains all the annotations for each image_id. 
-	# the key is the image_id, 
-	# the value is a list of the annotations for that id
-	images_anns = [ [] for i in range(1115985) ]
-	
-	img_id = images_ids[img_path]
-	for img in instances['images']:
-		if img['file_name'] == img_path:
-			images = [img]
+	# load the annotations of the image from the index
+	index = annotations_index(ann_path)
 
-	for ann in instances['annotations']:
-		if ann['image_id'] == img_id:
-			images_anns[img_id].append(ann)
+	img = index.image(img_path)
+	if img is None:
+		return []
 
-	return images_anns[img_id]
\ No newline at end of file
+	return index.image_annotations(img['id'])
@@ -123,6 +123,7 @@ def viewImages(img_path, segments, all_set, save_path=None, limit=None):
 	from keras_retinanet.utils.visualization import draw_box, draw_caption, draw_annotations
 	from keras_retinanet.utils.image import read_image_bgr
 	from keras_retinanet.utils.colors import label_color
+	from maskrcnn_modanet.annotations_index import annotations_index
 	from pycocotools import mask as maskUtils
 	
 	# from . import MyCOCO
@@ -133,30 +134,12 @@ def viewImages(img_path, segments, all_set, save_path=None, limit=None):
 	import numpy as np
 	import time
 
-	coco = MyCOCO(ann_path + 'instances_all.json')
+	# no annotation file: showAnns only needs the images shown, set one by one
+	coco = MyCOCO()
 
-	# load annotations
-	with open(ann_path + 'instances_all.json') as f:
-			instances = json.load(f)
+	# load annotations from the index, only for the images needed
+	index = annotations_index(ann_path)
 
-
-	images_ids = {
-		'file_name': 'id'
-	}
-
-	#images_filenames = [None] * 1115985
-
-
-	for img in instances['images']:
-		images_ids[img['file_name']] = img['id']
-		#images_filenames[img['id']] = img['file_name']
-
-
-	# images_anns contains all the annotations for each image_id. 
-	# the key is the image_id, 
-	# the value is a list of the annotations for that id
-	images_anns = [ [] for i in range(1115985) ]
-	
 	# load label to names mapping for visualization purposes
 	labels_to_names = {0: 'bag', 1: 'belt', 2: 'boots', 3: 'footwear', 4: 'outer', 5: 'dress', 6: 'sunglasses', 7: 'pants', 8: 'top', 9: 'shorts', 10: 'skirt', 11: 'headwear', 12: 'scarf/tie'}
 
@@ -175,22 +158,12 @@ def viewImages(img_path, segments, all_set, save_path=None, limit=None):
 	if all_set:
 		# load images
 		
-		images = instances['images']
-
-		for ann in instances['annotations']:
-			images_anns[ann['image_id']].append(ann)
+		images = index.images()
 
 
 	elif img_path:
 		# just draw the image selected
-		img_id = images_ids[img_path]
-		for img in instances['images']:
-			if img['file_name'] == img_path:
-				images = [img]
-
-		for ann in instances['annotations']:
-			if ann['image_id'] == img_id:
-				images_anns[img_id].append(ann)
+		images = [index.image(img_path)]
 
 	try:
 		#for each image in the dataset
@@ -219,13 +192,16 @@ def viewImages(img_path, segments, all_set, save_path=None, limit=None):
 
 			img_id = img['id']
 
+			image_anns = index.image_annotations(img_id)
+
 			plt.imshow(draw); plt.axis('on')
-			coco.showAnns(images_anns[img_id])
+			coco.imgs = {img_id: img}
+			coco.showAnns(image_anns)
 			plt.show()
 
 			segment_id = 0
 			# visualize detections
-			for ann in images_anns[img_id]:
+			for ann in image_anns:
 				break
 				box = ann['bbox']
 				label = ann['category_id'] - 1 # they start from 1 in the annotations